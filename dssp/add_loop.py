@@ -57,18 +57,16 @@ def cel2bytes(celsius, byte_length=2):
     payload = scaled_temp.to_bytes(byte_length, byteorder='little', signed=False)
     return payload
 
-# bytes to celsius
-def bytes2cel(byte_sequence):
-    value = int.from_bytes(byte_sequence, byteorder='little')
-    kelvin = value / 10
-    celsius = kelvin - 273.15
-    return celsius
+# 0.1K units to celsius
+def dk2cel(value):
+    return value / 10 - 273.15
 
 def main():
     cmd_line = argparse.ArgumentParser(description="Dawn Aerospace DSSP Test")
     cmd_line.add_argument("device", help="The serial or CAN interface")
     cmd_line.add_argument("node", help="The target node id", type = int)
     cmd_line.add_argument("-b", "--baudrate", help="CAN or Serial baud rate", type=int, default=115200)
+    cmd_line.add_argument("-w", "--window", help="Serial gateway requests in flight", type=int, default=1)
     args = cmd_line.parse_args()
 
     print( "Dawn Aerospace (c) 2022")
@@ -77,7 +75,7 @@ def main():
     try:
         gateway = dssp.CanInterface()
         try:
-            gateway.connect(channel=args.device)
+            gateway.connect(channel=args.device, window=args.window)
         except:
             print("Error connecting to ", args.device)
             exit(-1)
@@ -115,9 +113,9 @@ def main():
                     (0x2623, 5)
                 ]
 
+                temps = dssp.sdo_read_many(node.sdo, [(address, subindex, dssp.GATEWAY_TYPE_UINT16) for address, subindex in addresses_and_subindexes])
                 for address, subindex in addresses_and_subindexes:
-                    data = node.sdo.upload(address, subindex)
-                    temp_celsius = bytes2cel(data)
+                    temp_celsius = dk2cel(temps[(address, subindex)])
                     print(f"Address {hex(address)}, Subindex {subindex}: {temp_celsius:.2f} °C")
             except Exception as e:
                 print(f"Error during read operations: {e}")
@@ -16,22 +16,10 @@
 
 import time
 import argparse
+import os
 import dssp_canopen as dssp
-from io import SEEK_END
-
-# Naive and slow crc32 calculator is deliberately not the same implementation as
-# embedded code
-def crc32( initial, buffer ):
-    remainder = initial ^ 0xFFFFFFFF    
-
-    for val in buffer:
-        remainder = remainder ^ val
-        for bit in range(8,0,-1):
-            if (remainder & 1):
-                remainder = (remainder >> 1) ^ 0xEDB88320
-            else:
-                remainder = (remainder >> 1)
-    return remainder ^ 0xFFFFFFFF
+from dssp_canopen.flash import FirmwareDownload, FlashNode
+from dssp_canopen.flash_signature import file_signature
 
 def main():
     parser = argparse.ArgumentParser(description="Dawn Aerospace DSSP CANopen bootloader")
@@ -41,10 +29,12 @@ def main():
     parser.add_argument("-r", "--region", help="The flash region to program", type=int, choices=range(1,4,1), metavar="[1-3]", default=2)
     parser.add_argument("-b", "--baud_rate", help="Serial baud rate", type=int, default=115200)
     parser.add_argument("-s", "--size", help="Block size, typical 64", type=int, choices=range(1,65,1), metavar="[1-64]", default =64)
+    parser.add_argument("-w", "--window", help="Blocks in flight, 1 unless the gateway is known to queue requests", type=int, default=1)
     parser.add_argument("-q", "--quiet", help="Don't ask questions, just load and execute", action="store_true")
     parser.add_argument("-v", "--validate", help="Just sign whats there", action="store_true")
     parser.add_argument("-y", "--confirm", help="Answer yes to any questions", action="store_true")
     parser.add_argument("-e", "--erase", help="Erase region only", action="store_true")
+    parser.add_argument("-u", "--skip_unchanged", help="Don't erase and download if the region signature matches the file", action="store_true")
 
     args = parser.parse_args()
 
@@ -52,7 +42,7 @@ def main():
     print( "Starting DSSP bootloader on ", args.device )
 
     try:
-        gateway = dssp.CanOpenGateway(args.device, args.baud_rate)
+        gateway = dssp.CanOpenGateway(args.device, args.baud_rate, args.window)
 
         target_node = gateway.add_node(args.target_id, None)
         
@@ -71,18 +61,29 @@ def main():
                     print ('%-30s' % ("OD[" + hex(index) + "]"), ":", val)
 
             print( '%-30s' % "Flash region", ":", args.region)
-            region_length, last = gateway.upload(args.target_id, 0x1F58, args.region, dssp.GATEWAY_TYPE_UINT32)  
+
+        # the region length is needed for the file signature
+        region_length, last = gateway.upload(args.target_id, 0x1F58, args.region, dssp.GATEWAY_TYPE_UINT32)
+        if not (args.quiet):
             print( '%-30s' % "Flash region length", ":", region_length)
 
-            # read out the current signature
-            sig, last = gateway.upload(args.target_id, 0x1F56, args.region, dssp.GATEWAY_TYPE_UINT32)
+        # read out the current signature
+        sig, last = gateway.upload(args.target_id, 0x1F56, args.region, dssp.GATEWAY_TYPE_UINT32)
+        if not (args.quiet):
             print( '%-30s' % "Flash region signature", ": %08X" % sig )
 
+        # skip the erase and download if the region already holds the file
+        unchanged = False
+        if (args.skip_unchanged) and not (args.erase) and not (args.validate):
+            unchanged = (file_signature(args.file, region_length) == sig)
+            if (unchanged):
+                print( f"Node {args.target_id} region {args.region} already holds {args.file}, skipping erase and download" )
+
         if not(args.quiet):
             print("Unlocking...")
         gateway.download(args.target_id, 0x7F50, args.region, dssp.GATEWAY_TYPE_UINT32, b'INIT' )     # unlocks flash region
 
-        if not (args.validate):
+        if not (args.validate or unchanged):
             # erase flash and download the binary 
             if (args.quiet) or (args.confirm):
                 ch = 'Y'
@@ -98,7 +99,7 @@ def main():
                 print("Erasing...", end ='')
             
             starttime = time.time()
-            gateway.download(args.target_id, 0x1F51, args.region, dssp.GATEWAY_TYPE_UINT8, b'\x03')      # erase flash block
+            gateway.download(args.target_id, 0x1F51, args.region, dssp.GATEWAY_TYPE_UINT8, b'\x03', timeout=FlashNode.ERASE_TIMEOUT)      # erase flash block
             erasetime = time.time() - starttime
             if not(args.quiet):
                 print( f"\rErased flash in {erasetime:.2f} s")
@@ -107,45 +108,26 @@ def main():
             
             if not (args.erase):
                 # now download the firmware
-                fs = open(args.file, "rb")                                  # open firmware file
-                fs.seek(0, SEEK_END)
-                filelen = fs.tell()                                         # find length
-                fs.seek(0)
+                filelen = os.path.getsize(args.file)
                 if not (args.quiet):
                     print(f"About to download {filelen} bytes")
                 starttime = time.time()
-                blocknum = 0
-                crc = 0
-                bytes_processed = 0
-                while True:
-                    b = fs.read(args.size)
-                    if len(b) == 0:
-                        break
-                    if (filelen > 0 ) and not (args.quiet):
-                        print (f'\r{((blocknum*args.size)/filelen):.0%} ', end='')
-                    gateway.download(args.target_id, 0x1F50, args.region, dssp.GATEWAY_TYPE_DOMAIN, b, blocknum*args.size, False )
-                        
-                    bytes_processed += len(b)
-                    crc = crc32(crc, b)
-                    blocknum = blocknum + 1
-
-                # force the target to commit buffers to flash
-                gateway.download(args.target_id, 0x1F50, args.region, dssp.GATEWAY_TYPE_DOMAIN, b, blocknum*args.size, True )
-
-                # close file
-                fs.close()
+
+                def progress(acked, total, elapsed):
+                    if (total > 0) and not (args.quiet):
+                        print (f'\r{(acked/total):.0%} {acked/max(elapsed, 1e-3)/1e3:.1f} kB/s ', end='')
+
+                engine = FirmwareDownload(gateway, args.target_id, args.region, args.size, args.window, progress = progress)
+                signature = engine.download_file(args.file)
 
                 # record the time it took for the download
                 downloadtime = time.time() - starttime
 
                 if not(args.quiet):
-                    print( f"Downloaded file in {downloadtime:.2f} s")
+                    print( f"\rDownloaded file in {downloadtime:.2f} s, {engine.retransmit_count} blocks resent")
 
                 # calculate file signature by padding rest of the region with 0xFF
-                erased_byte= {0xff}
-                while (bytes_processed < region_length):
-                    crc = crc32(crc, erased_byte)
-                    bytes_processed += 1
+                crc = signature.value(region_length)
 
                 # read the newly generated signature from device
                 val, last = gateway.upload(args.target_id, 0x1F56, args.region, dssp.GATEWAY_TYPE_UINT32 )
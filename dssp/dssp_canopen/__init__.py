@@ -1,6 +1,7 @@
 # package/__init__.py
 from dssp_canopen.canopen_gateway import *
 from dssp_canopen.gateway_transport import *
+from dssp_canopen.aio_gateway import AsyncCanOpenGateway
 from canopen import *
 import canopen
 import dssp_canopen
@@ -11,7 +12,7 @@ class CanInterface:
         self.target_node = None
         self.target_node_id = 0
 
-    def connect(self, channel, bustype='socketcan', bitrate=1000000 ):
+    def connect(self, channel, bustype='socketcan', bitrate=1000000, window=None ):
         try:
             if (channel.startswith('can') or channel.startswith('vcan') or bustype=='slcan'):
                 self.cif = canopen.Network()
@@ -19,7 +20,7 @@ class CanInterface:
                 node = canopen.LocalNode(127, None)
                 self.cif.add_node(node)
             else:
-                self.cif = dssp_canopen.canopen_gateway.CanOpenGateway(channel, 112500)
+                self.cif = dssp_canopen.canopen_gateway.CanOpenGateway(channel, 112500, window)
             self.scanner = self.cif.scanner
         except:
             print("Error connecting to ", channel)
@@ -0,0 +1,264 @@
+#!/bin/python
+#
+#               /|\
+#              / | \
+#             /  |  \
+#            /   |   \
+#           /   / \   \
+#          /   //|\\   \
+#         /   // | \\   \  (c) Dawn Aerospace Ltd
+#        /___//_/ \_\\___\  www.dawnaerospace.com
+#
+# @file aio_gateway.py
+# @brief asyncio DSSP gateway
+#
+# asyncio equivalent of CanOpenGateway.  The serial port is read from the event
+# loop (loop.add_reader) instead of a thread pair per link, so one process can
+# run several links and the instrument pollers in one loop:
+#
+#   gw = await AsyncCanOpenGateway.open('/dev/ttyUSB0')
+#   val, last = await gw.upload(5, 0x2612, 5, GATEWAY_TYPE_UINT16)
+#   results = await asyncio.gather(*(gw.upload(5, i, 0, GATEWAY_TYPE_UINT16) for i in indices))
+#
+# Requests share the windowing, matching and go-back-N retry rules of
+# DsspGateway (DsspRequestWindow), with one event loop timer for the deadlines.
+# As with CanOpenGateway one request is in flight unless a larger window is
+# given.  If the port fails, outstanding and later requests time out.
+# POSIX only, it needs a selectable serial file descriptor.
+#
+
+import argparse
+import asyncio
+import itertools
+import struct
+import time
+import serial
+
+from dssp_canopen.gateway_transport import *
+from dssp_canopen.dssp_dll import DsspDataLinkLayer
+from dssp_canopen.dssp_gateway import DsspGateway, DsspGatewayRequest, DsspRequestWindow
+from dssp_canopen.canopen_gateway import (CanOpenGateway, CanOpenGatewayError, CanOpenPdo,
+                                          CanOpenGatewayTimeoutError, CanOpenSdoAbortError)
+
+
+class AsyncCanOpenGateway:
+    RSP_TIMEOUT      = DsspGateway.RSP_TIMEOUT
+    RETRIES          = DsspGateway.RETRIES
+    WINDOW           = DsspGateway.WINDOW
+
+    def __init__(self, port, window = None):
+        self.dssp   = DsspDataLinkLayer()
+        self.gtp    = GatewayTransportProtocol()
+
+        self.tx_count   = 0
+        self.tx_ack = 0
+        self.rx_count   = 0
+        self.pdo = CanOpenPdo()
+
+        self._port = port
+        self._loop = asyncio.get_running_loop()
+        self.window = window if (window != None) else self.WINDOW
+        self._window = asyncio.Semaphore(self.window)
+        self._requests = DsspRequestWindow()
+        self._timer = None              # event loop handle of the next deadline
+        self._seq = itertools.count()
+        self._loop.add_reader(port.fileno(), self._on_readable)
+
+    @property
+    def retransmit_count(self):
+        return self._requests.retransmit_count
+
+    @classmethod
+    async def open(cls, port, baudrate = 115200, window = None):
+        return cls(serial.Serial(port, baudrate, timeout=0), window)
+
+    # Closes the port, outstanding and later requests fail with CanOpenGatewayTimeoutError
+    def close(self):
+        if (self._port != None):
+            self._loop.remove_reader(self._port.fileno())
+            try:
+                self._port.close()
+            except (OSError, serial.SerialException):
+                pass                            # the port has gone already
+            self._port = None
+        if (self._timer != None):
+            self._timer.cancel()
+            self._timer = None
+        for req in self._requests.pending.values():
+            if not (req.callback.done()):
+                req.callback.set_exception(CanOpenGatewayTimeoutError())
+        self._requests.pending.clear()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def _on_readable(self):
+        try:
+            data = self._port.read(max(self._port.in_waiting, 1))
+        except (OSError, serial.SerialException):
+            self.close()                        # the port has gone, don't spin on it
+            return
+        for frame in self.dssp.frames(data):
+            try:
+                msg = self.gtp.decode(frame)
+            except Exception:
+                continue                        # malformed frame
+            if (msg != None):
+                self._dispatch(msg)
+
+    def _dispatch(self, msg):
+        req = None
+        if ((msg.msg_type == GATEWAY_MSG_ACK) or
+            ((msg.msg_type == GATEWAY_MSG_SDO) and (msg.cmd == GatewayTransportProtocol.GATEWAY_CMD_SDO_UPLOAD_RSP))):
+            req = self._requests.match(msg)
+        if (msg.msg_type == GATEWAY_MSG_ACK):
+            self.tx_ack += 1
+            if (req != None) and not (req.callback.done()):
+                req.callback.set_result((msg.error_code, None))
+        else:
+            self.rx_count += 1
+            if (req != None) and not (req.callback.done()):
+                msg.payload_type = req.msg.payload_type
+                req.callback.set_result((DsspGateway.ERROR_NONE, msg))
+            self.rxInd(msg)
+
+    # Runs _on_deadline at the earliest deadline of the outstanding requests
+    def _arm(self):
+        wait = self._requests.wait(time.monotonic())
+        if (self._timer != None):
+            self._timer.cancel()
+            self._timer = None
+        if (wait != None):
+            self._timer = self._loop.call_later(wait, self._on_deadline)
+
+    def _on_deadline(self):
+        self._timer = None
+        frames, expired = self._requests.expire(time.monotonic())
+        if (frames) and (self._port != None):
+            self._port.write(b''.join(frames))
+        for req in expired:
+            if not (req.callback.done()):
+                req.callback.set_exception(CanOpenGatewayTimeoutError())
+        self._arm()
+
+    # Sends msg and returns the response message (None for an ACK).  Raises
+    # CanOpenGatewayTimeoutError, CanOpenSdoAbortError or CanOpenGatewayError.
+    async def post(self, msg, timeout = None, retries = None):
+        timeout = timeout if (timeout != None) else self.RSP_TIMEOUT
+        retries = retries if (retries != None) else self.RETRIES
+        frame = self.dssp.encode(self.gtp.encode(msg))
+        async with self._window:
+            if (self._port == None):
+                raise CanOpenGatewayTimeoutError()
+            req = DsspGatewayRequest(next(self._seq), msg, frame, timeout, retries, self._loop.create_future())
+            self._requests.open(req, time.monotonic())
+            self.tx_count += 1
+            self._port.write(frame)
+            self._arm()
+            error_code, rsp = await req.callback
+        if (error_code == DsspGateway.ERROR_SDO_ABORTED):
+            raise CanOpenSdoAbortError(msg.node, msg.index, msg.subindex)
+        if (error_code != DsspGateway.ERROR_NONE):
+            raise CanOpenGatewayError(error_code)
+        return rsp
+
+    async def upload( self, node_id, index, subindex, payload_type=GATEWAY_TYPE_DOMAIN, offset = 0, timeout = None ):
+        gtp_msg = GatewayTransportMessage( GATEWAY_MSG_SDO, GatewayTransportProtocol.GATEWAY_CMD_SDO_UPLOAD,
+                                        node = node_id, index = index, subindex = subindex, payload_type=payload_type, offset=offset )
+        return CanOpenGateway.decode(payload_type, await self.post(gtp_msg, timeout))
+
+    async def download( self, node_id, index, subindex, payload_type, payload, offset = 0, last = True, timeout = None ):
+        if ((offset == 0) and (last==True)):
+            gtp_msg = GatewayTransportMessage( GATEWAY_MSG_SDO, GatewayTransportProtocol.GATEWAY_CMD_SDO_DOWNLOAD,
+                                               node = node_id, index = index, subindex = subindex, payload_type=payload_type, payload = payload )
+        else:
+            gtp_msg = GatewayTransportMessage( GATEWAY_MSG_SDO, GatewayTransportProtocol.GATEWAY_CMD_SDO_DOWNLOAD_SEG,
+                                            node = node_id, index = index, subindex = subindex, payload_type=payload_type, payload = payload, offset = offset, last = last )
+        await self.post(gtp_msg, timeout)
+
+    def rxInd( self, msg ):
+        # override in child class, e.g. for heartbeats
+        if (msg.msg_type == GATEWAY_MSG_CAN):
+            self.pdo.process(msg)
+        return
+
+async def _self_test(window, count):
+    from dssp_canopen.gateway_sim import SimulatedGateway
+    objects = {(5, 0x2600 + i, 3): (2900 + i).to_bytes(2, 'little') for i in range(count)}
+    with SimulatedGateway(objects, latency = 0.02) as sim:
+        async with await AsyncCanOpenGateway.open(sim.port, window = window) as gw:
+            start = time.monotonic()
+            results = await asyncio.gather(*(gw.upload(5, 0x2600 + i, 3, GATEWAY_TYPE_UINT16) for i in range(count)))
+            elapsed = time.monotonic() - start
+            if ([val for val, last in results] != [2900 + i for i in range(count)]):
+                print( "Fail async upload" )
+                exit(-1)
+            await gw.download(5, 0x2600, 3, GATEWAY_TYPE_UINT16, b'\x01\x00')
+            if (await gw.upload(5, 0x2600, 3, GATEWAY_TYPE_UINT16) != (1, True)):
+                print( "Fail async download" )
+                exit(-1)
+            try:
+                await gw.upload(5, 0x3000, 0, GATEWAY_TYPE_UINT16)
+                print( "Fail async abort" )
+                exit(-1)
+            except CanOpenSdoAbortError:
+                pass
+            sim.drop = 1
+            if (await gw.upload(5, 0x2601, 3, GATEWAY_TYPE_UINT16, timeout = 0.1) != (2901, True)) or (gw.retransmit_count != 1):
+                print( "Fail async retransmit" )
+                exit(-1)
+            # the download's ACK must not answer the lost upload ahead of it
+            sim.drop = 1
+            results = await asyncio.gather(gw.upload(5, 0x2602, 3, GATEWAY_TYPE_UINT16, timeout = 0.1),
+                                           gw.download(5, 0x2700, 0, GATEWAY_TYPE_UINT16, b'\x02\x00', timeout = 0.1))
+            if (results != [(2902, True), None]) or (gw.retransmit_count != 2):
+                print( "Fail async upload behind a lost request" )
+                exit(-1)
+            gw.pdo.map(0x185, 5, [(0x2612, 5, GATEWAY_TYPE_UINT16), (None, None, GATEWAY_TYPE_UINT16), (0x2613, 5, GATEWAY_TYPE_INT16)])
+            received = asyncio.Event()
+            gw.pdo.subscribe(lambda key, val, t: received.set(), 5, 0x2613, 5)
+            sim.send_can(0x185, struct.pack("<HHh", 2931, 0, -12))
+            await asyncio.wait_for(received.wait(), 1.0)
+            if (gw.pdo.latest(5, 0x2612, 5)[1] != 2931) or (gw.pdo.history(5, 0x2613, 5)[-1][1] != -12):
+                print( "Fail async PDO" )
+                exit(-1)
+    print( f"{count} uploads with window {window} in {elapsed:.3f}s" )
+    # a port that fails under an outstanding request
+    sim = SimulatedGateway(objects, latency = 0.5)
+    gw = await AsyncCanOpenGateway.open(sim.port)
+    if (gw.window != 1):
+        print( "Fail async default window" )
+        exit(-1)
+    pending = asyncio.ensure_future(gw.upload(5, 0x2600, 3, GATEWAY_TYPE_UINT16, timeout = 10.0))
+    await asyncio.sleep(0.1)
+    sim.close()
+    try:
+        await asyncio.wait_for(pending, 1.0)
+        print( "Fail async upload on a failed port" )
+        exit(-1)
+    except CanOpenGatewayTimeoutError:
+        pass
+    except asyncio.TimeoutError:
+        print( "Fail async failed port, the request is still outstanding" )
+        exit(-1)
+    try:
+        await gw.upload(5, 0x2600, 3, GATEWAY_TYPE_UINT16)
+        print( "Fail async upload after the port failed" )
+        exit(-1)
+    except CanOpenGatewayTimeoutError:
+        pass
+
+def main():
+    cmd_line = argparse.ArgumentParser(description="asyncio DSSP gateway test against a simulated gateway")
+    cmd_line.add_argument("-w", "--window", help="Requests in flight", type=int, default=8)
+    cmd_line.add_argument("-n", "--count", help="Number of uploads", type=int, default=20)
+    args = cmd_line.parse_args()
+
+    asyncio.run(_self_test(args.window, args.count))
+    print( "Pass all asyncio gateway tests" )
+
+if __name__ == "__main__":
+    main()
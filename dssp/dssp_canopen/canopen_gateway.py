@@ -21,28 +21,119 @@
 # SDO
 #   upload
 #   download
+# PDO
+#   receive (TPDOs of the nodes, decoded into signals)
 # 
 
 from dssp_canopen.dssp_gateway import DsspGateway
 from dssp_canopen.gateway_transport import *
+from dssp_canopen.od_cache import CANOPEN_PAYLOAD_TYPES, load_eds
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+import collections
+import os
 import threading
 import struct
 import time
 import canopen
 
 
-class CanOpenGatewayTimeoutError(Exception):
+# Precompiled decoders for the fixed size payload types
+PAYLOAD_STRUCTS = {
+    GATEWAY_TYPE_BOOL   : struct.Struct("<?"),
+    GATEWAY_TYPE_INT8   : struct.Struct("<b"),
+    GATEWAY_TYPE_UINT8  : struct.Struct("<B"),
+    GATEWAY_TYPE_INT16  : struct.Struct("<h"),
+    GATEWAY_TYPE_UINT16 : struct.Struct("<H"),
+    GATEWAY_TYPE_INT32  : struct.Struct("<i"),
+    GATEWAY_TYPE_UINT32 : struct.Struct("<I"),
+    GATEWAY_TYPE_INT64  : struct.Struct("<q"),
+    GATEWAY_TYPE_UINT64 : struct.Struct("<Q"),
+    GATEWAY_TYPE_REAL32 : struct.Struct("<f"),
+    GATEWAY_TYPE_REAL64 : struct.Struct("<d"),
+}
+
+# NumPy dtypes used by read_many(record=True)
+PAYLOAD_DTYPES = {
+    GATEWAY_TYPE_BOOL   : "?",
+    GATEWAY_TYPE_INT8   : "i1",
+    GATEWAY_TYPE_UINT8  : "u1",
+    GATEWAY_TYPE_INT16  : "<i2",
+    GATEWAY_TYPE_UINT16 : "<u2",
+    GATEWAY_TYPE_INT32  : "<i4",
+    GATEWAY_TYPE_UINT32 : "<u4",
+    GATEWAY_TYPE_INT64  : "<i8",
+    GATEWAY_TYPE_UINT64 : "<u8",
+    GATEWAY_TYPE_REAL32 : "<f4",
+    GATEWAY_TYPE_REAL64 : "<f8",
+}
+
+# Returns the value of an SDO payload of the given type
+def decode_payload( payload_type, payload ):
+    fmt = PAYLOAD_STRUCTS.get(payload_type)
+    if (fmt != None):
+        return fmt.unpack(payload)[0]
+    if (payload_type == GATEWAY_TYPE_STRING):
+        return bytes(payload).decode('ascii')
+    return bytearray(payload)
+
+# read_many items are (index, subindex) or (index, subindex, payload_type).
+# Without a type the item is looked up in types, {(index, subindex): payload_type}
+def _read_many_item( item, types = None ):
+    if (len(item) == 2):
+        return item[0], item[1], types.get((item[0], item[1]), GATEWAY_TYPE_DOMAIN) if (types != None) else GATEWAY_TYPE_DOMAIN
+    return tuple(item)
+
+# Returns {(index, subindex): value} or, with record=True, a NumPy record
+# with one field per item named like '2612sub5'
+def _read_many_result( items, values, record ):
+    result = dict()
+    types = dict()
+    for (index, subindex, payload_type), val in zip(items, values):
+        result.setdefault((index, subindex), val)
+        types.setdefault((index, subindex), payload_type)
+    if not (record):
+        return result
+    import numpy
+    dtype = [(f"{index:04X}sub{subindex}", PAYLOAD_DTYPES.get(types[(index, subindex)], "O")) for index, subindex in result]
+    return numpy.rec.array([tuple(result.values())], dtype=dtype)[0]
+
+# read_many for any node.sdo: uses the pipelined gateway version when there is
+# one, otherwise (e.g. a python-canopen SdoClient) reads the items one at a time
+def sdo_read_many( sdo, items, record = False ):
+    if (hasattr(sdo, 'read_many')):
+        return sdo.read_many(items, record)
+    items = [_read_many_item(item) for item in items]
+    values = [decode_payload(payload_type, sdo.upload(index, subindex)) for index, subindex, payload_type in items]
+    return _read_many_result(items, values, record)
+
+
+class CanOpenGatewayError(Exception):
+    def __init__(self, error_code):
+        self.error_code = error_code
+    def __str__(self):
+        return  f'CanOpen gateway error {self.error_code}'
+
+class CanOpenGatewayTimeoutError(CanOpenGatewayError):
     def __init__(self):
-        pass
+        CanOpenGatewayError.__init__(self, DsspGateway.ERROR_TIMEOUT)
     def __str__(self):
         return  'No response from CanOpen device'
 
+class CanOpenSdoAbortError(CanOpenGatewayError):
+    def __init__(self, node_id, index, subindex):
+        CanOpenGatewayError.__init__(self, DsspGateway.ERROR_SDO_ABORTED)
+        self.node_id = node_id
+        self.index = index
+        self.subindex = subindex
+    def __str__(self):
+        return  f'SDO transfer of {self.index:04X}sub{self.subindex} was aborted by node {self.node_id}'
+
 class CanOpenSdo:
     def __init__(self, gw, node_id, edsfile ):
         self.gw = gw
         self.id = node_id
         self.edsfile = edsfile
-        self.od = canopen.objectdictionary.import_od(edsfile, node_id)
+        self.od, self.types = load_eds(edsfile, node_id)     # types: (index, subindex) -> payload type
         self.fcb = None
         self.last = False
 
@@ -53,6 +144,15 @@ class CanOpenSdo:
     def download(self,index, subindex, payload):
         self.gw.download(self.id, index, subindex, GATEWAY_TYPE_DOMAIN, payload, 0, True)
 
+    # Returns the value of the object, decoded with its type from the EDS
+    def read( self, index, subindex = 0 ):
+        val, last = self.gw.upload(self.id, index, subindex, payload_type=self.types.get((index, subindex), GATEWAY_TYPE_DOMAIN))
+        return val
+
+    # Items given as (index, subindex) are decoded with their type from the EDS
+    def read_many( self, items, record = False ):
+        return self.gw.read_many(self.id, [_read_many_item(item, self.types) for item in items], record)
+
 class CanOpenNmt:
     def __init__(self, gw, node_id ):
         self.gw = gw
@@ -93,6 +193,140 @@ class CanOpenNmt:
                                            cobid = 0, payload = [cmd, self.id] )
         self.gw.post(gtp_msg, False)
 
+# Receives the TPDOs of the nodes and decodes them into signals keyed on
+# (node, index, subindex).  Every signal keeps its latest value and a ring
+# buffer of the last 'history' (timestamp, value) pairs.  Callbacks run on the
+# gateway receive thread, so they should be short.
+#
+#   gw.pdo.map(0x185, 5, [(0x2612, 5, GATEWAY_TYPE_UINT16), (0x2613, 5, GATEWAY_TYPE_UINT16)])
+#   gw.pdo.subscribe(lambda key, val, t: print(key, val), 5, 0x2612, 5)
+#   t, val = gw.pdo.latest(5, 0x2612, 5)
+#
+class CanOpenPdo:
+    HISTORY          = 1000
+    TPDO_COMM        = 0x1800
+    TPDO_MAPPING     = 0x1A00
+    TPDO_MAX         = 512
+    COB_ID_INVALID   = 0x80000000
+    COB_ID_MASK      = 0x1FFFFFFF
+
+    def __init__(self, history = None):
+        self.history_length = history if (history != None) else self.HISTORY
+        self.rx_count = 0
+        self.unmapped_count = 0
+        self._pdos = dict()             # cob id -> (layout, signal keys)
+        self._latest = dict()           # signal key -> (timestamp, value)
+        self._history = dict()          # signal key -> deque of (timestamp, value)
+        self._callbacks = []            # (signal key or None for all, callback)
+        self._lock = threading.Lock()
+
+    # Maps the PDO with this COB-ID.  signals are (index, subindex, payload_type)
+    # in the order they appear in the PDO, use None for the index of a dummy entry.
+    # Only byte aligned fixed size types are supported.
+    def map( self, cob_id, node_id, signals ):
+        fmt = "<"
+        keys = []
+        for index, subindex, payload_type in signals:
+            layout = PAYLOAD_STRUCTS.get(payload_type)
+            if (layout == None):
+                raise ValueError(f'PDO {cob_id:03X} entry {index}sub{subindex} has no fixed size type')
+            if (index == None):
+                fmt += f"{layout.size}x"
+            else:
+                fmt += layout.format[1:]
+                keys.append((node_id, index, subindex))
+        layout = struct.Struct(fmt)
+        if (layout.size > 8):
+            raise ValueError(f'PDO {cob_id:03X} mapping is {layout.size} bytes long')
+        with self._lock:
+            self._pdos[cob_id] = (layout, keys)
+            for key in keys:
+                if (key not in self._history):
+                    self._history[key] = collections.deque(maxlen=self.history_length)
+
+    def unmap( self, cob_id ):
+        with self._lock:
+            self._pdos.pop(cob_id, None)
+
+    # Maps the valid TPDOs found in the node's object dictionary and returns how
+    # many were mapped.  TPDOs that can not be decoded are reported and skipped.
+    def map_node( self, node ):
+        od = node.sdo.od
+        count = 0
+        for n in range(self.TPDO_MAX):
+            comm = od.get(self.TPDO_COMM + n)
+            mapping = od.get(self.TPDO_MAPPING + n)
+            if (comm is None) or (mapping is None) or (1 not in comm) or (0 not in mapping):
+                continue
+            cob_id = comm[1].default
+            if (cob_id == None) or (cob_id & self.COB_ID_INVALID):
+                continue
+            try:
+                self.map(cob_id & self.COB_ID_MASK, node.id, self._od_signals(od, mapping))
+                count += 1
+            except (KeyError, ValueError) as err:
+                print(f"Node {node.id} TPDO{n+1} not mapped: {err}")
+        return count
+
+    @staticmethod
+    def _od_signals( od, mapping ):
+        signals = []
+        for sub in range(1, (mapping[0].default or 0) + 1):
+            entry = mapping[sub].default
+            index, subindex, bits = entry >> 16, (entry >> 8) & 0xFF, entry & 0xFF
+            if (index < 0x20):
+                # dummy entry, the index is the data type
+                signals.append((None, None, CANOPEN_PAYLOAD_TYPES.get(index)))
+                continue
+            var = od.get_variable(index, subindex)
+            if (var is None):
+                raise KeyError(f'{index:04X}sub{subindex} is not in the object dictionary')
+            payload_type = CANOPEN_PAYLOAD_TYPES.get(var.data_type)
+            if (payload_type != None) and (bits != PAYLOAD_STRUCTS[payload_type].size * 8):
+                raise ValueError(f'{index:04X}sub{subindex} is mapped with {bits} bits')
+            signals.append((index, subindex, payload_type))
+        return signals
+
+    # callback(key, value, timestamp) is called for every new value of the
+    # signal, or of all signals if no index is given
+    def subscribe( self, callback, node_id = None, index = None, subindex = 0 ):
+        key = (node_id, index, subindex) if (index != None) else None
+        with self._lock:
+            self._callbacks = self._callbacks + [(key, callback)]
+
+    def unsubscribe( self, callback ):
+        with self._lock:
+            self._callbacks = [(key, cb) for key, cb in self._callbacks if (cb != callback)]
+
+    # Returns (timestamp, value) of the last value received, or None
+    def latest( self, node_id, index, subindex = 0 ):
+        return self._latest.get((node_id, index, subindex))
+
+    # Returns the buffered (timestamp, value) pairs, oldest first
+    def history( self, node_id, index, subindex = 0 ):
+        return list(self._history.get((node_id, index, subindex), ()))
+
+    # Decodes a received CAN message, returns False if it is not a mapped PDO
+    def process( self, msg, timestamp = None ):
+        pdo = self._pdos.get(msg.cob_id)
+        if (pdo == None):
+            self.unmapped_count += 1
+            return False
+        layout, keys = pdo
+        if (len(msg.payload) < layout.size):
+            return False
+        values = layout.unpack_from(msg.payload)
+        timestamp = timestamp if (timestamp != None) else time.time()
+        self.rx_count += 1
+        for key, val in zip(keys, values):
+            self._latest[key] = (timestamp, val)
+            self._history[key].append((timestamp, val))
+        for selected, callback in self._callbacks:
+            for key, val in zip(keys, values):
+                if (selected == None) or (selected == key):
+                    callback(key, val, timestamp)
+        return True
+
 class CanOpenNode:
     def __init__(self, gw, node_id, edsfile):
         self.sdo = CanOpenSdo(gw, node_id, edsfile)
@@ -103,37 +337,121 @@ class CanOpenNetwork:
     def __init__(self, gw):
         self.gw = gw
 
+# Identity of a node found by CanOpenScanner.scan, None where the node did not answer
+class CanOpenIdentity:
+    __slots__ = ('node', 'device_type', 'vendor_id', 'product_code', 'revision', 'serial_number')
+
+    def __init__(self, node, device_type = None, vendor_id = None, product_code = None, revision = None, serial_number = None):
+        self.node = node
+        self.device_type = device_type
+        self.vendor_id = vendor_id
+        self.product_code = product_code
+        self.revision = revision
+        self.serial_number = serial_number
+
+    def __repr__(self):
+        return ("CanOpenIdentity(" +
+                ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__) + ")")
+
+# Finds the nodes on the bus.  Every node id is sent an upload of the device
+# type (0x1000), with no retries, and the nodes that answered are then asked
+# for their identity object (0x1018).  The probes go through their own pool of
+# the gateway, SCAN_WINDOW at a time whatever the gateway's window.  A phase
+# ends once every probe is answered or has timed out, or after duration, when
+# the probes still queued are cancelled.  An answer that arrives after its
+# probe has timed out still counts.
+#
+# The probes stay in the gateway's window until they time out, so the error
+# ACK of a probe to an absent node is matched to the probe and not to another
+# thread's request.  SCAN_TIMEOUT has to be longer than the gateway takes to
+# give up on an absent node.  Nothing else is changed on the gateway, so other
+# threads keep their timeouts and window.
 class CanOpenScanner:
+    SCAN_TIMEOUT     = 0.1              # per probe, several gateway round trips
+    SCAN_DURATION    = 1.0              # longest wall-clock time of each phase
+    SCAN_POOL        = "scan"
+    SCAN_WINDOW      = 32               # probes in flight
+    DEVICE_TYPE      = (0x1000, 0)
+    IDENTITY         = ((0x1018, 1), (0x1018, 2), (0x1018, 3), (0x1018, 4))
+
     def __init__(self, gw):
         self.gw = gw
+        self.gw.pools.setdefault(self.SCAN_POOL, self.SCAN_WINDOW)
         self.nodes = set()
+        self._values = dict()           # (node, index, subindex) -> value of the identity objects
+        self._cond = threading.Condition()
+
+    # Called by the gateway for every SDO message received
+    def process( self, msg ):
+        with self._cond:
+            self.nodes.add(msg.node)
+            self._record(msg)
 
+    def _record( self, msg ):
+        if (msg.cmd == GatewayTransportProtocol.GATEWAY_CMD_SDO_UPLOAD_RSP) and (len(msg.payload) >= 4):
+            key = (msg.index, msg.subindex)
+            if (key == self.DEVICE_TYPE) or (key in self.IDENTITY):
+                self._values[(msg.node, msg.index, msg.subindex)] = PAYLOAD_STRUCTS[GATEWAY_TYPE_UINT32].unpack_from(msg.payload)[0]
+
+    # Sends the probes and waits until they are all answered or timed out, or
+    # for duration at most
+    def _burst( self, objects, duration ):
+        deadline = time.monotonic() + duration
+        settled = [0]
+        def answered(req, error_code, rsp):
+            with self._cond:
+                if (rsp != None):
+                    self._record(rsp)       # before rxInd, so the value is there when the phase ends
+                settled[0] += 1
+                self._cond.notify_all()
+        seqs = []
+        for node, index, subindex in objects:
+            gtp_msg = GatewayTransportMessage( msg_type = GATEWAY_MSG_SDO,
+                                               cmd = GatewayTransportProtocol.GATEWAY_CMD_SDO_UPLOAD,
+                                               node = node, index = index, subindex = subindex,
+                                               payload_type = GATEWAY_TYPE_UINT32 )
+            seqs.append(DsspGateway.post(self.gw, gtp_msg, answered, self.SCAN_TIMEOUT, 0, self.SCAN_POOL))
+        with self._cond:
+            self._cond.wait_for(lambda: settled[0] >= len(seqs), max(0.0, deadline - time.monotonic()))
+        self.gw.cancel(seqs)
+
+    # Returns a CanOpenIdentity for every node that answered, in node order.
+    # Takes at most about 2 * duration.
+    def scan( self, limit: int = 127, duration = None ):
+        duration = duration if (duration != None) else self.SCAN_DURATION
+        index, subindex = self.DEVICE_TYPE
+        with self._cond:
+            self._values.clear()
+        self._burst([(nid, index, subindex) for nid in range(1, limit+1)], duration)
+        with self._cond:
+            found = sorted(node for node, i, s in self._values if ((i, s) == self.DEVICE_TYPE) and (node <= limit))
+        objects = [(node, i, s) for node in found for i, s in self.IDENTITY]
+        self._burst(objects, duration)
+        with self._cond:
+            return [CanOpenIdentity(node, *(self._values.get((node,) + key) for key in (self.DEVICE_TYPE,) + self.IDENTITY))
+                    for node in found]
+
+    # Adds the nodes that answer to self.nodes
     def search( self, limit: int = 127 ):
-        stdtimeout = DsspGateway.RSP_TIMEOUT
-        DsspGateway.RSP_TIMEOUT = 0.001
-        for nid in range(1, limit+1):
-            gtp_msg = GatewayTransportMessage( msg_type = GATEWAY_MSG_SDO, 
-                                               cmd = GatewayTransportProtocol.GATEWAY_CMD_SDO_UPLOAD, 
-                                               node=nid, 
-                                               index = 0x1000, subindex = 0, 
-                                               payload_type=GATEWAY_TYPE_UINT8 )
-            self.gw.post(gtp_msg)
-        DsspGateway.RSP_TIMEOUT = stdtimeout
+        return self.scan(limit)
 
     def reset( self ):
-        self.nodes.clear()
+        with self._cond:
+            self.nodes.clear()
+            self._values.clear()
 
 class CanOpenGateway(DsspGateway):
 
-    def __init__(self, port, baudrate = 115200 ):
-        DsspGateway.__init__(self, port, baudrate)
+    def __init__(self, port, baudrate = 115200, window = None ):
+        DsspGateway.__init__(self, port, baudrate, window)
         self.last_rx_msg = None
-        self.tx_event = threading.Event()
-        self.rsp_event = threading.Event()
         self.err_code = 0
         self.timeout = 10.0
         self.nodes = list()
         self.scanner = CanOpenScanner(self)
+        self.pdo = CanOpenPdo()
+        self._uploads = dict()          # (node, index, subindex, offset) -> future of the upload in flight
+        self._uploads_lock = threading.Lock()
 
     def __del__(self):
         DsspGateway.__del__(self)
@@ -141,85 +459,278 @@ class CanOpenGateway(DsspGateway):
     def add_node( self, node_id, edsfile=''):
         node = CanOpenNode( self, node_id, edsfile )
         self.nodes.append(node)
+        self.pdo.map_node(node)
         return node
 
     def rxInd( self, msg):
         self.last_rx_msg = msg
         if (msg.msg_type == GATEWAY_MSG_SDO ):
-            self.scanner.nodes.add(msg.node)
-            if (msg.cmd == GatewayTransportProtocol.GATEWAY_CMD_SDO_UPLOAD_RSP) or (msg.cmd == GatewayTransportProtocol.GATEWAY_CMD_SDO_UPLOAD_RSP_SEG):
-                self.err_code = DsspGateway.ERROR_NONE
-                self.tx_event.set()
-                self.rsp_event.set()
+            self.scanner.process(msg)
+        elif (msg.msg_type == GATEWAY_MSG_CAN ):
+            self.pdo.process(msg)
         return
 
     def txCnf( self, error_code ):
         self.err_code = error_code
-        self.tx_event.set()
         return
 
+    # Posts msg and returns a future for the response message.  The future
+    # raises CanOpenGatewayTimeoutError if the gateway never answers and
+    # CanOpenGatewayError (or CanOpenSdoAbortError) if it answers with an error.
+    # decode(rsp) turns the response message into the future's result and
+    # timeout overrides RSP_TIMEOUT for each attempt, e.g. for a slow erase.
+    # future.request is the DsspGatewayRequest, see its 'suspect' flag.
+    def _request(self, msg, decode = None, timeout = None):
+        future = Future()
+        def done(req, error_code, rsp):
+            if (error_code == DsspGateway.ERROR_NONE):
+                try:
+                    future.set_result(decode(rsp) if (decode != None) else rsp)
+                except Exception as err:
+                    future.set_exception(err)
+            elif (error_code == DsspGateway.ERROR_TIMEOUT):
+                future.set_exception(CanOpenGatewayTimeoutError())
+            elif (error_code == DsspGateway.ERROR_SDO_ABORTED):
+                future.set_exception(CanOpenSdoAbortError(msg.node, msg.index, msg.subindex))
+            else:
+                future.set_exception(CanOpenGatewayError(error_code))
+        future.request = DsspGateway.post_request(self, msg, done, timeout)
+        return future
+
+    # Waits self.timeout for the result, or long enough for every attempt of
+    # a request with a longer per-attempt timeout
+    def _result(self, future, timeout = None):
+        wait = self.timeout
+        if (timeout != None):
+            wait = max(wait, timeout * (self.RETRIES + 1) + 1.0)
+        try:
+            return future.result(timeout=wait)
+        except FutureTimeoutError:
+            raise CanOpenGatewayTimeoutError
+
     def post(self, msg, blocking = True):
-        self.tx_event.clear()
-        super().post(msg)
+        future = self._request(msg)
         if (blocking == True):
-            if not (self.tx_event.wait(timeout=self.timeout)):
-                raise CanOpenGatewayTimeoutError
-            #if (self.err_code == DsspGateway.ERROR_TIMEOUT):
-            #   raise CanOpenGatewayTimeoutError
-
-    def upload( self, node_id, index, subindex, payload_type=GATEWAY_TYPE_DOMAIN, offset = 0 ):
-        gtp_msg = GatewayTransportMessage( GATEWAY_MSG_SDO, GatewayTransportProtocol.GATEWAY_CMD_SDO_UPLOAD, 
-                                        node = node_id, index = index, subindex = subindex, payload_type=payload_type, offset=offset )
-        last = True
-        val = None
-        self.rsp_event.clear()
-        self.post(gtp_msg)
-        self.rsp_event.wait()                   # can only proceed if we've had a response
-
-        if (self.last_rx_msg != None):
-            if (self.last_rx_msg.msg_type == GATEWAY_MSG_SDO):
-                if (self.last_rx_msg.cmd == GatewayTransportProtocol.GATEWAY_CMD_SDO_UPLOAD_RSP):
-                    if (payload_type == GATEWAY_TYPE_BOOL):
-                        val = struct.unpack("<?", bytearray(self.last_rx_msg.payload))[0]
-                    elif (payload_type == GATEWAY_TYPE_INT8):
-                        val = struct.unpack("<b", bytearray(self.last_rx_msg.payload))[0]
-                    elif (payload_type == GATEWAY_TYPE_UINT8):
-                        val = struct.unpack("<B", bytearray(self.last_rx_msg.payload))[0]
-                    elif (payload_type == GATEWAY_TYPE_INT16):
-                        val = struct.unpack("<h", bytearray(self.last_rx_msg.payload))[0]
-                    elif (payload_type == GATEWAY_TYPE_UINT16):
-                        val = struct.unpack("<H", bytearray(self.last_rx_msg.payload))[0]
-                    elif (payload_type == GATEWAY_TYPE_INT32):
-                        val = struct.unpack("<i", bytearray(self.last_rx_msg.payload))[0]
-                    elif (payload_type == GATEWAY_TYPE_UINT32):
-                        val = struct.unpack("<I", bytearray(self.last_rx_msg.payload))[0]
-                    elif (payload_type == GATEWAY_TYPE_INT64):
-                        val = struct.unpack("<q", bytearray(self.last_rx_msg.payload))[0]
-                    elif (payload_type == GATEWAY_TYPE_UINT64):
-                        val = struct.unpack("<Q", bytearray(self.last_rx_msg.payload))[0]
-                    elif (payload_type == GATEWAY_TYPE_REAL32):
-                        val = struct.unpack("<f", bytearray(self.last_rx_msg.payload))[0]
-                    elif (payload_type == GATEWAY_TYPE_REAL64):
-                        val = struct.unpack("<d", bytearray(self.last_rx_msg.payload))[0]
-                    elif (payload_type == GATEWAY_TYPE_STRING):
-                        val = bytearray(self.last_rx_msg.payload).decode('ascii')
-                    else:                            
-                        val = bytearray(self.last_rx_msg.payload)
-                        last = self.last_rx_msg.last
-        return val, last
-
-    def download( self, node_id, index, subindex, payload_type, payload, offset = 0, last = True ):
+            try:
+                self._result(future)
+            except CanOpenGatewayTimeoutError:
+                raise
+            except CanOpenGatewayError as err:
+                return err.error_code
+        return DsspGateway.ERROR_NONE
+
+    @staticmethod
+    def decode( payload_type, msg ):
+        if (msg == None) or (msg.msg_type != GATEWAY_MSG_SDO) or (msg.cmd != GatewayTransportProtocol.GATEWAY_CMD_SDO_UPLOAD_RSP):
+            return None, True
+        val = decode_payload(payload_type, msg.payload)
+        if (type(val) is bytearray):
+            return val, msg.last
+        return val, True
+
+    # As decode, with the offset the response carries appended
+    @staticmethod
+    def decode_segment( payload_type, msg ):
+        return CanOpenGateway.decode(payload_type, msg) + (msg.offset if (msg != None) else 0,)
+
+    # Returns a future for (value, last), or with with_offset (value, last,
+    # offset) where offset is the one in the response.  Concurrent uploads of
+    # the same object and offset share one request and one future.
+    def upload_async( self, node_id, index, subindex, payload_type=GATEWAY_TYPE_DOMAIN, offset = 0, timeout = None, with_offset = False ):
+        key = (node_id, index, subindex, offset, with_offset)
+        with self._uploads_lock:
+            future = self._uploads.get(key)
+            if (future != None) and (future.payload_type == payload_type):
+                return future
+            gtp_msg = GatewayTransportMessage( GATEWAY_MSG_SDO, GatewayTransportProtocol.GATEWAY_CMD_SDO_UPLOAD, 
+                                            node = node_id, index = index, subindex = subindex, payload_type=payload_type, offset=offset )
+            decode = self.decode_segment if (with_offset) else self.decode
+            future = self._request(gtp_msg, lambda rsp: decode(payload_type, rsp), timeout)
+            future.payload_type = payload_type
+            self._uploads[key] = future
+        future.add_done_callback(lambda f: self._upload_done(key, f))
+        return future
+
+    def _upload_done( self, key, future ):
+        with self._uploads_lock:
+            if (self._uploads.get(key) is future):
+                del self._uploads[key]
+
+    def upload( self, node_id, index, subindex, payload_type=GATEWAY_TYPE_DOMAIN, offset = 0, timeout = None ):
+        return self._result(self.upload_async(node_id, index, subindex, payload_type, offset, timeout), timeout)
+
+    # Reads several objects from one node with all requests issued up front, so
+    # with a window > 1 the whole set costs about one round trip.  See
+    # _read_many_result for the return value.
+    def read_many( self, node_id, items, record = False ):
+        items = [_read_many_item(item) for item in items]
+        futures = [self.upload_async(node_id, index, subindex, payload_type) for index, subindex, payload_type in items]
+        values = [self._result(future)[0] for future in futures]
+        return _read_many_result(items, values, record)
+
+    # Returns a future that completes when the gateway acknowledges the download
+    def download_async( self, node_id, index, subindex, payload_type, payload, offset = 0, last = True, timeout = None ):
         if ((offset == 0) and (last==True)):
             gtp_msg = GatewayTransportMessage( GATEWAY_MSG_SDO, GatewayTransportProtocol.GATEWAY_CMD_SDO_DOWNLOAD, 
                                                node = node_id, index = index, subindex = subindex, payload_type=payload_type, payload = payload )
         else:
             gtp_msg = GatewayTransportMessage( GATEWAY_MSG_SDO, GatewayTransportProtocol.GATEWAY_CMD_SDO_DOWNLOAD_SEG, 
                                             node = node_id, index = index, subindex = subindex, payload_type=payload_type, payload = payload, offset = offset, last = last )
-        self.post(gtp_msg)
+        return self._request(gtp_msg, None, timeout)
+
+    def download( self, node_id, index, subindex, payload_type, payload, offset = 0, last = True, timeout = None ):
+        self._result(self.download_async(node_id, index, subindex, payload_type, payload, offset, last, timeout), timeout)
         return
 
+# Object dictionary of a node with one TPDO carrying two temperatures and a pad byte
+def _test_od( node_id ):
+    od = canopen.objectdictionary.ObjectDictionary()
+    def var( name, index, subindex, data_type, default ):
+        v = canopen.objectdictionary.ODVariable(name, index, subindex)
+        v.data_type = data_type
+        v.default = default
+        return v
+    U8, U16, U32 = canopen.objectdictionary.UNSIGNED8, canopen.objectdictionary.UNSIGNED16, canopen.objectdictionary.UNSIGNED32
+    comm = canopen.objectdictionary.ODRecord("TPDO1 communication parameter", 0x1800)
+    comm.add_member(var("COB-ID", 0x1800, 1, U32, 0x180 + node_id))
+    mapping = canopen.objectdictionary.ODRecord("TPDO1 mapping parameter", 0x1A00)
+    for sub, entry in enumerate([3, 0x26120510, 0x00050008, 0x26130510]):
+        mapping.add_member(var(f"Entry {sub}", 0x1A00, sub, U32 if sub else U8, entry))
+    for index in (0x2612, 0x2613):
+        heater = canopen.objectdictionary.ODRecord(f"Heater {index:04X}", index)
+        heater.add_member(var("Temperature [0.1K]", index, 5, U16, 0))
+        od.add_object(heater)
+    od.add_object(comm)
+    od.add_object(mapping)
+    return od
+
+def _test_pdo():
+    class Node:
+        id = 5
+    node = Node()
+    node.sdo = Node()
+    node.sdo.od = _test_od(node.id)
+    pdo = CanOpenPdo(history = 2)
+    if (pdo.map_node(node) != 1):
+        print( "Fail PDO mapping from object dictionary" )
+        exit(-1)
+    received = []
+    pdo.subscribe(lambda key, val, t: received.append((key, val)), 5, 0x2613, 5)
+    for n in range(3):
+        msg = GatewayTransportMessage(GATEWAY_MSG_CAN, payload = struct.pack("<HBH", 2900 + n, 0xFF, 3000 + n), cobid = 0x185)
+        pdo.process(msg, timestamp = n)
+    if (pdo.latest(5, 0x2612, 5) != (2, 2902)) or (pdo.history(5, 0x2613, 5) != [(1, 3001), (2, 3002)]):
+        print( "Fail PDO decode" )
+        exit(-1)
+    if (received != [((5, 0x2613, 5), 3000 + n) for n in range(3)]):
+        print( "Fail PDO callback" )
+        exit(-1)
+    if (pdo.process(GatewayTransportMessage(GATEWAY_MSG_CAN, payload = b'\x00', cobid = 0x186)) or (pdo.unmapped_count != 1)):
+        print( "Fail unmapped PDO" )
+        exit(-1)
+
+def _test_gateway():
+    from dssp_canopen.gateway_sim import SimulatedGateway
+    with SimulatedGateway({(5, 0x2612, 5): b'\x75\x0b'}, latency = 0.005) as sim:
+        gw = CanOpenGateway(sim.port)
+        if (gw.upload(5, 0x2612, 5, GATEWAY_TYPE_UINT16) != (2933, True)):
+            print( "Fail gateway upload" )
+            exit(-1)
+        node = gw.add_node(5, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SatDriveController-v1.3.4.eds"))
+        if (node.sdo.read(0x2612, 5) != 2933) or (node.sdo.read_many([(0x2612, 5)]) != {(0x2612, 5): 2933}):
+            print( "Fail typed SDO read" )
+            exit(-1)
+        received = threading.Event()
+        gw.pdo.map(0x185, 5, [(0x2612, 5, GATEWAY_TYPE_UINT16)])
+        gw.pdo.subscribe(lambda key, val, t: received.set())
+        sim.send_can(0x185, b'\x76\x0b')
+        if not (received.wait(1.0)) or (gw.pdo.latest(5, 0x2612, 5)[1] != 2934):
+            print( "Fail gateway PDO" )
+            exit(-1)
+
+# A request lost ahead of others in the window must not take their responses
+def _test_window():
+    from dssp_canopen.gateway_sim import SimulatedGateway
+    with SimulatedGateway({(5, 0x2612, 5): b'\x75\x0b'}, latency = 0.005) as sim:
+        gw = CanOpenGateway(sim.port, window = 2)
+        sim.drop = 1
+        upload = gw.upload_async(5, 0x2612, 5, GATEWAY_TYPE_UINT16, timeout = 0.1)
+        download = gw.download_async(5, 0x2613, 5, GATEWAY_TYPE_UINT16, b'\x01\x00', timeout = 0.1)
+        if (gw._result(upload) != (2933, True)) or (gw._result(download) != None) or (gw.retransmit_count != 1):
+            print( "Fail upload behind a lost request" )
+            exit(-1)
+        sim.drop = 1
+        requests = [gw.post_request(GatewayTransportMessage(GATEWAY_MSG_SDO, GatewayTransportProtocol.GATEWAY_CMD_SDO_DOWNLOAD,
+                                                            node = 5, index = 0x2614, subindex = n, payload = b'\x01'), timeout = 0.1)
+                    for n in range(2)]
+        while (gw.outstanding()):
+            time.sleep(0.01)
+        if not (requests[0].suspect) or (gw.retransmit_count != 2):
+            print( "Fail ACK of a lost download" )
+            exit(-1)
+
+def _test_scanner():
+    from dssp_canopen.gateway_sim import SimulatedGateway
+    objects = dict()
+    for node in (5, 9):
+        objects[(node, 0x1000, 0)] = (0x20192 + node).to_bytes(4, 'little')
+        for sub in range(1, 5):
+            objects[(node, 0x1018, sub)] = (node * 16 + sub).to_bytes(4, 'little')
+    with SimulatedGateway(objects, latency = 0.02) as sim:
+        sim.online = {5, 9}
+        gw = CanOpenGateway(sim.port)
+        start = time.monotonic()
+        found = gw.scanner.scan()
+        elapsed = time.monotonic() - start
+        if ([(i.node, i.device_type, i.vendor_id, i.serial_number) for i in found] != [(5, 0x20197, 81, 84), (9, 0x2019B, 145, 148)]):
+            print( "Fail scanner", found )
+            exit(-1)
+        if (gw.scanner.nodes != {5, 9}) or (DsspGateway.RSP_TIMEOUT != 3.0):
+            print( "Fail scanner nodes" )
+            exit(-1)
+        # a phase cut short sends nothing more, and its probes time out
+        gw.scanner.scan(duration = 0.005)
+        requests = len(sim.requests)
+        time.sleep(2 * CanOpenScanner.SCAN_TIMEOUT)
+        if (gw.outstanding() != 0) or (len(sim.requests) != requests):
+            print( "Fail scanner cancel" )
+            exit(-1)
+        # absent nodes answered with error ACKs, while another thread uses node 5
+        sim.offline_delay = 0.03
+        errors = []
+        scanning = threading.Event()
+        def traffic():
+            n = 0
+            while not (scanning.is_set()) or (n < 10):
+                try:
+                    gw.download(5, 0x2000, 0, GATEWAY_TYPE_UINT16, n.to_bytes(2, 'little'))
+                    if (gw.upload(5, 0x2000, 0, GATEWAY_TYPE_UINT16) != (n, True)) or (gw.upload(5, 0x1018, 4, GATEWAY_TYPE_UINT32) != (84, True)):
+                        errors.append(n)
+                except CanOpenGatewayError as err:
+                    errors.append(err)
+                n += 1
+        thread = threading.Thread(target=traffic)
+        thread.start()
+        start = time.monotonic()
+        found = gw.scanner.scan()
+        offline = time.monotonic() - start
+        scanning.set()
+        thread.join()
+        if ([i.node for i in found] != [5, 9]) or (errors):
+            print( "Fail scanner with error ACKs and other traffic", found, errors[:3] )
+            exit(-1)
+        if (offline > CanOpenScanner.SCAN_DURATION):
+            print( "Fail scanner phases end once every probe is answered" )
+            exit(-1)
+    print( f"Scanned 127 nodes in {elapsed:.3f}s, {offline:.3f}s with error ACKs and other traffic" )
+
 def main():
     print( "Sdo gateway unit test" )
+    _test_scanner()
+    _test_pdo()
+    _test_gateway()
+    _test_window()
+    print( "Pass all CanOpen gateway tests" )
 
 
 if __name__ == "__main__":
@@ -15,72 +15,135 @@
 # @brief DSSP Data Link Layer
 # 
 
+import argparse
+import binascii
+import os
+import timeit
+
+
+CRC16_CCITT_POLY    = 0x1021
+CRC16_INITIAL_VALUE = 0xFFFF
+
+# Build the 256 entry lookup table for a non-reflected 16 bit CRC
+def crc16_make_table( poly ):
+    table = []
+    for n in range(256):
+        crc = n << 8
+        for bit in range(8):
+            if (crc & 0x8000):
+                crc = (crc << 1) ^ poly
+            else:
+                crc = crc << 1
+        table.append(crc & 0xFFFF)
+    return tuple(table)
+
+CRC16_CCITT_TABLE = crc16_make_table(CRC16_CCITT_POLY)
+
+# Table driven CRC16, works for any polynomial given its table
+def crc16_table( crc_in, b, table = CRC16_CCITT_TABLE ):
+    crc = crc_in & 0xFFFF
+    for x in b:
+        crc = ((crc << 8) & 0xFF00) ^ table[(crc >> 8) ^ x]
+    return crc
+
+# CRC16-CCITT using binascii.crc_hqx, which implements the same
+# polynomial in C.  Accepts bytes, bytearray or memoryview without copying.
+def crc16_ccitt( crc_in, b ):
+    try:
+        return binascii.crc_hqx(b, crc_in & 0xFFFF)
+    except TypeError:
+        return binascii.crc_hqx(bytes(b), crc_in & 0xFFFF)   # lists and tuples
+
+# Running CRC16 that can be fed a frame in pieces, e.g. memoryview slices
+class Crc16:
+    def __init__(self, initial = CRC16_INITIAL_VALUE, poly = CRC16_CCITT_POLY):
+        self.initial = initial & 0xFFFF
+        self.poly = poly
+        if (poly == CRC16_CCITT_POLY):
+            self._update = crc16_ccitt
+        else:
+            table = crc16_make_table(poly)
+            self._update = lambda crc, b: crc16_table(crc, b, table)
+        self.value = self.initial
+
+    def update( self, b ):
+        self.value = self._update(self.value, b)
+        return self.value
+
+    def reset( self ):
+        self.value = self.initial
+
 
 class DsspDataLinkLayer:
     def __init__(self):
-        self.rx_frame = []
-        self.rx_in_frame = False
-        self.CRC16_INITIAL_VALUE = 0xFFFF
+        self.rx_frame = bytearray()
+        self.CRC16_INITIAL_VALUE = CRC16_INITIAL_VALUE
 
         return
 
     # CRC16-CCITT
     def crc16( self, crc_in, b):
-        crc = crc_in & 0xFFFF
-        for x in b:
-            x = (crc >> 8) ^ x
-            x ^= x>>4
-            crc = ((crc << 8) ^ (x << 12) ^ (x <<5) ^ (x)) & 0xFFFF
-        return crc
+        return crc16_ccitt(crc_in, b)
 
 
-    def cobs_encode( self, payload):  
+    # Worst case encoded size: leading and trailing zero, plus one code
+    # byte for every 254 bytes of payload
+    @staticmethod
+    def cobs_max_length( payload_length ):
+        return payload_length + payload_length//254 + 3
+
+    # Returns the COBS encoded payload with a leading zero (to clear any
+    # potential junk) and a trailing zero frame delimiter
+    def cobs_encode( self, payload):
+        if not isinstance(payload, (bytes, bytearray)):
+            payload = bytes(payload)
         rd_len = len(payload)
-        encoded_message = []
-        encoded_message.append(0)       # send a sarting zero to clear any potential junk
-        encoded_message.append(0)       # will get replaced by run length
+        encoded_message = bytearray(self.cobs_max_length(rd_len))    # starts with a zero
+        src = memoryview(payload)
         rd_pos = 0
         wr_pos = 1
-        run_length = 0
-        # count run length (number of bytes) before we encounter a zero
-        while (rd_pos<rd_len):
-            if (payload[rd_pos] == 0):
-                # replace run length byte
-                encoded_message[wr_pos] = run_length+1
-                wr_pos = wr_pos + run_length+1
-                run_length = 0
-                encoded_message.append(0)
-                rd_pos += 1
-            elif (run_length == 255):
-                encoded_message[wr_pos] = 0xFF
-                wr_pos += run_length+1
-                encoded_message.append(0)
-                run_length = 0
+        while True:
+            # find the next zero within the longest run a code byte can describe
+            run_end = min(rd_pos + 254, rd_len)
+            zero_pos = payload.find(0, rd_pos, run_end)
+            if (zero_pos >= 0):
+                run_end = zero_pos
+            run_length = run_end - rd_pos
+            encoded_message[wr_pos] = run_length + 1
+            encoded_message[wr_pos+1:wr_pos+1+run_length] = src[rd_pos:run_end]
+            wr_pos += run_length + 1
+            if (zero_pos >= 0):
+                rd_pos = run_end + 1            # skip the zero, it is implied by the code
+            elif (run_length == 254):
+                rd_pos = run_end                # full run, no zero implied
             else:
-                encoded_message.append(payload[rd_pos])
-                run_length += 1
-                rd_pos+=1
-        encoded_message[wr_pos] = run_length+1
-        encoded_message.append(0)
-        return encoded_message
+                break
+        del encoded_message[wr_pos+1:]          # trailing zero is already in place
+        return bytes(encoded_message)
 
+    # Returns the decoded frame, frame_in must not include the zero delimiters
     def cobs_decode(self, frame_in):
         if (frame_in == None):
             return None
-        frame_out = []
-        rll_pos = frame_in[0]
-        rll_len = frame_in[0]
-        rd_pos = 1
-        while (rd_pos < len(frame_in)):
-            if (rll_pos == rd_pos):
-                if (rll_len != 0xFF):
-                    frame_out.append(0)
-                rll_len = frame_in[rd_pos]
-                rll_pos = rd_pos + rll_len
-            else:
-                frame_out.append(frame_in[rd_pos])
-            rd_pos += 1
-        return frame_out
+        if not isinstance(frame_in, (bytes, bytearray, memoryview)):
+            frame_in = bytes(frame_in)
+        rd_len = len(frame_in)
+        frame_out = bytearray(rd_len)
+        rd_pos = 0
+        wr_pos = 0
+        with memoryview(frame_in) as src:
+            while (rd_pos < rd_len):
+                rll_len = src[rd_pos]
+                rll_end = rd_pos + rll_len
+                if (rll_len == 0) or (rll_end > rd_len):
+                    return None                 # corrupt frame
+                frame_out[wr_pos:wr_pos+rll_len-1] = src[rd_pos+1:rll_end]
+                wr_pos += rll_len - 1
+                rd_pos = rll_end
+                if (rll_len != 0xFF) and (rd_pos < rd_len):
+                    wr_pos += 1                 # frame_out is zero filled
+        del frame_out[wr_pos:]
+        return bytes(frame_out)
 
     def encode( self, message):
         frame = bytearray(message)
@@ -89,80 +152,221 @@ class DsspDataLinkLayer:
         frame.append( (crc>>8) & 0xFF )
         return self.cobs_encode(frame)
 
+    # Returns the payload of a COBS encoded frame (delimiters removed),
+    # or None if it fails the CRC check
+    def check_frame(self, rx_frame):
+        frame = self.cobs_decode(rx_frame)
+        if (frame == None) or (len(frame) < 2):
+            return None
+        crc = self.crc16(self.CRC16_INITIAL_VALUE, frame[:-2])
+        if ((frame[-2] + 256*frame[-1]) != crc):
+            return None                         # discard if CRC fails
+        return frame
+
+    # Generator yielding every valid frame completed by input_data.
+    # Frames are delimited by zeros, the leading zero is optional.  Any partial
+    # frame at the end of the chunk is kept in rx_frame until the next call,
+    # so the generator must be run to completion.
+    def frames(self, input_data):
+        if not isinstance(input_data, (bytes, bytearray)):
+            input_data = bytes(input_data)
+        data = memoryview(input_data)
+        start = 0
+        while True:
+            end = input_data.find(0, start)
+            if (end < 0):
+                self.rx_frame += data[start:]   # partial frame, wait for more
+                return
+            if (len(self.rx_frame) > 0):
+                self.rx_frame += data[start:end]
+                frame = self.check_frame(self.rx_frame)
+                self.rx_frame.clear()
+            elif (end > start):
+                frame = self.check_frame(data[start:end])
+            else:
+                frame = None                    # back to back zeros, nothing to flush
+            if (frame != None):
+                yield frame
+            start = end + 1
+
+    # Returns the last valid frame completed by input_data.  Kept for
+    # compatibility, use frames() so that bursts of frames are not dropped
     def process(self, input_data):
         rx_valid_frame = None
-        for x in input_data:
-            if (self.rx_in_frame == True):
-                if (x == 0):                    # if we're in a frame, receiving a 0 means its the end
-                    self.rx_in_frame = False
-                    rx_valid_frame = self.cobs_decode(self.rx_frame)
-                    if (rx_valid_frame != None):
-                        if (len(rx_valid_frame) >=2 ):
-                            crc = self.crc16(self.CRC16_INITIAL_VALUE, rx_valid_frame[:-2])
-                            if ((rx_valid_frame[len(rx_valid_frame)-2] + 256*rx_valid_frame[len(rx_valid_frame)-1] ) != crc):
-                                rx_valid_frame = None # discard if CRC fails
-                    self.rx_frame.clear()
-                else:
-                    self.rx_frame.append(x)
-            else:                               # if we're not in a frame
-                if (x == 0):                    # a zero means flush what's there
-                    self.rx_frame.clear()
-                else:                           # anything else could be start of a frame as the leading zero is optional
-                    self.rx_in_frame = True
-                    self.rx_frame.append(x)
-
+        for rx_valid_frame in self.frames(input_data):
+            pass
         return rx_valid_frame
 
+# Original bit twiddling CRC16-CCITT, kept as the reference for the faster versions
+def crc16_reference( crc_in, b ):
+    crc = crc_in & 0xFFFF
+    for x in b:
+        x = (crc >> 8) ^ x
+        x ^= x>>4
+        crc = ((crc << 8) ^ (x << 12) ^ (x <<5) ^ (x)) & 0xFFFF
+    return crc
+
+# Original list based COBS codec, kept as the reference for the faster versions.
+# Note it only agrees with cobs_encode for runs of up to 254 non-zero bytes.
+def cobs_encode_reference( payload ):
+    rd_len = len(payload)
+    encoded_message = []
+    encoded_message.append(0)       # send a sarting zero to clear any potential junk
+    encoded_message.append(0)       # will get replaced by run length
+    rd_pos = 0
+    wr_pos = 1
+    run_length = 0
+    # count run length (number of bytes) before we encounter a zero
+    while (rd_pos<rd_len):
+        if (payload[rd_pos] == 0):
+            # replace run length byte
+            encoded_message[wr_pos] = run_length+1
+            wr_pos = wr_pos + run_length+1
+            run_length = 0
+            encoded_message.append(0)
+            rd_pos += 1
+        elif (run_length == 255):
+            encoded_message[wr_pos] = 0xFF
+            wr_pos += run_length+1
+            encoded_message.append(0)
+            run_length = 0
+        else:
+            encoded_message.append(payload[rd_pos])
+            run_length += 1
+            rd_pos+=1
+    encoded_message[wr_pos] = run_length+1
+    encoded_message.append(0)
+    return encoded_message
+
+def cobs_decode_reference( frame_in ):
+    if (frame_in == None):
+        return None
+    frame_out = []
+    rll_pos = frame_in[0]
+    rll_len = frame_in[0]
+    rd_pos = 1
+    while (rd_pos < len(frame_in)):
+        if (rll_pos == rd_pos):
+            if (rll_len != 0xFF):
+                frame_out.append(0)
+            rll_len = frame_in[rd_pos]
+            rll_pos = rd_pos + rll_len
+        else:
+            frame_out.append(frame_in[rd_pos])
+        rd_pos += 1
+    return frame_out
+
+def bench( count = 2000, size = 64 ):
+    frames = [os.urandom(size) for n in range(count)]
+
+    # every implementation must agree with the reference before we time it
+    for frame in frames:
+        crc = crc16_reference(CRC16_INITIAL_VALUE, frame)
+        if (crc16_table(CRC16_INITIAL_VALUE, frame) != crc) or (crc16_ccitt(CRC16_INITIAL_VALUE, frame) != crc):
+            print("Fail CRC parity")
+            exit(-1)
+
+    print( f"CRC16 over {count} frames of {size} bytes")
+    for name, fn in (("reference", crc16_reference), ("table", crc16_table), ("crc_hqx", crc16_ccitt)):
+        t = min(timeit.repeat(lambda: [fn(CRC16_INITIAL_VALUE, f) for f in frames], number=1, repeat=5))
+        print( '%-12s' % name, f": {count/t:12.0f} frames/s" )
+
+    dssp = DsspDataLinkLayer()
+    for frame in frames:
+        encoded = dssp.cobs_encode(frame)
+        if (list(encoded) != cobs_encode_reference(frame)) or (dssp.cobs_decode(encoded[1:-1]) != frame):
+            print("Fail COBS parity")
+            exit(-1)
+
+    print( f"COBS over {count} frames of {size} bytes")
+    encoded = [dssp.cobs_encode(f) for f in frames]
+    for name, fn, args in (("ref encode", cobs_encode_reference, frames), ("encode", dssp.cobs_encode, frames),
+                           ("ref decode", cobs_decode_reference, [e[1:-1] for e in encoded]), ("decode", dssp.cobs_decode, [e[1:-1] for e in encoded])):
+        t = min(timeit.repeat(lambda: [fn(f) for f in args], number=1, repeat=5))
+        print( '%-12s' % name, f": {count/t:12.0f} frames/s" )
+
 def main():
+    cmd_line = argparse.ArgumentParser(description="DSSP Data Link Layer tests")
+    cmd_line.add_argument("-b", "--bench", help="Run benchmarks instead of tests", action="store_true")
+    args = cmd_line.parse_args()
+
+    if (args.bench):
+        bench()
+        return
+
     dssp = DsspDataLinkLayer()
     test_str = '123456789'
-    crc = dssp.crc16( dssp.CRC16_INITIAL_VALUE, bytearray(test_str, "ascii"))
-    # print( f"crc = {hex(crc)}")
-    if (crc != 0x29B1):
+    for crc_fn in (dssp.crc16, crc16_reference, crc16_table, crc16_ccitt):
+        crc = crc_fn( dssp.CRC16_INITIAL_VALUE, bytearray(test_str, "ascii"))
+        # print( f"crc = {hex(crc)}")
+        if (crc != 0x29B1):
+            print("Fail CRC")
+            exit(-1)
+
+    # incremental CRC over memoryview slices must match the one shot CRC
+    running = Crc16()
+    view = memoryview(bytearray(test_str, "ascii"))
+    running.update(view[:4])
+    running.update(view[4:])
+    if (running.value != 0x29B1):
         print("Fail CRC")
         exit(-1)
 
     # encode a test message
     test_array = (0x10, 0x52, 0x01, 0x17, 0x10, 0x00, 0x02, 0xE8, 0x03, 0xA8, 0xA6)
     result_array = dssp.cobs_encode(test_array)
-    if (result_array != [0x06, 0x10, 0x52, 0x01, 0x17, 0x10, 0x06, 0x02, 0xE8, 0x03, 0xA8, 0xA6, 0x00]):
+    if (result_array != bytes([0x00, 0x06, 0x10, 0x52, 0x01, 0x17, 0x10, 0x06, 0x02, 0xE8, 0x03, 0xA8, 0xA6, 0x00])):
+        print("Fail COBS")
+        exit(-1)
+    if (dssp.cobs_decode(result_array[1:-1]) != bytes(test_array)):
         print("Fail COBS")
         exit(-1)
 
     # encode a short test message with no zeros
     test_array = [x+1 for x in range(0,16)]
     result_array = dssp.cobs_encode(test_array)
-    expected_result = test_array
+    expected_result = list(test_array)
     expected_result.insert( 0, len(test_array)+1 )
+    expected_result.insert( 0, 0 )
     expected_result.append(0)
 
-    if (result_array != expected_result):
+    if (result_array != bytes(expected_result)):
         print("Fail COBS")
         exit(-1)
 
-    # encode a long message with no zeros
+    # encode a long message with no zeros, needs a 0xFF code after 254 bytes
     test_array = [x+1 for x in range(0,255)]
     test_array.append(1)
 
-    result_array = dssp.cobs_decode(test_array)
-    
-    expected_result = [x+1 for x in range(0,255)]
-    expected_result.insert( 0, 0xFF )
-    expected_result.append(2)
+    result_array = dssp.cobs_encode(test_array)
+
+    expected_result = [0, 0xFF]
+    expected_result += [x+1 for x in range(0,254)]
+    expected_result.append(3)
+    expected_result.append(255)
     expected_result.append(1)
     expected_result.append(0)
 
-    if (result_array != expected_result):
+    if (result_array != bytes(expected_result)):
+        print("Fail COBS")
+        exit(-1)
+    if (dssp.cobs_decode(result_array[1:-1]) != bytes(test_array)):
         print("Fail COBS")
         exit(-1)
 
-
-    test_message = (0x52, 0x01, 0x17, 0x10, 0x00, 0x02, 0xE8, 0x03)
+    test_message = (0x10, 0x52, 0x01, 0x17, 0x10, 0x00, 0x02, 0xE8, 0x03)
     result_array = dssp.encode(test_message)
-    if (result_array != [0x06, 0x10, 0x52, 0x01, 0x17, 0x10, 0x06, 0x02, 0xE8, 0x03, 0xA8, 0xA6, 0x00]):
+    if (result_array != bytes([0x00, 0x06, 0x10, 0x52, 0x01, 0x17, 0x10, 0x06, 0x02, 0xE8, 0x03, 0xA8, 0xA6, 0x00])):
         print("Fail DSSP encode test")
         exit(-1)
 
+    # several frames in one read, split across two reads, must all be returned
+    burst = bytes(dssp.encode(test_message)) * 3
+    found = list(dssp.frames(burst[:20])) + list(dssp.frames(burst[20:]))
+    if (len(found) != 3) or any(list(frame[:-2]) != list(test_message) for frame in found):
+        print("Fail DSSP deframer test")
+        exit(-1)
+
     print( "Pass all DSSP Data Link Layer tests")
 
 if __name__ == "__main__":
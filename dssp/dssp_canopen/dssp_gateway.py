@@ -13,138 +13,331 @@
 # @date 20th October 2021
 # @author Andrew Dachs
 # @brief Gateway for DSSP
-# 
+#
 # Provides primitives for sending and receiving GatewayTransportProtocol messages
 # over a DSSP serial link.  The class is intended to be subclassed with more specific
 # implementations of txcnf and rxind.
-# 
+#
+# Requests are sent from a window of up to 'window' outstanding frames.  Every
+# request is answered by the gateway with either an ACK or an SDO upload response.
+# The gateway protocol carries no sequence numbers, so upload responses are matched
+# to the oldest outstanding upload of the same object and offset, and ACKs to the
+# oldest outstanding request that an ACK can answer.  That is any request except
+# an upload, which only an error ACK answers.
+#
+# ACKs are positional.  A request lost on the serial link shifts the ACKs behind
+# it onto the wrong requests.  So when a request times out it is retransmitted
+# together with every request sent after it (go-back-N).  The requests
+# acknowledged since the window was last empty are marked 'suspect', because one
+# of them may have taken the ACK of the lost request.  Engines that stream
+# idempotent writes check the flag and send those writes again.
+# A window of 1 gives the original stop-and-wait behaviour.
+#
+# Requests can be posted to a separate pool with its own window, e.g. the
+# scanner's probes, so they neither wait for nor hold up the other requests.
+#
 
+import collections
+import itertools
 import threading
-import queue
+import time
 import serial
 
 from dssp_canopen.gateway_transport import *
 from dssp_canopen.dssp_dll import DsspDataLinkLayer
 
 
+class DsspGatewayRequest:
+    __slots__ = ('seq', 'msg', 'frame', 'timeout', 'retries', 'deadline', 'callback', 'pool', 'suspect')
+
+    def __init__(self, seq, msg, frame, timeout, retries, callback, pool = None):
+        self.seq = seq
+        self.msg = msg
+        self.frame = frame
+        self.timeout = timeout
+        self.retries = retries
+        self.deadline = 0
+        self.callback = callback
+        self.pool = pool
+        self.suspect = False            # acknowledged, but maybe with the ACK of a lost request
+
+    def is_upload(self):
+        return (self.msg.msg_type == GATEWAY_MSG_SDO) and (self.msg.cmd == GatewayTransportProtocol.GATEWAY_CMD_SDO_UPLOAD)
+
+    # True if msg is the response this request is waiting for.  A successful
+    # upload is always answered with data, so only an error ACK can answer one
+    def matches(self, msg):
+        if (msg.msg_type == GATEWAY_MSG_ACK):
+            return (msg.error_code != 0) or not (self.is_upload())
+        return ((self.is_upload()) and
+                (self.msg.node == msg.node) and (self.msg.index == msg.index) and (self.msg.subindex == msg.subindex) and
+                (self.msg.offset == msg.offset))
+
+# The outstanding requests of a gateway in order of transmission, shared by
+# DsspGateway and AsyncCanOpenGateway.  The caller serialises access.
+class DsspRequestWindow:
+
+    def __init__(self):
+        self.pending = collections.OrderedDict()        # seq -> outstanding request
+        self.acked = []                                 # acknowledged since the window was last empty
+        self.retransmit_count = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def count(self, pool):
+        return sum(1 for req in self.pending.values() if (req.pool == pool))
+
+    # Adds a request that has just been sent
+    def open(self, req, now):
+        req.deadline = now + req.timeout
+        self.pending[req.seq] = req
+
+    # Removes and returns the outstanding request answered by msg, if any
+    def match(self, msg):
+        for req in self.pending.values():
+            if (req.matches(msg)):
+                del self.pending[req.seq]
+                if (msg.msg_type == GATEWAY_MSG_ACK):
+                    self.acked.append(req)
+                if not (self.pending):
+                    self.acked.clear()                  # every ACK is accounted for
+                return req
+        return None
+
+    def _suspect(self):
+        for req in self.acked:
+            req.suspect = True
+        self.acked.clear()
+
+    # Retransmits or expires overdue requests.  Returns the frames to write, in
+    # order, and the requests that ran out of retries
+    def expire(self, now):
+        frames = []
+        expired = []
+        while (self.pending):
+            req = next((req for req in self.pending.values() if (req.deadline <= now)), None)
+            if (req == None):
+                break
+            self._suspect()
+            if (req.retries > 0):
+                # go back: the request and everything sent after it, their ACKs may be shifted
+                req.retries -= 1
+                resend = list(self.pending.values())
+                resend = resend[resend.index(req):]
+                for later in resend:
+                    later.deadline = now + later.timeout
+                    frames.append(later.frame)
+                self.retransmit_count += len(resend)
+                break
+            del self.pending[req.seq]
+            expired.append(req)
+        if not (self.pending):
+            self.acked.clear()
+        return frames, expired
+
+    # Seconds to the next deadline, None if nothing is outstanding
+    def wait(self, now):
+        if not (self.pending):
+            return None
+        return max(0.0, min(req.deadline for req in self.pending.values()) - now)
+
+
 class DsspGateway:
     RSP_TIMEOUT      = 3.0
     RETRIES          = 2
+    WINDOW           = 1
     ERROR_NONE       = 0
+    ERROR_SDO_ABORTED = 9
     ERROR_TIMEOUT    = 254
 
-    def __init__(self, port, baudrate = 115200 ):
+    def __init__(self, port, baudrate = 115200, window = None ):
 
         # start modules
         self.dssp   = DsspDataLinkLayer()
         self.gtp    = GatewayTransportProtocol()
 
-        self.tx_queue = queue.SimpleQueue()
+        self.tx_queue = collections.deque()
         self.tx_count   = 0
         self.tx_ack = 0
         self.rx_count   = 0
 
+        self.window = window if (window != None) else self.WINDOW
+        self.pools = dict()                             # pool -> window, for requests not in the main window
+        self._requests = DsspRequestWindow()
+        self._seq = itertools.count()
+        self._tx_cond = threading.Condition()
+
         self._reading = False
         self._serial_rx_thread = None
         self._serialport = None
         self._serial_tx_thread = None
         self._writing = False
 
-        self.ack_lock = threading.Lock()
-
         # open serial port and start threads
         try:
             self._serialport = serial.Serial(port, baudrate, timeout=None )
             self._reading = True
-            self._serial_rx_thread = threading.Thread(target=self._read_thread, args=(self._serialport,self.ack_lock),daemon=True)
+            self._serial_rx_thread = threading.Thread(target=self._read_thread, args=(self._serialport,),daemon=True)
             self._serial_rx_thread.start()
             self._writing = True
-            self._serial_tx_thread = threading.Thread(target=self._write_thread, args=(self._serialport,self.tx_queue,self.ack_lock,), daemon=True)
-            self._serial_tx_thread.start()            
+            self._serial_tx_thread = threading.Thread(target=self._write_thread, args=(self._serialport,), daemon=True)
+            self._serial_tx_thread.start()
         except (serial.SerialException, serial.SerialTimeoutException) as err:
             print(f"Error connecting to serial port {err}")
 
     def __del__(self):
         # stop worker threads and close serial port
-        if (self.ack_lock.locked()):
-            self.ack_lock.release()
+        with self._tx_cond:
+            self._writing = False
+            self._tx_cond.notify_all()
         if self._serial_rx_thread is not None:
             self._reading = False
             self._serial_rx_thread.join()
         if self._serial_tx_thread is not None:
-            self._writing = False
             self._serial_tx_thread.join()
         if self._serialport is not None:
-            if (self._serialport.is_open()):
+            if (self._serialport.is_open):
                 self._serialport.close()
 
-    # the write thread waits for a message on the tx_queue, sends it
-    # on the serial port.  If no ack is received it retries
-    def _write_thread(self, port, txq, ack_lock):
-        item = None
-        retry_count = 0
-        while self._writing and port:
-            try:
-                if (ack_lock.acquire( blocking = True, timeout=DsspGateway.RSP_TIMEOUT) == True):
-                    item = txq.get()                      # wait for something to send
+    @property
+    def retransmit_count(self):
+        return self._requests.retransmit_count
+
+    # Under the tx lock: retransmit or expire overdue requests and move queued
+    # requests into their window.  Returns the frames to write, the expired
+    # requests and how long to sleep before the next deadline.
+    def _schedule(self, now):
+        frames, expired = self._requests.expire(now)
+        if (self.tx_queue):
+            room = dict()
+            waiting = collections.deque()
+            for req in self.tx_queue:
+                if (req.pool not in room):
+                    room[req.pool] = self.pools.get(req.pool, self.window) - self._requests.count(req.pool)
+                if (room[req.pool] > 0):
+                    room[req.pool] -= 1
+                    self._requests.open(req, now)
                     self.tx_count += 1
-                    retry_count = self.RETRIES
-                    port.write(item)
-                    port.flush()                          # writing serial data takes ~20ms becuase of latency setting in PC USB serial driver
+                    frames.append(req.frame)
                 else:
-                    if (item != None):
-                        if (retry_count > 0):
-                            retry_count -= 1
-                            #print( ".", end = '', flush=True)
-                            port.write(item)
-                            port.flush()
-                        else:
-                            self.txCnf( DsspGateway.ERROR_TIMEOUT )            # timeout 
-                            item = None 
-                            ack_lock.release()
+                    waiting.append(req)
+            self.tx_queue = waiting
+        return frames, expired, self._requests.wait(now)
+
+    # the write thread sends queued requests while there is room in the window
+    # and retransmits any request that has not been answered within its timeout.
+    # Once a request runs out of retries it is confirmed with ERROR_TIMEOUT
+    def _write_thread(self, port):
+        while self._writing and port:
+            with self._tx_cond:
+                frames, expired, wait = self._schedule(time.monotonic())
+                if not (frames or expired):
+                    self._tx_cond.wait(wait)        # woken by post, responses and shutdown
+                    continue
+            try:
+                for frame in frames:
+                    port.write(frame)
+                if (frames):
+                    port.flush()                    # writing serial data takes ~20ms becuase of latency setting in PC USB serial driver
             except:
-                continue
+                pass
+            for req in expired:
+                self._complete(req, DsspGateway.ERROR_TIMEOUT, None)
+                self.txCnf( DsspGateway.ERROR_TIMEOUT )            # timeout
         print( "Leaving tx thread")
 
     # read thread passes characters as they are received through
     # to dssp frame assembler.  Completed frames are then
-    # decoded into gateway messages.
-    def _read_thread(self, port, ack_lock):
+    # decoded into gateway messages.  A single read may complete
+    # several frames, every one of them is dispatched.
+    def _read_thread(self, port):
         while self._reading and port:
             try:
                 bytes_to_read = port.in_waiting
                 if (bytes_to_read < 1):
                     bytes_to_read = 1
                 var = port.read(bytes_to_read)
-                if (var != b''):                 
-                    frame = self.dssp.process(var)
-                    if (frame != None ):
-                        msg = self.gtp.decode( frame )
-                        if (msg != None):
-                            # we have a valid gateway message
-                            if ((msg.msg_type == GATEWAY_MSG_ACK) or
-                                ((msg.msg_type == GATEWAY_MSG_SDO) and (msg.cmd == GatewayTransportProtocol.GATEWAY_CMD_SDO_UPLOAD_RSP))):
-                                    try:
-                                        ack_lock.release()
-                                    except:
-                                        pass
-                            if (msg.msg_type == GATEWAY_MSG_ACK):
-                                self.tx_ack += 1
-                                self.txCnf( msg.error_code )
-                            else:
-                                self.rx_count += 1
-                                self.rxInd( msg )
             except:
                 continue
+            if (var != b''):
+                for frame in self.dssp.frames(var):
+                    try:
+                        self._dispatch(self.gtp.decode( frame ))
+                    except:
+                        continue
         print( "Leaving rx thread")
 
-    def post( self, msg ):
+    # Removes and returns the outstanding request answered by msg, if any
+    def _match(self, msg):
+        with self._tx_cond:
+            req = self._requests.match(msg)
+            if (req != None):
+                self._tx_cond.notify()              # room in the window
+            return req
+
+    def _complete(self, req, error_code, rsp):
+        if (req.callback != None):
+            req.callback(req, error_code, rsp)
+
+    def _dispatch(self, msg):
+        if (msg != None):
+            # we have a valid gateway message
+            req = None
+            if ((msg.msg_type == GATEWAY_MSG_ACK) or
+                ((msg.msg_type == GATEWAY_MSG_SDO) and (msg.cmd == GatewayTransportProtocol.GATEWAY_CMD_SDO_UPLOAD_RSP))):
+                req = self._match(msg)
+            if (msg.msg_type == GATEWAY_MSG_ACK):
+                self.tx_ack += 1
+                if (req != None):                   # otherwise a duplicate ack for a retransmitted request
+                    self._complete(req, msg.error_code, None)
+                    self.txCnf( msg.error_code )
+            else:
+                self.rx_count += 1
+                if (req != None):
+                    msg.payload_type = req.msg.payload_type     # several uploads may be in flight
+                    self._complete(req, DsspGateway.ERROR_NONE, msg)
+                self.rxInd( msg )
+
+    # Queues msg for transmission and returns its sequence number.
+    # callback(request, error_code, response) is called once the request is
+    # acknowledged, answered or has timed out on all retries.  A request in a
+    # pool is sent when there is room in that pool's window, see self.pools
+    def post( self, msg, callback = None, timeout = None, retries = None, pool = None ):
+        return self.post_request(msg, callback, timeout, retries, pool).seq
+
+    # As post, but returns the DsspGatewayRequest
+    def post_request( self, msg, callback = None, timeout = None, retries = None, pool = None ):
         # first pack the gateway message into an array of bytes
         payload_bytes = self.gtp.encode(msg)
         # now encode the bytes as DSSP with checksum and COBS framing
         dssp_frame = self.dssp.encode(payload_bytes)
+        req = DsspGatewayRequest(next(self._seq), msg, dssp_frame,
+                                 timeout if (timeout != None) else DsspGateway.RSP_TIMEOUT,
+                                 retries if (retries != None) else self.RETRIES,
+                                 callback, pool)
         # send it on serial port
-        self.tx_queue.put(dssp_frame)
+        with self._tx_cond:
+            self.tx_queue.append(req)
+            self._tx_cond.notify()
+        return req
+
+    # Drops the requests with these sequence numbers that are still queued.
+    # Requests already sent stay in the window without their callback, so a
+    # late response is still matched to them and not to another request
+    def cancel( self, seqs ):
+        seqs = set(seqs)
+        with self._tx_cond:
+            self.tx_queue = collections.deque(req for req in self.tx_queue if (req.seq not in seqs))
+            for req in self._requests.pending.values():
+                if (req.seq in seqs):
+                    req.callback = None
+                    req.retries = 0
+
+    # Number of requests queued or waiting for a response
+    def outstanding( self ):
+        with self._tx_cond:
+            return len(self.tx_queue) + len(self._requests)
 
     def rxInd( self, msg ):
         # override in child class
@@ -0,0 +1,484 @@
+#!/bin/python
+#
+#               /|\
+#              / | \
+#             /  |  \
+#            /   |   \
+#           /   / \   \
+#          /   //|\\   \
+#         /   // | \\   \  (c) Dawn Aerospace Ltd
+#        /___//_/ \_\\___\  www.dawnaerospace.com
+#
+# @file flash.py
+# @brief Pipelined firmware download for the SatDrive bootloader
+#
+# FirmwareDownload sends an image to a flash region as segmented SDO downloads
+# to OD[0x1F50], in blocks of up to 'window' segments waiting for their ACK at
+# once.  The gateway retransmits a segment that is not acknowledged in time.
+# A segment that the gateway gives up on, or that is refused, is sent again by
+# the engine, up to 'retries' times.  The final 'last' segment is only sent
+# once every other segment has been acknowledged.
+#
+# The gateway protocol has no sequence numbers and ACKs are positional, so a
+# segment lost on the serial link shifts the ACKs behind it.  Another segment
+# of the block then times out, and the gateway flags the segments acknowledged
+# alongside it as suspect (see dssp_gateway.py).  Which of them was lost can't
+# be told, so the engine sends the suspect segments of the block again.
+# Segments are written at their offset, so sending one twice is harmless.
+# Waiting for each block keeps that to one block.  The region signature check
+# after the download still proves the image.  For a pipelined download open
+# the gateway with a window of at least the engine's.
+#
+# flash_nodes() runs the whole bootloader sequence (reset, unlock, erase,
+# download, verify) for several nodes at once over one gateway, so the erase
+# of one node overlaps the download to another.  The bootloader acknowledges
+# the erase command and erases in the background, so FlashNode polls the flash
+# status (OD[0x1F57]) between other nodes' requests instead of holding a
+# request slot of the gateway for the whole erase.  A manifest lists one node
+# per line as 'node_id file [region]':
+#
+#   5   Controller-DA18-01-30-10-10-v1.3.4.bin
+#   10  Feedline-DA18-01-30-30-10-v1.3.4.bin   2
+#
+# With skip_unchanged a node whose region signature (OD[0x1F56]) already
+# matches the file is left as it is.  The bootloader's program data object is
+# write only, so there is no reading back to rewrite just the pages that differ.
+#
+
+import argparse
+import collections
+import concurrent.futures
+import mmap
+import os
+import threading
+import time
+
+from dssp_canopen.gateway_transport import *
+from dssp_canopen.canopen_gateway import CanOpenGateway, CanOpenGatewayError, CanOpenGatewayTimeoutError, CanOpenSdoAbortError
+from dssp_canopen.flash_signature import FlashSignature, file_signature
+
+
+# Bootloader objects
+BOOT_DATA          = 0x1F50
+BOOT_CONTROL       = 0x1F51
+BOOT_SIGNATURE     = 0x1F56
+BOOT_STATUS        = 0x1F57
+BOOT_REGION_LENGTH = 0x1F58
+BOOT_UNLOCK        = 0x7F50
+
+BOOT_CMD_EXECUTE   = b'\x01'
+BOOT_CMD_ERASE     = b'\x03'
+BOOT_CMD_VALIDATE  = b'\x83'
+BOOT_CMD_INVALIDATE = b'\x84'
+
+BOOT_STATUS_OK     = 0
+BOOT_STATUS_BUSY   = 1
+BOOT_STATUS_NAMES  = {0: "OK", 1: "BUSY", 2: "NOVALPROG", 4: "FORMAT", 6: "CRC", 8: "NOTCLEARED",
+                      10: "WRITE", 12: "ADDRESS", 14: "SECURED", 16: "NVDATA"}
+
+class FlashStatusError(Exception):
+    def __init__(self, status):
+        self.status = status
+    def __str__(self):
+        return f'flash status {BOOT_STATUS_NAMES.get(self.status, self.status)}'
+
+class FirmwareDownload:
+    INDEX_DATA       = BOOT_DATA
+    SEGMENT_SIZE     = 64
+    WINDOW           = 8
+    RETRIES          = 3
+
+    # progress(bytes_acknowledged, total_bytes, elapsed_seconds) is called
+    # whenever segments are acknowledged.  timeout overrides the gateway's
+    # RSP_TIMEOUT for each attempt of a segment
+    def __init__(self, gw, node_id, region, segment_size = None, window = None, retries = None, progress = None, timeout = None):
+        self.gw = gw
+        self.node_id = node_id
+        self.region = region
+        self.segment_size = segment_size if (segment_size != None) else self.SEGMENT_SIZE
+        self.window = window if (window != None) else max(getattr(gw, 'window', 1), 1)
+        self.retries = retries if (retries != None) else self.RETRIES
+        self.progress = progress
+        self.timeout = timeout
+        self.retransmit_count = 0
+        self.elapsed = 0.0
+
+    # Bytes per second of the last download
+    def throughput( self, length ):
+        return length / self.elapsed if (self.elapsed > 0) else 0.0
+
+    def _send( self, image, offset ):
+        return self.gw.download_async(self.node_id, self.INDEX_DATA, self.region, GATEWAY_TYPE_DOMAIN,
+                                      bytes(image[offset:offset+self.segment_size]), offset, False, self.timeout)
+
+    # Downloads image (bytes like) and returns its FlashSignature
+    def download( self, image ):
+        image = memoryview(image)
+        total = len(image)
+        queue = collections.deque(range(0, total, self.segment_size))
+        attempts = collections.Counter()
+        acked = 0
+        starttime = time.monotonic()
+        while (queue):
+            block = dict()                  # future -> offset
+            while (queue) and (len(block) < self.window):
+                offset = queue.popleft()
+                block[self._send(image, offset)] = offset
+            concurrent.futures.wait(block)
+            missing = []
+            for future, offset in block.items():
+                try:
+                    future.result()
+                    if not (future.request.suspect):
+                        acked += min(self.segment_size, total - offset)
+                        continue
+                    error = CanOpenGatewayTimeoutError()     # its ACK may have been another segment's
+                except CanOpenGatewayError as err:
+                    error = err
+                attempts[offset] += 1
+                if (attempts[offset] > self.retries):
+                    raise error
+                missing.append(offset)
+            self.retransmit_count += len(missing)
+            queue.extendleft(reversed(missing))     # missing segments go first
+            if (self.progress != None):
+                self.progress(acked, total, time.monotonic() - starttime)
+        # force the target to commit buffers to flash
+        self.gw.download(self.node_id, self.INDEX_DATA, self.region, GATEWAY_TYPE_DOMAIN, b'', total, True)
+        self.elapsed = time.monotonic() - starttime
+        signature = FlashSignature()
+        signature.update(image)
+        return signature
+
+    # Downloads a .bin file, see download()
+    def download_file( self, filename ):
+        with open(filename, "rb") as fs:
+            if (fs.seek(0, 2) == 0):
+                return self.download(b'')
+            with mmap.mmap(fs.fileno(), 0, access=mmap.ACCESS_READ) as image:
+                return self.download(image)
+
+# One node to flash and, once flashed, the outcome
+class FlashJob:
+    REGION           = 2
+
+    def __init__(self, node_id, filename, region = None):
+        self.node_id = node_id
+        self.filename = filename
+        self.region = region if (region != None) else self.REGION
+        self.status = "pending"
+        self.error = None
+        self.length = 0
+        self.region_length = None
+        self.old_signature = None
+        self.expected = None
+        self.signature = None
+        self.retransmit_count = 0
+        self.times = dict()                 # step -> seconds
+
+    def ok( self ):
+        return self.status in ("ok", "unchanged")
+
+    def __repr__(self):
+        return f"FlashJob(node={self.node_id}, file={self.filename!r}, region={self.region}, status={self.status!r})"
+
+# Returns the jobs listed in a manifest, file names are relative to the manifest
+def read_manifest( filename ):
+    jobs = []
+    directory = os.path.dirname(os.path.abspath(filename))
+    with open(filename) as f:
+        for line in f:
+            fields = line.split("#")[0].split()
+            if not (fields):
+                continue
+            if (len(fields) not in (2, 3)):
+                raise ValueError(f'{filename}: expected "node_id file [region]", got "{line.strip()}"')
+            region = int(fields[2], 0) if (len(fields) == 3) else None
+            jobs.append(FlashJob(int(fields[0], 0), os.path.join(directory, fields[1]), region))
+    return jobs
+
+class FlashNode:
+    ERASE_TIMEOUT    = 20.0
+    ERASE_POLL       = 0.2
+    ERASE_SETTLE     = 2.0              # for a bootloader without a flash status
+    RESET_DELAY      = 0.5
+
+    def __init__(self, gw, job, segment_size = None, window = None, progress = None):
+        self.gw = gw
+        self.job = job
+        self.segment_size = segment_size
+        self.window = window
+        self.progress = progress
+
+    def _step( self, name, fn, *args ):
+        starttime = time.monotonic()
+        try:
+            return fn(*args)
+        finally:
+            self.job.times[name] = time.monotonic() - starttime
+
+    def _upload_u32( self, index ):
+        val, last = self.gw.upload(self.job.node_id, index, self.job.region, GATEWAY_TYPE_UINT32)
+        return val
+
+    def _control( self, cmd, timeout = None ):
+        future = self.gw.download_async(self.job.node_id, BOOT_CONTROL, self.job.region, GATEWAY_TYPE_UINT8, cmd, timeout = timeout)
+        return future.result((timeout if (timeout != None) else self.gw.RSP_TIMEOUT) * (self.gw.RETRIES + 1) + 1.0)
+
+    def reset( self ):
+        node = self.job.node_id
+        nmt_reset = GatewayTransportMessage(msg_type = GATEWAY_MSG_CAN, cobid = 0, payload = [129, node])
+        # make sure we're in the bootloader by resetting twice
+        self.gw.post(nmt_reset, False)
+        time.sleep(self.RESET_DELAY)        # delay to allow bootloader to start
+        self.gw.post(nmt_reset, False)
+
+    # the bootloader only accepts control commands for an unlocked region
+    def unlock( self ):
+        self.gw.download(self.job.node_id, BOOT_UNLOCK, self.job.region, GATEWAY_TYPE_UINT32, b'INIT')
+
+    # the erase is only sent here, the gateway is free for the other nodes while
+    # the flash status reads busy
+    def erase( self ):
+        self.unlock()
+        self._control(BOOT_CMD_ERASE)
+        deadline = time.monotonic() + self.ERASE_TIMEOUT
+        while True:
+            try:
+                status = self._upload_u32(BOOT_STATUS)
+            except CanOpenSdoAbortError:
+                time.sleep(self.ERASE_SETTLE)
+                return
+            if (status == BOOT_STATUS_OK):
+                return
+            if (status != BOOT_STATUS_BUSY):
+                raise FlashStatusError(status)
+            if (time.monotonic() > deadline):
+                raise CanOpenGatewayTimeoutError()
+            time.sleep(self.ERASE_POLL)
+
+    def download( self ):
+        progress = None
+        if (self.progress != None):
+            progress = lambda acked, total, elapsed: self.progress(self.job, acked, total, elapsed)
+        engine = FirmwareDownload(self.gw, self.job.node_id, self.job.region, self.segment_size, self.window, progress = progress)
+        try:
+            return engine.download_file(self.job.filename)
+        finally:
+            self.job.retransmit_count = engine.retransmit_count
+
+    # Runs the bootloader sequence and fills in the job, execute starts the new
+    # image.  With skip_unchanged a region whose signature already matches the
+    # file is only validated, not erased and written again
+    def run( self, execute = False, skip_unchanged = False ):
+        job = self.job
+        starttime = time.monotonic()
+        try:
+            job.status = "reset"
+            self._step("reset", self.reset)
+            job.status = "connect"
+            job.region_length = self._upload_u32(BOOT_REGION_LENGTH)
+            try:
+                job.old_signature = self._upload_u32(BOOT_SIGNATURE)
+            except CanOpenSdoAbortError:
+                pass                                        # nothing signed yet
+            job.length = os.path.getsize(job.filename)
+            job.expected = file_signature(job.filename, job.region_length)
+            if (skip_unchanged) and (job.old_signature == job.expected):
+                job.signature = job.old_signature
+                self.unlock()
+                self._control(BOOT_CMD_VALIDATE)
+                job.status = "unchanged"
+                if (execute):
+                    self.gw.download_async(job.node_id, BOOT_CONTROL, job.region, GATEWAY_TYPE_UINT8, BOOT_CMD_EXECUTE)
+                return job
+            job.status = "erase"
+            self._step("erase", self.erase)
+            job.status = "download"
+            self._step("download", self.download)
+            job.status = "verify"
+            job.signature = self._step("verify", self._upload_u32, BOOT_SIGNATURE)
+            if (job.signature != job.expected):
+                self._control(BOOT_CMD_INVALIDATE)          # clear signature in device
+                job.status = "bad signature"
+                return job
+            self._control(BOOT_CMD_VALIDATE)
+            job.status = "ok"
+            if (execute):
+                self.gw.download_async(job.node_id, BOOT_CONTROL, job.region, GATEWAY_TYPE_UINT8, BOOT_CMD_EXECUTE)
+        except Exception as err:
+            job.error = f"{job.status}: {err}"
+            job.status = "failed"
+        finally:
+            job.times["total"] = time.monotonic() - starttime
+        return job
+
+# Flashes every job at once over gw and returns the jobs.
+# progress(job, acked, total, elapsed) reports the downloads
+def flash_nodes( gw, jobs, segment_size = None, window = None, progress = None, execute = False, skip_unchanged = False ):
+    threads = [threading.Thread(target=FlashNode(gw, job, segment_size, window, progress).run, args=(execute, skip_unchanged), daemon=True)
+               for job in jobs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return jobs
+
+# Returns the consolidated report of flash_nodes as lines of text
+def flash_report( jobs ):
+    lines = [f"{'node':>4}  {'file':40}  {'region':>6}  {'bytes':>7}  {'erase':>6}  {'download':>8}  {'total':>6}  {'expected':>8}  {'flash':>8}  status"]
+    for job in jobs:
+        expected = f"{job.expected:08X}" if (job.expected != None) else "-"
+        signature = f"{job.signature:08X}" if (job.signature != None) else "-"
+        lines.append(f"{job.node_id:4d}  {os.path.basename(job.filename):40.40}  {job.region:6d}  {job.length:7d}  "
+                     f"{job.times.get('erase', 0):6.1f}  {job.times.get('download', 0):8.1f}  {job.times.get('total', 0):6.1f}  "
+                     f"{expected:>8}  {signature:>8}  {job.status if (job.error == None) else job.error}")
+    return lines
+
+# erase_times maps a node to the seconds its erase takes, the flash status
+# reads busy until then.  Without it there is no flash status object
+def _simulated_bootloader(region_length, erase_times = None):
+    from dssp_canopen.gateway_sim import SimulatedGateway
+    from dssp_canopen.flash_signature import image_signature
+
+    # signs a region when its download is committed, like the bootloader
+    class SimulatedBootloader(SimulatedGateway):
+        def __init__(self, *args, **kwargs):
+            self.erasing = dict()               # (node, region) -> end of the erase
+            self.overlapped = set()             # (node downloading, node erasing)
+            SimulatedGateway.__init__(self, *args, **kwargs)
+
+        def _respond(self, msg):
+            if (msg.msg_type == GATEWAY_MSG_SDO) and (erase_times != None):
+                now = time.monotonic()
+                key = (msg.node, msg.subindex)
+                if (msg.index == BOOT_CONTROL) and (bytes(msg.payload) == BOOT_CMD_ERASE):
+                    self.erasing[key] = now + erase_times.get(msg.node, 0.0)
+                if (msg.index == BOOT_STATUS):
+                    busy = now < self.erasing.get(key, 0.0)
+                    self.objects[(msg.node, BOOT_STATUS, msg.subindex)] = (BOOT_STATUS_BUSY if busy else BOOT_STATUS_OK).to_bytes(4, 'little')
+                if (msg.index == BOOT_DATA):
+                    self.overlapped.update((msg.node, node) for (node, region), end in self.erasing.items() if (now < end))
+            rsp = SimulatedGateway._respond(self, msg)
+            if (msg.msg_type == GATEWAY_MSG_SDO) and (msg.index == BOOT_DATA) and (msg.last):
+                image = self.objects.get((msg.node, BOOT_DATA, msg.subindex), b'')
+                self.objects[(msg.node, BOOT_SIGNATURE, msg.subindex)] = image_signature(image, region_length).to_bytes(4, 'little')
+            return rsp
+    return SimulatedBootloader
+
+def _test_flash_nodes(window, size):
+    import tempfile
+    region_length = 4 * size
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, "manifest.txt"), "w") as f:
+            for node in (5, 10, 11, 12):
+                with open(os.path.join(directory, f"node{node}.bin"), "wb") as image:
+                    image.write(os.urandom(size + node))
+                f.write(f"{node} node{node}.bin  # comment\n")
+        jobs = read_manifest(os.path.join(directory, "manifest.txt"))
+        objects = dict()
+        for job in jobs:
+            objects[(job.node_id, BOOT_REGION_LENGTH, job.region)] = region_length.to_bytes(4, 'little')
+            objects[(job.node_id, BOOT_SIGNATURE, job.region)] = bytes(4)
+        with _simulated_bootloader(region_length)(objects, latency = 0.02) as sim:
+            gw = CanOpenGateway(sim.port, window = window)
+            FlashNode.ERASE_SETTLE = 0.5
+            starttime = time.monotonic()
+            flash_nodes(gw, jobs)
+            elapsed = time.monotonic() - starttime
+            for line in flash_report(jobs):
+                print( line )
+            if not all(job.ok() for job in jobs) or (len(jobs) != 4):
+                print( "Fail flash nodes" )
+                exit(-1)
+            if (sum(job.times['total'] for job in jobs) < 2 * elapsed):
+                print( "Fail flash nodes in parallel" )
+                exit(-1)
+            requests = len(sim.requests)
+            flash_nodes(gw, jobs, skip_unchanged = True)
+            if not all(job.status == "unchanged" for job in jobs) or (len(sim.requests) - requests > 8 * len(jobs)):
+                print( "Fail skip unchanged" )
+                exit(-1)
+            unlocked = set()
+            for msg in sim.requests[requests:]:
+                if (msg.msg_type == GATEWAY_MSG_SDO) and (msg.index == BOOT_UNLOCK):
+                    unlocked.add(msg.node)
+                if (msg.msg_type == GATEWAY_MSG_SDO) and (msg.index == BOOT_CONTROL) and (msg.node not in unlocked):
+                    print( "Fail unlock before validate" )
+                    exit(-1)
+
+# a slow erase at the window of dssp_flash.py, the gateway must carry one
+# node's download while another node's flash is still erasing
+def _test_flash_erase(size):
+    import tempfile
+    erase_times = {5: 0.5, 10: 3.0}
+    with tempfile.TemporaryDirectory() as directory:
+        jobs = []
+        objects = dict()
+        for node in erase_times:
+            filename = os.path.join(directory, f"node{node}.bin")
+            with open(filename, "wb") as image:
+                image.write(os.urandom(size))
+            jobs.append(FlashJob(node, filename))
+            objects[(node, BOOT_REGION_LENGTH, FlashJob.REGION)] = (4 * size).to_bytes(4, 'little')
+        with _simulated_bootloader(4 * size, erase_times)(objects, latency = 0.02) as sim:
+            gw = CanOpenGateway(sim.port, window = 1)
+            flash_nodes(gw, jobs)
+            for line in flash_report(jobs):
+                print( line )
+            if not all(job.status == "ok" for job in jobs):
+                print( "Fail flash nodes with a slow erase" )
+                exit(-1)
+            if ((5, 10) not in sim.overlapped) or (jobs[1].times['erase'] < erase_times[10]):
+                print( "Fail download while another node erases" )
+                exit(-1)
+
+def _self_test(window, size):
+    from dssp_canopen.gateway_sim import SimulatedGateway
+    image = os.urandom(size)
+    key = (5, FirmwareDownload.INDEX_DATA, 2)
+    for w in (1, window):
+        with SimulatedGateway(latency = 0.02) as sim:
+            gw = CanOpenGateway(sim.port, window = w)
+            engine = FirmwareDownload(gw, 5, 2, window = w)
+            signature = engine.download(image)
+            if (sim.objects.get(key) != image) or (signature.length != size):
+                print( f"Fail download with window {w}" )
+                exit(-1)
+            print( f"{size} bytes with window {w} in {engine.elapsed:.2f}s, {engine.throughput(size)/1e3:.1f} kB/s" )
+    with SimulatedGateway(latency = 0.005) as sim:
+        gw = CanOpenGateway(sim.port, window = 1)
+        sim.drop = 3                        # the first segment and both of its gateway retransmissions
+        engine = FirmwareDownload(gw, 5, 2, window = 1, timeout = 0.05)
+        engine.download(image[:1024])
+        if (sim.objects.get(key) != image[:1024]) or (engine.retransmit_count != 1):
+            print( "Fail download with lost segments" )
+            exit(-1)
+    # a segment lost in the middle of a block, its ACK is taken by the next one
+    with SimulatedGateway(latency = 0.005) as sim:
+        gw = CanOpenGateway(sim.port, window = 4)
+        lost = []
+        def lose_one(acked, total, elapsed):
+            if (acked >= 256) and not (lost):
+                sim.drop = 1
+                lost.append(acked)
+        engine = FirmwareDownload(gw, 5, 2, window = 4, timeout = 0.05, progress = lose_one)
+        engine.download(image[:1024])
+        if (sim.objects.get(key) != image[:1024]) or (engine.retransmit_count == 0):
+            print( "Fail download with a segment lost in a block" )
+            exit(-1)
+        print( f"Lost segment in a block of 4, {engine.retransmit_count} segments resent" )
+
+def main():
+    cmd_line = argparse.ArgumentParser(description="Firmware download test against a simulated gateway")
+    cmd_line.add_argument("-w", "--window", help="Segments in flight", type=int, default=FirmwareDownload.WINDOW)
+    cmd_line.add_argument("-n", "--size", help="Image size", type=int, default=16384)
+    args = cmd_line.parse_args()
+
+    _self_test(args.window, args.size)
+    _test_flash_nodes(args.window, args.size)
+    _test_flash_erase(args.size // 8)
+    print( "Pass all firmware download tests" )
+
+if __name__ == "__main__":
+    main()
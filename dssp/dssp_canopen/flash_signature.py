@@ -0,0 +1,127 @@
+#!/bin/python
+#
+#               /|\
+#              / | \
+#             /  |  \
+#            /   |   \
+#           /   / \   \
+#          /   //|\\   \
+#         /   // | \\   \  (c) Dawn Aerospace Ltd
+#        /___//_/ \_\\___\  www.dawnaerospace.com
+#
+# @file flash_signature.py
+# @brief Flash region signatures for the SatDrive bootloader
+#
+# The bootloader signs a flash region with the CRC32 (IEEE 802.3, as zlib) of
+# the whole region, so the signature of an image is the CRC32 of the file
+# followed by 0xFF up to the region length.  The padding is run through zlib
+# in blocks of a precomputed 0xFF run instead of a byte at a time.
+#
+# Expected signature of an image, without a target:
+#
+#   python -m dssp_canopen.flash_signature Controller.bin -l 0x40000
+#
+
+import argparse
+import os
+import time
+import zlib
+
+ERASED_BYTE    = 0xFF
+_ERASED_RUN    = bytes([ERASED_BYTE]) * 65536
+_READ_SIZE     = 1 << 20
+
+
+# Naive and slow crc32 calculator is deliberately not the same implementation as
+# embedded code.  Kept as the reference for crc32()
+def crc32_reference( initial, buffer ):
+    remainder = initial ^ 0xFFFFFFFF
+
+    for val in buffer:
+        remainder = remainder ^ val
+        for bit in range(8,0,-1):
+            if (remainder & 1):
+                remainder = (remainder >> 1) ^ 0xEDB88320
+            else:
+                remainder = (remainder >> 1)
+    return remainder ^ 0xFFFFFFFF
+
+# Same result as crc32_reference
+def crc32( initial, buffer ):
+    return zlib.crc32(buffer, initial)
+
+# Returns crc continued over count erased bytes
+def crc32_pad( crc, count ):
+    while (count > 0):
+        n = min(count, len(_ERASED_RUN))
+        crc = zlib.crc32(_ERASED_RUN[:n] if (n < len(_ERASED_RUN)) else _ERASED_RUN, crc)
+        count -= n
+    return crc
+
+# Running signature of an image, updated as blocks are sent to the target
+class FlashSignature:
+    def __init__(self, crc = 0):
+        self.crc = crc
+        self.length = 0
+
+    def update(self, buffer):
+        self.crc = zlib.crc32(buffer, self.crc)
+        self.length += len(buffer)
+
+    # Signature of the region once the rest of it is left erased
+    def value(self, region_length):
+        if (self.length > region_length):
+            raise ValueError(f'Image of {self.length} bytes does not fit a {region_length} byte region')
+        return crc32_pad(self.crc, region_length - self.length)
+
+# Signature of the flash region after data has been written to it
+def image_signature( data, region_length ):
+    sig = FlashSignature()
+    sig.update(data)
+    return sig.value(region_length)
+
+# Signature of the flash region after the file has been written to it
+def file_signature( filename, region_length ):
+    sig = FlashSignature()
+    with open(filename, "rb") as fs:
+        while True:
+            b = fs.read(_READ_SIZE)
+            if len(b) == 0:
+                break
+            sig.update(b)
+    return sig.value(region_length)
+
+def _self_test():
+    data = os.urandom(3000)
+    if (crc32(0, data) != crc32_reference(0, data)) or (crc32(0x12345678, data[:100]) != crc32_reference(0x12345678, data[:100])):
+        print( "Fail crc32" )
+        exit(-1)
+    for pad in (0, 1, 255, 65536, 70000):
+        if (image_signature(data, len(data) + pad) != crc32_reference(0, data + bytes([ERASED_BYTE]) * pad)):
+            print( f"Fail signature with {pad} bytes of padding" )
+            exit(-1)
+    sig = FlashSignature()
+    for n in range(0, len(data), 64):
+        sig.update(data[n:n+64])
+    if (sig.value(4096) != image_signature(data, 4096)):
+        print( "Fail streamed signature" )
+        exit(-1)
+    print( "Pass all flash signature tests" )
+
+def main():
+    parser = argparse.ArgumentParser(description="Flash region signature of SatDrive images")
+    parser.add_argument("files", help="Binary files", nargs="*")
+    parser.add_argument("-l", "--length", help="Flash region length, as read from OD[0x1F58]", type=lambda x: int(x, 0))
+    parser.add_argument("-t", "--test", help="Run the self test", action="store_true")
+    args = parser.parse_args()
+
+    if (args.test) or not (args.files):
+        _self_test()
+    for filename in args.files:
+        length = args.length if (args.length != None) else os.path.getsize(filename)
+        starttime = time.perf_counter()
+        sig = file_signature(filename, length)
+        print( f"{filename:50s} {length:8d} : {sig:08X} ({(time.perf_counter() - starttime) * 1e3:.1f} ms)" )
+
+if __name__ == "__main__":
+    main()
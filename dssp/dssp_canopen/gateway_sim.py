@@ -0,0 +1,151 @@
+#!/bin/python
+#
+#               /|\
+#              / | \
+#             /  |  \
+#            /   |   \
+#           /   / \   \
+#          /   //|\\   \
+#         /   // | \\   \  (c) Dawn Aerospace Ltd
+#        /___//_/ \_\\___\  www.dawnaerospace.com
+#
+# @file gateway_sim.py
+# @brief Simulated DSSP gateway on a local pty
+#
+# Stands in for the DSSP serial gateway so the gateway classes can be exercised
+# without hardware.  The simulator answers SDO uploads from a dictionary of
+# objects keyed on (node, index, subindex), stores SDO downloads in the same
+# dictionary and acknowledges everything else.  Each response is sent 'latency'
+# seconds after its request arrives, like the USB serial round trip.
+# send_can() injects frames from the bus, such as TPDOs.
+#
+# POSIX only, it needs os.openpty.
+#
+
+import os
+import queue
+import struct
+import threading
+import time
+import tty
+
+from dssp_canopen.dssp_dll import DsspDataLinkLayer
+from dssp_canopen.gateway_transport import *
+
+
+class SimulatedGateway:
+    ERROR_SDO_ABORTED = 9
+    SEGMENT_SIZE      = 64
+
+    def __init__(self, objects = None, latency = 0.02):
+        self.objects = objects if (objects != None) else dict()
+        self.latency = latency
+        self.requests = []                      # every decoded request, in order of arrival
+        self.drop = 0                           # number of requests to ignore, to force retransmissions
+        self.online = set()                     # if not empty, only these nodes answer
+        self.offline_delay = None               # if set, SDOs to other nodes get an error ACK after this long, as a gateway's SDO timeout
+        self._dssp = DsspDataLinkLayer()
+        self._gtp = GatewayTransportProtocol()
+        self._write_lock = threading.Lock()
+        self._running = True
+
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)    # give this to the gateway under test
+        self._tx_queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._tx_thread = threading.Thread(target=self._write, daemon=True)
+        self._tx_thread.start()
+
+    # Hangs up the link, as unplugging the gateway would
+    def close(self):
+        self._running = False
+        os.write(self._slave, b'\x00')        # wake the reader, the master is only released once it returns
+        self._thread.join(1.0)
+        os.close(self._slave)
+        os.close(self._master)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # responses are written in order of arrival, like the real gateway
+    def _send(self, payload, delay):
+        self._tx_queue.put((time.monotonic() + delay, payload))
+
+    def _write(self):
+        while self._running:
+            due, payload = self._tx_queue.get()
+            time.sleep(max(0.0, due - time.monotonic()))
+            with self._write_lock:
+                if (self._running):
+                    os.write(self._master, self._dssp.encode(payload))
+
+    # Sends an unsolicited CAN frame to the host, e.g. a TPDO of one of the nodes
+    def send_can(self, cob_id, payload, delay = 0):
+        self._send(GTP_CAN.pack(GatewayTransportProtocol.TYPE_FIELD, 0x80, cob_id) + bytes(payload), delay)
+
+    def _ack(self, error_code = 0):
+        return GTP_ACK.pack(GatewayTransportProtocol.TYPE_FIELD, 0, GatewayTransportProtocol.GATEWAY_CMD_ACK, error_code)
+
+    def _respond(self, msg):
+        P = GatewayTransportProtocol
+        if (msg.msg_type != GATEWAY_MSG_SDO):
+            return self._ack()
+        key = (msg.node, msg.index, msg.subindex)
+        if (msg.cmd == P.GATEWAY_CMD_SDO_UPLOAD):
+            value = self.objects.get(key)
+            if (value == None):
+                return self._ack(self.ERROR_SDO_ABORTED)
+            value = bytes(value)
+            if (msg.payload_type != GATEWAY_TYPE_DOMAIN):
+                return GTP_UPLOAD_RSP.pack(P.TYPE_FIELD, msg.node, P.GATEWAY_CMD_SDO_UPLOAD_RSP, msg.index, msg.subindex) + value
+            segment = value[msg.offset:msg.offset+self.SEGMENT_SIZE]
+            offset = msg.offset
+            if (msg.offset + self.SEGMENT_SIZE >= len(value)):
+                offset |= GTP_LAST_FLAG
+            return GTP_UPLOAD_RSP_SEG.pack(P.TYPE_FIELD, msg.node, P.GATEWAY_CMD_SDO_UPLOAD_RSP_SEG, msg.index, msg.subindex, offset) + segment
+        if (msg.cmd == P.GATEWAY_CMD_SDO_DOWNLOAD):
+            self.objects[key] = bytes(msg.payload)
+        elif (msg.cmd == P.GATEWAY_CMD_SDO_DOWNLOAD_SEG):
+            value = bytearray(self.objects.get(key, b'') if (msg.offset > 0) else b'')
+            value[msg.offset:msg.offset+len(msg.payload)] = msg.payload
+            self.objects[key] = bytes(value)
+        return self._ack()
+
+    def _run(self):
+        while self._running:
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                break
+            for frame in self._dssp.frames(data):
+                # the data link layer leaves the CRC on, the decoder expects it only on responses
+                msg = self._gtp.decode(frame[:-2])
+                if (msg == None):
+                    continue
+                self.requests.append(msg)
+                if (self.drop > 0):
+                    self.drop -= 1
+                    continue
+                if (self.online) and (msg.msg_type == GATEWAY_MSG_SDO) and (msg.node not in self.online):
+                    if (self.offline_delay != None):
+                        self._send(self._ack(self.ERROR_SDO_ABORTED), self.offline_delay)
+                    continue
+                self._send(self._respond(msg), self.latency)
+
+def main():
+    with SimulatedGateway({(5, 0x1008, 0): b'SatDrive'}) as sim:
+        print( f"Simulated gateway on {sim.port}, Ctrl-C to stop" )
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == "__main__":
+    main()
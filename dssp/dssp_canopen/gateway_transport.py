@@ -17,6 +17,10 @@
 # for transmission over the serial port
 # 
 
+import argparse
+import struct
+import timeit
+
 
 # gateway transport payload types
 GATEWAY_TYPE_BOOL         = 0
@@ -39,7 +43,10 @@ GATEWAY_MSG_SDO     = 1
 GATEWAY_MSG_CAN     = 2
 
 class GatewayTransportMessage:
-    def __init__(self, msg_type=0, cmd=0, error_code=0, node=0, index=0, subindex=0, payload_type=0, offset = 0, last = True, payload=[], cobid=0):
+    __slots__ = ('msg_type', 'cmd', 'error_code', 'node', 'index', 'subindex',
+                 'offset', 'payload_type', 'payload', 'cob_id', 'last')
+
+    def __init__(self, msg_type=0, cmd=0, error_code=0, node=0, index=0, subindex=0, payload_type=0, offset = 0, last = True, payload=b'', cobid=0):
         self.msg_type = msg_type
         self.cmd = cmd
         self.error_code = error_code
@@ -52,6 +59,30 @@ class GatewayTransportMessage:
         self.cob_id = cobid
         self.last = last
 
+    def __repr__(self):
+        return ("GatewayTransportMessage(" +
+                ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__) + ")")
+
+
+# Precompiled frame layouts, all fields little endian.  Offsets are 31 bits
+# with the top bit of the 32 bit field used as the 'last segment' flag.
+GTP_ACK             = struct.Struct("<BBBH")      # type, 0, cmd, error code
+GTP_SDO             = struct.Struct("<BBBHBB")    # type, node, cmd, index, subindex, payload type
+GTP_SDO_SEG         = struct.Struct("<BBBHBBI")   # type, node, cmd, index, subindex, payload type, offset
+GTP_SDO_OFFSET      = struct.Struct("<I")         # optional upload offset
+GTP_UPLOAD_RSP      = struct.Struct("<BBBHB")     # type, node, cmd, index, subindex
+GTP_UPLOAD_RSP_SEG  = struct.Struct("<BBBHBI")    # type, node, cmd, index, subindex, offset
+GTP_CAN             = struct.Struct("<BBI")       # type, 0x80, cob id
+
+GTP_LAST_FLAG       = 0x80000000
+GTP_OFFSET_MASK     = 0x7FFFFFFF
+GTP_CRC_LENGTH      = 2                           # received frames still carry the DSSP CRC
+
+# Frames are short, so packing the header and concatenating the payload
+# is quicker than pack_into a preallocated buffer
+def _pack_frame(header, payload, *fields):
+    return header.pack(*fields) + payload
+
 
 class GatewayTransportProtocol:
     # if the type field is not this, it isn't GTP
@@ -75,38 +106,47 @@ class GatewayTransportProtocol:
 
     def __init__(self):
         self.req_payload_type = 0
+        self._sdo_encoders = {
+            self.GATEWAY_CMD_SDO_DOWNLOAD       : self._encode_sdo_download,
+            self.GATEWAY_CMD_SDO_DOWNLOAD_SEG   : self._encode_sdo_download_seg,
+            self.GATEWAY_CMD_SDO_UPLOAD         : self._encode_sdo_upload,
+        }
+
+    def _encode_sdo_download(self, msg):
+        return _pack_frame(GTP_SDO, bytes(msg.payload), self.TYPE_FIELD, msg.node & 0x7F, self.GATEWAY_CMD_SDO_DOWNLOAD,
+                           msg.index & 0xFFFF, msg.subindex, msg.payload_type)
+
+    def _encode_sdo_download_seg(self, msg):
+        offset = msg.offset & GTP_OFFSET_MASK
+        if (msg.last == True):
+            offset |= GTP_LAST_FLAG
+        self.req_payload_type = msg.payload_type
+        return _pack_frame(GTP_SDO_SEG, bytes(msg.payload), self.TYPE_FIELD, msg.node & 0x7F, self.GATEWAY_CMD_SDO_DOWNLOAD_SEG,
+                           msg.index & 0xFFFF, msg.subindex, msg.payload_type, offset)
+
+    def _encode_sdo_upload(self, msg):
+        self.req_payload_type = msg.payload_type
+        offset = b''
+        if (msg.offset != 0):
+            offset = GTP_SDO_OFFSET.pack(msg.offset & GTP_OFFSET_MASK)
+        return _pack_frame(GTP_SDO, offset, self.TYPE_FIELD, msg.node & 0x7F, self.GATEWAY_CMD_SDO_UPLOAD,
+                           msg.index & 0xFFFF, msg.subindex, msg.payload_type)
 
     ''' 
         Returns a byte array representation of the gateway transport protocol frame
         See ICD for details of message structure
     '''
     def encode(self, msg ):
-        if (msg.msg_type == GATEWAY_MSG_ACK):
-            b = [self.TYPE_FIELD, 0, self.GATEWAY_CMD_ACK, msg.error_code & 0xFF, (msg.error_code<<8) & 0xFF]            
-        elif (msg.msg_type == GATEWAY_MSG_SDO):
-            if (msg.cmd == self.GATEWAY_CMD_SDO_DOWNLOAD):
-                b = [self.TYPE_FIELD, msg.node & 0x7F, self.GATEWAY_CMD_SDO_DOWNLOAD, msg.index & 0xFF, (msg.index >> 8) & 0xFF, msg.subindex, msg.payload_type ]
-                b += bytes(msg.payload)
-            elif (msg.cmd == self.GATEWAY_CMD_SDO_DOWNLOAD_SEG ):
-                if (msg.last == True):
-                    last_flag = 0x80
-                else:
-                    last_flag = 0
-                b = [self.TYPE_FIELD, msg.node & 0x7F, self.GATEWAY_CMD_SDO_DOWNLOAD_SEG, msg.index & 0xFF, (msg.index >> 8) & 0xFF, msg.subindex, msg.payload_type, 
-                     msg.offset & 0xFF, (msg.offset>>8) & 0xFF, (msg.offset>>16) & 0xFF, (msg.offset>>24) & 0x7F | last_flag ]
-                b += bytes(msg.payload)
-                self.req_payload_type = msg.payload_type
-            elif (msg.cmd == self.GATEWAY_CMD_SDO_UPLOAD ):
-                b = [self.TYPE_FIELD, msg.node & 0x7F, self.GATEWAY_CMD_SDO_UPLOAD, msg.index & 0xFF, (msg.index >> 8) & 0xFF, msg.subindex, msg.payload_type ]
-                if (msg.offset != 0):
-                    b += [msg.offset & 0xFF, (msg.offset>>8) & 0xFF, (msg.offset>>16) & 0xFF, (msg.offset>>24) & 0x7F]
-                self.req_payload_type = msg.payload_type
+        if (msg.msg_type == GATEWAY_MSG_SDO):
+            encoder = self._sdo_encoders.get(msg.cmd)
+            if (encoder != None):
+                return encoder(msg)
+        elif (msg.msg_type == GATEWAY_MSG_ACK):
+            # only the low byte of the error code is sent, the high byte is always 0
+            return GTP_ACK.pack(self.TYPE_FIELD, 0, self.GATEWAY_CMD_ACK, msg.error_code & 0xFF)
         elif (msg.msg_type == GATEWAY_MSG_CAN):
-            b = [self.TYPE_FIELD, 0x80, msg.cob_id & 0xFF, (msg.cob_id >>8)& 0xFF, (msg.cob_id >>16)& 0xFF, (msg.cob_id >>24)& 0xFF ]
-            b += bytes(msg.payload)
-        else:
-            b=[]
-        return bytes(b)
+            return _pack_frame(GTP_CAN, bytes(msg.payload), self.TYPE_FIELD, 0x80, msg.cob_id & 0xFFFFFFFF)
+        return b''
 
     '''
         Returns gateway message, parsed from raw frame bytes
@@ -179,11 +219,110 @@ class GatewayTransportProtocol:
                 msg.payload  = frame[6:-2]
             return msg
 
+
+# Original list based encoder, kept as the reference for the struct based one.
+# Decoding keeps the original code: building the message costs far more than
+# reading the fields, and struct unpacking measured no faster (see bench)
+class _ReferenceGatewayTransportProtocol(GatewayTransportProtocol):
+    def encode(self, msg ):
+        if (msg.msg_type == GATEWAY_MSG_ACK):
+            b = [self.TYPE_FIELD, 0, self.GATEWAY_CMD_ACK, msg.error_code & 0xFF, (msg.error_code<<8) & 0xFF]            
+        elif (msg.msg_type == GATEWAY_MSG_SDO):
+            if (msg.cmd == self.GATEWAY_CMD_SDO_DOWNLOAD):
+                b = [self.TYPE_FIELD, msg.node & 0x7F, self.GATEWAY_CMD_SDO_DOWNLOAD, msg.index & 0xFF, (msg.index >> 8) & 0xFF, msg.subindex, msg.payload_type ]
+                b += bytes(msg.payload)
+            elif (msg.cmd == self.GATEWAY_CMD_SDO_DOWNLOAD_SEG ):
+                if (msg.last == True):
+                    last_flag = 0x80
+                else:
+                    last_flag = 0
+                b = [self.TYPE_FIELD, msg.node & 0x7F, self.GATEWAY_CMD_SDO_DOWNLOAD_SEG, msg.index & 0xFF, (msg.index >> 8) & 0xFF, msg.subindex, msg.payload_type, 
+                     msg.offset & 0xFF, (msg.offset>>8) & 0xFF, (msg.offset>>16) & 0xFF, (msg.offset>>24) & 0x7F | last_flag ]
+                b += bytes(msg.payload)
+                self.req_payload_type = msg.payload_type
+            elif (msg.cmd == self.GATEWAY_CMD_SDO_UPLOAD ):
+                b = [self.TYPE_FIELD, msg.node & 0x7F, self.GATEWAY_CMD_SDO_UPLOAD, msg.index & 0xFF, (msg.index >> 8) & 0xFF, msg.subindex, msg.payload_type ]
+                if (msg.offset != 0):
+                    b += [msg.offset & 0xFF, (msg.offset>>8) & 0xFF, (msg.offset>>16) & 0xFF, (msg.offset>>24) & 0x7F]
+                self.req_payload_type = msg.payload_type
+        elif (msg.msg_type == GATEWAY_MSG_CAN):
+            b = [self.TYPE_FIELD, 0x80, msg.cob_id & 0xFF, (msg.cob_id >>8)& 0xFF, (msg.cob_id >>16)& 0xFF, (msg.cob_id >>24)& 0xFF ]
+            b += bytes(msg.payload)
+        else:
+            b=[]
+        return bytes(b)
+
+
+def _test_messages():
+    P = GatewayTransportProtocol
+    return [
+        GatewayTransportMessage(GATEWAY_MSG_ACK, P.GATEWAY_CMD_ACK, error_code = 9),
+        GatewayTransportMessage(GATEWAY_MSG_ACK, P.GATEWAY_CMD_ACK, error_code = 0x1FE),
+        GatewayTransportMessage(GATEWAY_MSG_SDO, P.GATEWAY_CMD_SDO_DOWNLOAD, node = 5, index = 0x2612, subindex = 7,
+                                payload_type = GATEWAY_TYPE_UINT16, payload = b'\x4c\x0b'),
+        GatewayTransportMessage(GATEWAY_MSG_SDO, P.GATEWAY_CMD_SDO_DOWNLOAD_SEG, node = 5, index = 0x1F50, subindex = 2,
+                                payload_type = GATEWAY_TYPE_DOMAIN, payload = bytes(range(64)), offset = 0x12345, last = False),
+        GatewayTransportMessage(GATEWAY_MSG_SDO, P.GATEWAY_CMD_SDO_DOWNLOAD_SEG, node = 5, index = 0x1F50, subindex = 2,
+                                payload_type = GATEWAY_TYPE_DOMAIN, payload = b'\x01', offset = 128, last = True),
+        GatewayTransportMessage(GATEWAY_MSG_SDO, P.GATEWAY_CMD_SDO_UPLOAD, node = 5, index = 0x2018, subindex = 1,
+                                payload_type = GATEWAY_TYPE_DOMAIN),
+        GatewayTransportMessage(GATEWAY_MSG_SDO, P.GATEWAY_CMD_SDO_UPLOAD, node = 5, index = 0x2018, subindex = 1,
+                                payload_type = GATEWAY_TYPE_DOMAIN, offset = 4096),
+        GatewayTransportMessage(GATEWAY_MSG_CAN, payload = [129, 5], cobid = 0x705),
+    ]
+
+# Frames as they come out of the data link layer, still carrying the CRC
+def _test_frames():
+    P = GatewayTransportProtocol
+    crc = b'\xA5\x5A'
+    return [
+        bytes([P.TYPE_FIELD, 0, P.GATEWAY_CMD_ACK, 9, 0]) + crc,
+        bytes([P.TYPE_FIELD, 5, P.GATEWAY_CMD_SDO_UPLOAD_RSP, 0x12, 0x26, 5, 0x4c, 0x0b]) + crc,
+        bytes([P.TYPE_FIELD, 5, P.GATEWAY_CMD_SDO_UPLOAD_RSP_SEG, 0x18, 0x20, 1, 0x40, 0, 0, 0]) + bytes(range(64)) + crc,
+        bytes([P.TYPE_FIELD, 5, P.GATEWAY_CMD_SDO_UPLOAD_RSP_SEG, 0x18, 0x20, 1, 0x80, 0, 0, 0x80]) + bytes(range(8)) + crc,
+        bytes([P.TYPE_FIELD, 0x80, 0x85, 0x01, 0, 0, 1, 2, 3, 4]) + crc,
+    ] + [bytes(P().encode(msg)) + crc for msg in _test_messages()[2:-1]]
+
+def _fields(msg):
+    return tuple(bytes(v) if (name == 'payload') else getattr(msg, name) for name, v in
+                 ((name, getattr(msg, name)) for name in GatewayTransportMessage.__slots__))
+
+def bench( count = 20000 ):
+    gtp = GatewayTransportProtocol()
+    ref = _ReferenceGatewayTransportProtocol()
+    messages = _test_messages()
+    frames = _test_frames()
+    n = count // len(messages)
+    print( f"Gateway transport encode/decode, {n * len(messages)} messages")
+    for name, proto in (("reference", ref), ("struct", gtp)):
+        t = min(timeit.repeat(lambda: [proto.encode(m) for m in messages], number=n, repeat=11))
+        print( '%-12s' % name, f"encode : {n*len(messages)/t:12.0f} frames/s" )
+    t = min(timeit.repeat(lambda: [gtp.decode(f) for f in frames], number=n, repeat=11))
+    print( '%-12s' % "", f"decode : {n*len(frames)/t:12.0f} frames/s" )
+
 def main():
-    # unit tests
-    return
-    
-    
+    cmd_line = argparse.ArgumentParser(description="Gateway transport protocol tests")
+    cmd_line.add_argument("-b", "--bench", help="Run benchmarks instead of tests", action="store_true")
+    args = cmd_line.parse_args()
+
+    if (args.bench):
+        bench()
+        return
+
+    # the struct encoder must produce exactly what the reference does, and a
+    # frame must decode the same given as bytes or as a list
+    gtp = GatewayTransportProtocol()
+    ref = _ReferenceGatewayTransportProtocol()
+    for msg in _test_messages():
+        if (gtp.encode(msg) != ref.encode(msg)):
+            print( "Fail GTP encode", msg )
+            exit(-1)
+    for frame in _test_frames():
+        if (_fields(gtp.decode(frame)) != _fields(ref.decode(list(frame)))):
+            print( "Fail GTP decode", frame.hex() )
+            exit(-1)
+
+    print( "Pass all gateway transport tests")
 
 if __name__ == "__main__":
     main()
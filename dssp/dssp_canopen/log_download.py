@@ -0,0 +1,248 @@
+#!/bin/python
+#
+#               /|\
+#              / | \
+#             /  |  \
+#            /   |   \
+#           /   / \   \
+#          /   //|\\   \
+#         /   // | \\   \  (c) Dawn Aerospace Ltd
+#        /___//_/ \_\\___\  www.dawnaerospace.com
+#
+# @file log_download.py
+# @brief Pipelined, resumable download of SatDrive log regions
+#
+# LogDownload reads a log region (OD[0x2018]) with up to 'window' segment
+# uploads in flight.  The log length is not known up front, so the first
+# segment gives the segment size and uploads are issued ahead at fixed offsets
+# until a segment flagged 'last' (or a short one) marks the end.  Segments are
+# written in place into a file grown in large steps, and a sidecar checkpoint
+# '<file>.ckpt' records the length of data confirmed on disk, so an
+# interrupted download resumes from there instead of offset 0.  The
+# checkpoint is removed once the region is complete.
+#
+# Each segment is written at the offset its response carries.  A response
+# for another offset than the one requested is not trusted, the segment is
+# requested again.
+#
+
+import argparse
+import concurrent.futures
+import json
+import os
+import time
+
+from dssp_canopen.gateway_transport import *
+from dssp_canopen.canopen_gateway import CanOpenGatewayError, CanOpenGatewayTimeoutError
+
+
+class LogDownload:
+    INDEX_DATA       = 0x2018
+    WINDOW           = 8
+    RETRIES          = 3
+    PREALLOCATE      = 256 * 1024
+    CHECKPOINT_INTERVAL = 0.5
+
+    # progress(region, bytes_confirmed, elapsed_seconds) is called as segments
+    # arrive.  timeout overrides the gateway's RSP_TIMEOUT for each attempt
+    def __init__(self, gw, node_id, window = None, retries = None, progress = None, timeout = None):
+        self.gw = gw
+        self.node_id = node_id
+        self.window = window if (window != None) else max(getattr(gw, 'window', 1), 1)
+        self.retries = retries if (retries != None) else self.RETRIES
+        self.progress = progress
+        self.timeout = timeout
+        self.retransmit_count = 0
+        self.resumed_from = 0
+        self.elapsed = 0.0
+
+    @staticmethod
+    def checkpoint_file( filename ):
+        return filename + ".ckpt"
+
+    def _read_checkpoint( self, filename, region ):
+        try:
+            with open(self.checkpoint_file(filename)) as f:
+                state = json.load(f)
+            if (state["node"] == self.node_id) and (state["region"] == region) and (os.path.getsize(filename) >= state["offset"]):
+                return state["offset"], state["segment"]
+        except (OSError, ValueError, KeyError):
+            pass
+        return 0, None
+
+    def _write_checkpoint( self, fd, filename, region, offset, segment ):
+        os.fsync(fd)                        # the data has to be on disk before the checkpoint says so
+        tmp = self.checkpoint_file(filename) + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(dict(node = self.node_id, region = region, offset = offset, segment = segment), f)
+        os.replace(tmp, self.checkpoint_file(filename))
+
+    def _upload( self, region, offset ):
+        return self.gw.upload_async(self.node_id, self.INDEX_DATA, region, GATEWAY_TYPE_DOMAIN, offset, self.timeout, with_offset = True)
+
+    # Requests the segment at offset again, False once it is out of retries
+    def _retry( self, region, offset, attempts, inflight ):
+        attempts[offset] = attempts.get(offset, 0) + 1
+        if (attempts[offset] > self.retries):
+            return False
+        self.retransmit_count += 1
+        inflight[self._upload(region, offset)] = offset
+        return True
+
+    # Downloads a log region to filename and returns its length.  With resume
+    # an interrupted download of the same node and region carries on from its
+    # checkpoint
+    def download( self, region, filename, resume = True ):
+        start, segment = self._read_checkpoint(filename, region) if (resume) else (0, None)
+        self.resumed_from = start
+        starttime = time.monotonic()
+        confirmed = start                   # everything before this is on disk
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if (start == 0):
+                os.ftruncate(fd, 0)
+            allocated = os.fstat(fd).st_size
+            received = dict()               # offset -> length, of segments beyond the confirmed data
+            attempts = dict()
+            inflight = dict()               # future -> offset
+            end = None                      # log length, once the last segment is seen
+            checkpointed = time.monotonic()
+            next_offset = start
+            if (segment == None):
+                inflight[self._upload(region, start)] = start      # the first segment sets the segment size
+                next_offset = None
+            while (end == None) or (confirmed < end):
+                while (end == None) and (next_offset != None) and (len(inflight) < self.window):
+                    inflight[self._upload(region, next_offset)] = next_offset
+                    next_offset += segment
+                done, not_done = concurrent.futures.wait(inflight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    offset = inflight.pop(future)
+                    if (end != None) and (offset >= end):
+                        continue                # read ahead past the end of the log
+                    try:
+                        data, last, rsp_offset = future.result()
+                    except CanOpenGatewayError:
+                        if not (self._retry(region, offset, attempts, inflight)):
+                            raise
+                        continue
+                    if (rsp_offset != offset):
+                        # the answer to another request, ask for this segment again
+                        if not (self._retry(region, offset, attempts, inflight)):
+                            raise CanOpenGatewayTimeoutError()
+                        continue
+                    if (segment == None):
+                        segment = max(len(data), 1)
+                        next_offset = offset + segment
+                    if (len(data) > 0):
+                        if (offset + len(data) > allocated):
+                            allocated = offset + len(data) + self.PREALLOCATE
+                            os.ftruncate(fd, allocated)
+                        os.pwrite(fd, data, offset)
+                    received[offset] = len(data)
+                    if (last) or (len(data) < segment):
+                        end = offset + len(data) if (end == None) else min(end, offset + len(data))
+                while (confirmed in received) and (received[confirmed] > 0):
+                    confirmed += received.pop(confirmed)
+                if (end != None) and (confirmed in received):
+                    received.pop(confirmed)     # empty segment at the end
+                if (time.monotonic() - checkpointed >= self.CHECKPOINT_INTERVAL):
+                    self._write_checkpoint(fd, filename, region, confirmed, segment)
+                    checkpointed = time.monotonic()
+                if (self.progress != None):
+                    self.progress(region, confirmed, time.monotonic() - starttime)
+            os.ftruncate(fd, end)
+            os.fsync(fd)
+        except BaseException:
+            if (segment != None):
+                self._write_checkpoint(fd, filename, region, confirmed, segment)
+            raise
+        finally:
+            os.close(fd)
+        try:
+            os.remove(self.checkpoint_file(filename))
+        except FileNotFoundError:
+            pass
+        self.elapsed = time.monotonic() - starttime
+        return end
+
+def _self_test(window, size):
+    import tempfile
+    from dssp_canopen.gateway_sim import SimulatedGateway
+    from dssp_canopen.canopen_gateway import CanOpenGateway
+    logs = {region: os.urandom(size + region * 7) for region in (1, 2)}
+    logs[3] = b''
+    logs[4] = os.urandom(2 * SimulatedGateway.SEGMENT_SIZE)
+    objects = {(5, LogDownload.INDEX_DATA, region): log for region, log in logs.items()}
+    with tempfile.TemporaryDirectory() as directory, SimulatedGateway(objects, latency = 0.02) as sim:
+        gw = CanOpenGateway(sim.port, window = window)
+        for w in (1, window):
+            engine = LogDownload(gw, 5, w)
+            filename = os.path.join(directory, f"log{w}.bin")
+            length = engine.download(1, filename)
+            with open(filename, "rb") as f:
+                if (length != len(logs[1])) or (f.read() != logs[1]):
+                    print( f"Fail log download with window {w}" )
+                    exit(-1)
+            print( f"{length} bytes with window {w} in {engine.elapsed:.2f}s, {length/engine.elapsed/1e3:.1f} kB/s" )
+        for region in (3, 4):
+            filename = os.path.join(directory, f"region{region}.bin")
+            if (engine.download(region, filename) != len(logs[region])) or (open(filename, "rb").read() != logs[region]):
+                print( f"Fail log download of region {region}" )
+                exit(-1)
+        # interrupt a download, then resume it
+        filename = os.path.join(directory, "resume.bin")
+        def interrupt(region, confirmed, elapsed):
+            if (confirmed >= size // 2):
+                raise KeyboardInterrupt
+        engine = LogDownload(gw, 5, window, progress = interrupt)
+        try:
+            engine.download(2, filename)
+            print( "Fail log download interrupt" )
+            exit(-1)
+        except KeyboardInterrupt:
+            pass
+        engine = LogDownload(gw, 5, window)
+        requests = len(sim.requests)
+        length = engine.download(2, filename)
+        if (engine.resumed_from < size // 2) or (open(filename, "rb").read() != logs[2]) or os.path.exists(LogDownload.checkpoint_file(filename)):
+            print( "Fail log download resume" )
+            exit(-1)
+        print( f"Resumed at {engine.resumed_from} of {length} bytes with {len(sim.requests) - requests} requests" )
+        # lose a request mid download, then answer one segment with another
+        lost = []
+        def lose(region, confirmed, elapsed):
+            if (confirmed >= size // 2) and not (lost):
+                lost.append(confirmed)
+                sim.drop = 1
+        engine = LogDownload(gw, 5, 4, progress = lose, timeout = 0.1)
+        filename = os.path.join(directory, "lost.bin")
+        retransmits = gw.retransmit_count
+        if (engine.download(1, filename) != len(logs[1])) or (open(filename, "rb").read() != logs[1]) or (gw.retransmit_count == retransmits):
+            print( "Fail log download with a lost request" )
+            exit(-1)
+        engine = LogDownload(gw, 5, 4)
+        upload = engine._upload
+        swapped = []
+        def swap(region, offset):
+            if (offset == SimulatedGateway.SEGMENT_SIZE) and not (swapped):
+                swapped.append(offset)
+                return upload(region, offset + (1 << 20))      # an offset the engine never asks for
+            return upload(region, offset)
+        engine._upload = swap
+        filename = os.path.join(directory, "swapped.bin")
+        if (engine.download(1, filename) != len(logs[1])) or (open(filename, "rb").read() != logs[1]) or (engine.retransmit_count != 1):
+            print( "Fail log download with a misplaced segment" )
+            exit(-1)
+
+def main():
+    cmd_line = argparse.ArgumentParser(description="Log download test against a simulated gateway")
+    cmd_line.add_argument("-w", "--window", help="Segments in flight", type=int, default=LogDownload.WINDOW)
+    cmd_line.add_argument("-n", "--size", help="Log size", type=int, default=16384)
+    args = cmd_line.parse_args()
+
+    _self_test(args.window, args.size)
+    print( "Pass all log download tests" )
+
+if __name__ == "__main__":
+    main()
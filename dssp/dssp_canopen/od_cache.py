@@ -0,0 +1,171 @@
+#!/bin/python
+#
+#               /|\
+#              / | \
+#             /  |  \
+#            /   |   \
+#           /   / \   \
+#          /   //|\\   \
+#         /   // | \\   \  (c) Dawn Aerospace Ltd
+#        /___//_/ \_\\___\  www.dawnaerospace.com
+#
+# @file od_cache.py
+# @brief Cached object dictionary loading
+#
+# Parsing an EDS file takes tens of milliseconds per node.  load_eds() keeps
+# the parsed object dictionary, together with a table of the gateway payload
+# type of every object, in an in-memory LRU and in a pickle on disk.  Both are
+# keyed on the EDS path, its modification time and size, the node id and the
+# canopen version, so an edited EDS is parsed again.
+#
+# The disk cache lives in $DSSP_OD_CACHE, or ~/.cache/dssp_canopen.  Set
+# DSSP_OD_CACHE to an empty string to disable it.
+#
+# Object dictionaries from the cache are shared, treat them as read only.
+#
+
+import argparse
+import collections
+import hashlib
+import os
+import pickle
+import threading
+import time
+import canopen
+
+from dssp_canopen.gateway_transport import *
+
+
+# Gateway payload types of the fixed size CANopen data types
+CANOPEN_PAYLOAD_TYPES = {
+    canopen.objectdictionary.BOOLEAN    : GATEWAY_TYPE_BOOL,
+    canopen.objectdictionary.INTEGER8   : GATEWAY_TYPE_INT8,
+    canopen.objectdictionary.INTEGER16  : GATEWAY_TYPE_INT16,
+    canopen.objectdictionary.INTEGER32  : GATEWAY_TYPE_INT32,
+    canopen.objectdictionary.INTEGER64  : GATEWAY_TYPE_INT64,
+    canopen.objectdictionary.UNSIGNED8  : GATEWAY_TYPE_UINT8,
+    canopen.objectdictionary.UNSIGNED16 : GATEWAY_TYPE_UINT16,
+    canopen.objectdictionary.UNSIGNED32 : GATEWAY_TYPE_UINT32,
+    canopen.objectdictionary.UNSIGNED64 : GATEWAY_TYPE_UINT64,
+    canopen.objectdictionary.REAL32     : GATEWAY_TYPE_REAL32,
+    canopen.objectdictionary.REAL64     : GATEWAY_TYPE_REAL64,
+}
+
+OD_CACHE_SIZE = 16
+OD_CACHE_ENV  = "DSSP_OD_CACHE"
+
+_od_cache = collections.OrderedDict()       # key -> (od, types), most recently used last
+_od_cache_lock = threading.Lock()
+
+# Returns {(index, subindex): payload_type} for every variable in od.  Strings
+# are GATEWAY_TYPE_STRING, everything that is not fixed size is GATEWAY_TYPE_DOMAIN
+def od_payload_types( od ):
+    types = dict()
+    for obj in od.values():
+        variables = obj.values() if isinstance(obj, (canopen.objectdictionary.ODRecord, canopen.objectdictionary.ODArray)) else [obj]
+        for var in variables:
+            if (var.data_type == canopen.objectdictionary.VISIBLE_STRING):
+                payload_type = GATEWAY_TYPE_STRING
+            else:
+                payload_type = CANOPEN_PAYLOAD_TYPES.get(var.data_type, GATEWAY_TYPE_DOMAIN)
+            types[(var.index, var.subindex)] = payload_type
+    return types
+
+def _cache_dir():
+    return os.environ.get(OD_CACHE_ENV, os.path.join(os.path.expanduser("~"), ".cache", "dssp_canopen"))
+
+def _cache_key( edsfile, node_id ):
+    path = os.path.abspath(edsfile)
+    st = os.stat(path)
+    return (path, st.st_mtime_ns, st.st_size, node_id, canopen.__version__)
+
+def _cache_file( key ):
+    directory = _cache_dir()
+    if not (directory):
+        return None
+    return os.path.join(directory, hashlib.sha1(repr(key).encode()).hexdigest() + ".pickle")
+
+def _load_pickle( key ):
+    filename = _cache_file(key)
+    try:
+        with open(filename, "rb") as f:
+            cached_key, entry = pickle.load(f)
+        if (cached_key == key):
+            return entry
+    except Exception:
+        pass                                    # missing, stale or unreadable, parse the EDS again
+    return None
+
+def _save_pickle( key, entry ):
+    filename = _cache_file(key)
+    if (filename == None):
+        return
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok = True)
+        tmp = f"{filename}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump((key, entry), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, filename)               # readers never see a partial file
+    except OSError:
+        pass
+
+# Returns (od, types) for the EDS file, see od_payload_types for types.
+# Without a file the object dictionary is empty, as with import_od.
+def load_eds( edsfile, node_id = None ):
+    if not (edsfile):
+        return canopen.objectdictionary.ObjectDictionary(), dict()
+    key = _cache_key(edsfile, node_id)
+    with _od_cache_lock:
+        entry = _od_cache.get(key)
+        if (entry != None):
+            _od_cache.move_to_end(key)
+            return entry
+    entry = _load_pickle(key)
+    if (entry == None):
+        od = canopen.objectdictionary.import_od(edsfile, node_id)
+        entry = (od, od_payload_types(od))
+        _save_pickle(key, entry)
+    with _od_cache_lock:
+        _od_cache[key] = entry
+        while (len(_od_cache) > OD_CACHE_SIZE):
+            _od_cache.popitem(last = False)
+    return entry
+
+# Returns the object dictionary of the EDS file
+def load_od( edsfile, node_id = None ):
+    return load_eds(edsfile, node_id)[0]
+
+def clear_cache():
+    with _od_cache_lock:
+        _od_cache.clear()
+
+def main():
+    cmd_line = argparse.ArgumentParser(description="Object dictionary cache test")
+    cmd_line.add_argument("-e", "--eds", help="EDS file", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SatDriveController-v1.3.4.eds"))
+    cmd_line.add_argument("-n", "--node", help="Node id", type=int, default=5)
+    args = cmd_line.parse_args()
+
+    start = time.perf_counter()
+    reference = canopen.objectdictionary.import_od(args.eds, args.node)
+    parse = time.perf_counter() - start
+    clear_cache()
+    start = time.perf_counter()
+    od, types = load_eds(args.eds, args.node)
+    first = time.perf_counter() - start
+    clear_cache()
+    start = time.perf_counter()
+    od, types = load_eds(args.eds, args.node)
+    disk = time.perf_counter() - start
+    start = time.perf_counter()
+    if (load_od(args.eds, args.node) is not od):
+        print( "Fail memory cache" )
+        exit(-1)
+    memory = time.perf_counter() - start
+    if (od_payload_types(reference) != types) or (sorted(reference.keys()) != sorted(od.keys())):
+        print( "Fail cached object dictionary" )
+        exit(-1)
+    print( f"import_od {parse*1e3:.1f}ms, first load {first*1e3:.1f}ms, disk cache {disk*1e3:.1f}ms, memory cache {memory*1e6:.1f}us" )
+    print( "Pass all object dictionary cache tests" )
+
+if __name__ == "__main__":
+    main()
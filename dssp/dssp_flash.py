@@ -0,0 +1,94 @@
+#!/bin/python
+#
+#               /|\
+#              / | \
+#             /  |  \
+#            /   |   \
+#           /   / \   \
+#          /   //|\\   \
+#         /   // | \\   \  (c) Dawn Aerospace Ltd
+#        /___//_/ \_\\___\  www.dawnaerospace.com
+#
+# @brief DSSP SatDrive multi-node bootloader
+#
+# Flash several SatDrive nodes at once over one DSSP serial port.  The manifest
+# lists one node per line as 'node_id file [region]', e.g.
+#
+#   5   Controller-DA18-01-30-10-10-v1.3.4.bin
+#   10  Feedline-DA18-01-30-30-10-v1.3.4.bin
+#   11  Tank-DA18-01-30-30-10-v1.3.4.bin
+#   12  Thruster-DA18-01-30-30-10-v1.3.4.bin
+#
+
+import time
+import argparse
+import json
+import dssp_canopen as dssp
+from dssp_canopen.flash import flash_nodes, flash_report, read_manifest
+
+def main():
+    parser = argparse.ArgumentParser(description="Dawn Aerospace DSSP CANopen multi-node bootloader")
+    parser.add_argument("manifest", help="Manifest of 'node_id file [region]' lines" )
+    parser.add_argument("device", help="The serial interface, typical /dev/ttyUSB0)")
+    parser.add_argument("-b", "--baud_rate", help="Serial baud rate", type=int, default=115200)
+    parser.add_argument("-s", "--size", help="Block size, typical 64", type=int, choices=range(1,65,1), metavar="[1-64]", default =64)
+    parser.add_argument("-w", "--window", help="Blocks queued per node, the gateway sends one at a time", type=int, default=1)
+    parser.add_argument("-x", "--execute", help="Execute the new images", action="store_true")
+    parser.add_argument("-u", "--skip_unchanged", help="Don't erase and download nodes whose region signature matches the file", action="store_true")
+    parser.add_argument("-y", "--confirm", help="Answer yes to any questions", action="store_true")
+    parser.add_argument("-o", "--output", help="Write the report as JSON")
+
+    args = parser.parse_args()
+
+    print( "Dawn Aerospace (c) 2021")
+    try:
+        jobs = read_manifest(args.manifest)
+    except (OSError, ValueError) as err:
+        print( err )
+        return
+
+    for job in jobs:
+        print( f"Node {job.node_id:3d} region {job.region} : {job.filename}" )
+    if not (args.confirm):
+        ch = input( f"Erase and flash {len(jobs)} nodes? [y/N]" )
+        if (ch[:1].upper() != 'Y'):
+            print( "Exiting")
+            return
+
+    print( "Starting DSSP bootloader on ", args.device )
+    # ACKs carry nothing to tell the nodes apart, so one lost frame could corrupt another
+    # node's image with more than one request outstanding on the shared gateway
+    gateway = dssp.CanOpenGateway(args.device, args.baud_rate, 1)
+
+    acked = dict()
+    shown = [0.0]
+    def progress(job, done, total, elapsed):
+        acked[job.node_id] = done
+        if (time.time() - shown[0] < 0.2) and (done < total):
+            return
+        shown[0] = time.time()
+        print( "\r" + "  ".join(f"{node}:{n/1e3:.1f}k" for node, n in sorted(acked.items())) + " ", end='', flush=True)
+
+    starttime = time.time()
+    flash_nodes(gateway, jobs, args.size, args.window, progress, args.execute, args.skip_unchanged)
+    print( f"\rFlashed {len(jobs)} nodes in {time.time() - starttime:.1f} s" )
+    print()
+    for line in flash_report(jobs):
+        print( line )
+
+    if (args.output):
+        with open(args.output, "w") as f:
+            json.dump([dict(node = job.node_id, file = job.filename, region = job.region, status = job.status, error = job.error,
+                            length = job.length, region_length = job.region_length, old_signature = job.old_signature,
+                            expected = job.expected, signature = job.signature, retransmits = job.retransmit_count,
+                            times = job.times) for job in jobs], f, indent = 2)
+
+    # print some stats before we exit
+    print()
+    print( f"Tx count   {gateway.tx_count}")
+    print( f"Tx ack     {gateway.tx_ack}")
+    print( f"Rx count   {gateway.rx_count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+#!/bin/python
+#
+#               /|\
+#              / | \
+#             /  |  \
+#            /   |   \
+#           /   / \   \
+#          /   //|\\   \
+#         /   // | \\   \  (c) Dawn Aerospace Ltd
+#        /___//_/ \_\\___\  www.dawnaerospace.com
+#
+# @file log_decoder.py
+# @brief Vectorised decoder for DSSP binary logs
+#
+# A log is a sequence of records
+#
+#   version (1 byte, 0xFF marks erased flash)
+#   length  (1 byte, of the whole record)
+#   time    (4 bytes)
+#   payload (length - 6 bytes, the first byte is the log type)
+#
+# The log is memory mapped and walked once to find where every record starts.
+# Records are then grouped by log type and payload length, and each group is
+# decoded in one go with the NumPy structured dtype of its layout in
+# log_records, giving one array per column.  The columns are the same as
+# log_to_csv's state_change produces.
+#
+
+import argparse
+import mmap
+import time
+import numpy as np
+from log_records import LOG_RECORDS, log_layout, table_name
+
+TABLE_FORMATS = {"parquet" : ".parquet", "feather" : ".feather", "csv" : ".csv"}
+MANIFEST = "manifest.json"
+
+RECORD_HEADER = 6
+ERASED = 0xFF
+
+# Walks the records of buf and returns the (offsets, lengths) of the records
+# read_record would read, stopping at erased flash, a bad length, a zero time
+# or the end of the data.  Lengths are cut short by the end of the data, so a
+# length of RECORD_HEADER or less is a record without a payload.  Only the
+# version and length bytes are looked at record by record, the times are
+# checked together afterwards.  With archive, several logs one after the other
+# (as a flash dump of several regions) are read through, carrying on after
+# the erased flash at the end of each
+def index_log( buf, archive = False ):
+    size = len(buf)
+    offsets = []
+    append = offsets.append
+    off = 0
+    while (off + 1 < size):
+        n = buf[off + 1]
+        if (buf[off] == ERASED):
+            if not (archive):
+                break
+            off = _skip_erased(buf, off)
+            continue
+        if (n <= 6) or (n >= 255):
+            break
+        append(off)
+        off += n
+    data = np.frombuffer(buf, dtype=np.uint8)
+    offsets = np.array(offsets, dtype=np.int64)
+    zero = np.nonzero(_record_times(data, offsets) == 0)[0]
+    if (len(zero)):
+        offsets = offsets[:zero[0]]
+    lengths = np.minimum(data[offsets + 1].astype(np.int64), size - offsets)
+    return offsets, lengths
+
+# Offset of the first byte after the erased flash at off
+def _skip_erased( buf, off, block = 65536 ):
+    data = np.frombuffer(buf, dtype=np.uint8)
+    while (off < len(data)):
+        used = np.flatnonzero(data[off:off + block] != ERASED)
+        if (len(used)):
+            return off + int(used[0])
+        off += block
+    return len(data)
+
+# Times of the records at offsets, zero padded when cut short by the end of data
+def _record_times( data, offsets ):
+    positions = offsets[:, None] + 2 + np.arange(4)
+    times = np.zeros((len(offsets), 4), dtype=np.uint8)
+    inside = positions < len(data)
+    times[inside] = data[positions[inside]]
+    return times.view("<u4")[:, 0].astype(np.int64)
+
+# Returns a (records, width) array of the payloads starting at offsets, zero
+# padded to width
+def _payloads( data, offsets, length, width ):
+    rows = np.zeros((len(offsets), max(width, length)), dtype=np.uint8)
+    rows[:, :length] = data[(offsets + RECORD_HEADER)[:, None] + np.arange(length)]
+    return rows
+
+# Decodes the payloads at offsets, all of the same length, with layout.
+# Returns a dict of field -> array, or list of str for hex fields
+def _decode_group( data, offsets, length, layout ):
+    rows = _payloads(data, offsets, length, layout.size)
+    columns = dict()
+    if (layout.int_fields):
+        fixed = rows if (rows.shape[1] == layout.size) else np.ascontiguousarray(rows[:, :layout.size])
+        records = fixed.view(layout.dtype)[:, 0]
+        for name, offset, size in layout.int_fields:
+            columns[name] = records[name]
+    for name, offset, size in layout.hex_fields:
+        end = length if (size == None) else min(offset + size, length)
+        w = 2 * max(end - offset, 0)
+        text = np.ascontiguousarray(rows[:, offset:max(end, offset)]).tobytes().hex()
+        columns[name] = [text[i*w:(i+1)*w] for i in range(len(offsets))]
+    return {name: columns[name] for name in layout.names}
+
+# Column order and the integer columns with gaps of the wide table of records
+# at offsets, as pandas makes them from state_change: the columns come in the
+# order state_change sets them when every row has the same ones, and sorted
+# otherwise, and integer columns with gaps are float64 with NaN
+def log_columns( data, offsets, lengths ):
+    keys = data[offsets + RECORD_HEADER].astype(np.int64) * 256 + lengths - RECORD_HEADER
+    layouts = set()
+    for key in np.unique(keys).tolist():
+        layout = log_layout(*divmod(key, 256))
+        layouts.add(tuple(layout.names) if (layout != None) else ())
+    if (len(layouts) == 1):
+        order = ["t", "u", "log_id"] + list(layouts.pop())
+        gaps = set()
+    else:
+        names = set(name for layout in layouts for name in layout)
+        order = sorted(names | {"t", "u", "log_id"})
+        gaps = set(name for name in names if any((name not in layout) for layout in layouts))
+    return order, gaps
+
+# Decodes the records at offsets, all with a payload, into columns of the
+# wide table given by log_columns().  Returns a dict of column -> array
+def decode_records( buf, offsets, lengths, order, gaps ):
+    data = np.frombuffer(buf, dtype=np.uint8)
+    count = len(offsets)
+    payload_lengths = lengths - RECORD_HEADER
+    columns = dict()
+    columns["t"] = _record_times(data, offsets)
+    u = np.empty(count, dtype=object)
+    u[:] = [bytes(buf[o + RECORD_HEADER:o + n]) for o, n in zip(offsets.tolist(), lengths.tolist())]
+    columns["u"] = u
+    log_ids = data[offsets + RECORD_HEADER].astype(np.int64)
+    columns["log_id"] = log_ids
+
+    keys = log_ids * 256 + payload_lengths
+    for key in np.unique(keys).tolist():
+        rows = np.nonzero(keys == key)[0]
+        log_type, length = divmod(key, 256)
+        layout = log_layout(log_type, length)
+        if (layout == None) or not (layout.fields):
+            continue
+        for name, values in _decode_group(data, offsets[rows], length, layout).items():
+            if (name not in columns):
+                if (isinstance(values, list)):
+                    columns[name] = np.full(count, np.nan, dtype=object)
+                else:
+                    columns[name] = np.full(count, np.nan) if (name in gaps) else np.zeros(count, dtype=np.int64)
+            columns[name][rows] = values
+    for name in order:
+        if (name not in columns):       # in the log, but not in these records
+            columns[name] = np.full(count, np.nan)
+    return {name: columns[name] for name in order}
+
+# Decodes the records of a log held in buf (bytes, mmap, ...).  Returns a dict
+# of column -> array and the number of records processed.
+def decode_log( buf, archive = False ):
+    offsets, lengths = index_log(buf, archive)
+    processed = len(offsets)
+    payload = lengths > RECORD_HEADER
+    offsets, lengths = offsets[payload], lengths[payload]
+    if (len(offsets) == 0):
+        return dict(t = np.zeros(0, dtype=np.int64), u = np.zeros(0, dtype=object)), processed
+    order, gaps = log_columns(np.frombuffer(buf, dtype=np.uint8), offsets, lengths)
+    return decode_records(buf, offsets, lengths, order, gaps), processed
+
+# Returns the decoded log as a DataFrame, with the same columns as log_to_csv
+# has always written
+def log_dataframe( columns ):
+    import pandas as pd
+    return pd.DataFrame(columns)
+
+# Decodes the records of a log held in buf into one DataFrame per log type.
+# Every table has the record number in the log and the time 't', then every
+# field of every layout of its type, so a table has the same columns and
+# dtypes whichever variants of the record the log holds.  Integer fields are
+# nullable integers of the largest size the field has, hex fields are strings,
+# and both are missing (NA or None) in records whose layout lacks them.  Types
+# without fields keep the payload as bytes in 'u'.  Returns a dict of table
+# name -> DataFrame and the number of records processed.
+def decode_tables( buf, archive = False ):
+    offsets, lengths = index_log(buf, archive)
+    processed = len(offsets)
+    payload = lengths > RECORD_HEADER
+    offsets, lengths = offsets[payload], lengths[payload]
+    return decode_table_records(buf, offsets, lengths, np.arange(len(offsets))), processed
+
+# Empty columns of a table of count records of log_type: the column names,
+# fields of the newest layout first, {name: (values, present)} for the
+# integer fields and {name: values} for the hex fields and the raw payload 'u'
+def _table_schema( log_type, count ):
+    layouts = LOG_RECORDS[log_type].layouts if (log_type in LOG_RECORDS) else []
+    order = []
+    sizes = dict()
+    for layout in reversed(layouts):
+        order += [name for name in layout.names if (name not in order)]
+        for name, offset, size in layout.int_fields:
+            sizes[name] = max(sizes.get(name, 0), size)
+    ints = {name: (np.zeros(count, dtype=f"<u{size}"), np.zeros(count, dtype=bool)) for name, size in sizes.items()}
+    texts = {name: np.full(count, None, dtype=object) for name in order if (name not in sizes)}
+    if not (layouts) or not all(layout.fields for layout in layouts):
+        order.append("u")
+        texts["u"] = np.full(count, None, dtype=object)
+    return order, ints, texts
+
+# Decodes the records at offsets, all with a payload, into one DataFrame per
+# log type as decode_tables().  numbers are their record numbers in the log
+def decode_table_records( buf, offsets, lengths, numbers ):
+    import pandas as pd
+    data = np.frombuffer(buf, dtype=np.uint8)
+    times = _record_times(data, offsets).astype(np.uint32)
+    payload_lengths = lengths - RECORD_HEADER
+    log_ids = data[offsets + RECORD_HEADER]
+    tables = dict()
+    for log_type in np.unique(log_ids).tolist():
+        records = np.nonzero(log_ids == log_type)[0]
+        count = len(records)
+        columns = dict(record = numbers[records].astype(np.uint32), t = times[records])
+        order, ints, texts = _table_schema(log_type, count)
+        for length in np.unique(payload_lengths[records]).tolist():
+            rows = np.nonzero(payload_lengths[records] == length)[0]
+            layout = log_layout(log_type, length)
+            if (layout == None) or not (layout.fields):
+                texts["u"][rows] = [bytes(buf[o + RECORD_HEADER:o + n]) for o, n in zip(offsets[records[rows]].tolist(), lengths[records[rows]].tolist())]
+                continue
+            for name, values in _decode_group(data, offsets[records[rows]], length, layout).items():
+                if (isinstance(values, list)):
+                    texts[name][rows] = values
+                else:
+                    ints[name][0][rows] = values
+                    ints[name][1][rows] = True
+        for name in order:
+            if (name in ints):
+                values, present = ints[name]
+                columns[name] = pd.arrays.IntegerArray(values, ~present)
+            else:
+                columns[name] = texts[name]
+        tables[table_name(log_type)] = pd.DataFrame(columns)
+    return tables
+
+# Writes each table to directory as parquet, feather or csv, with a JSON
+# manifest listing the tables, their files, rows and column dtypes.  Returns
+# the path of the manifest
+def write_tables( tables, directory, fmt = "parquet", source = None, processed_records = None ):
+    import json
+    import os
+    os.makedirs(directory, exist_ok=True)
+    manifest = dict(source = source, records = processed_records, format = fmt, tables = dict())
+    log_types = {record.name: log_type for log_type, record in LOG_RECORDS.items()}
+    for name, df in tables.items():
+        filename = name + TABLE_FORMATS[fmt]
+        path = os.path.join(directory, filename)
+        if (fmt == "parquet"):
+            df.to_parquet(path, index=False)
+        elif (fmt == "feather"):
+            df.to_feather(path)
+        else:
+            df.to_csv(path, index=False)
+        log_type = log_types.get(name, int(name.rsplit("_", 1)[-1]) if (name.startswith("log_type_")) else None)
+        manifest["tables"][name] = dict(file = filename, log_id = log_type, rows = len(df),
+                                        columns = {column: str(dtype) for column, dtype in df.dtypes.items()})
+    path = os.path.join(directory, MANIFEST)
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent = 2)
+    return path
+
+# Decodes a log file with decoder (decode_log or decode_tables)
+def decode_file( filename, decoder = decode_log, archive = False ):
+    with open(filename, "rb") as fs:
+        if (fs.seek(0, 2) == 0):
+            return decoder(b'', archive)
+        with mmap.mmap(fs.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return decoder(buf, archive)
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode a DSSP binary log and compare with log_to_csv")
+    parser.add_argument("in_file", help="The binary log" )
+    args = parser.parse_args()
+
+    starttime = time.time()
+    columns, processed_records = decode_file(args.in_file)
+    df = log_dataframe(columns)
+    decodetime = time.time() - starttime
+    print( f"Decoded {processed_records} records in {decodetime:.3f}s" )
+
+    import log_to_csv
+    starttime = time.time()
+    reference, reference_records = log_to_csv.reference_dataframe(args.in_file)
+    print( f"Reference decoded in {time.time() - starttime:.3f}s" )
+    if (df.to_csv() != reference.to_csv()) or (processed_records != reference_records):
+        print( "Fail, output differs from log_to_csv" )
+        exit(-1)
+    print( "Pass, output is identical to log_to_csv" )
+
+    tables, table_records = decode_file(args.in_file, decode_tables)
+    for name, table in tables.items():
+        wide = df.iloc[table["record"]]
+        for column in table.columns.drop(["record", "u"], errors="ignore"):
+            if not (table[column].astype(object).fillna(-1).tolist() == wide[column].astype(object).fillna(-1).tolist()):
+                print( f"Fail, table {name} column {column} differs" )
+                exit(-1)
+    if (sum(len(table) for table in tables.values()) != len(df)) or (table_records != processed_records):
+        print( "Fail, tables don't hold every record" )
+        exit(-1)
+    print( f"Pass, {len(tables)} tables match" )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+#!/bin/python
+#
+#               /|\
+#              / | \
+#             /  |  \
+#            /   |   \
+#           /   / \   \
+#          /   //|\\   \
+#         /   // | \\   \  (c) Dawn Aerospace Ltd
+#        /___//_/ \_\\___\  www.dawnaerospace.com
+#
+# @file log_index.py
+# @brief Time index of a DSSP binary log for range queries
+#
+# The index is kept next to the log as '<log>.idx': the offset, time, log
+# type and length of every record with a payload, in log order, followed by
+# the record numbers sorted by time.  It is built on first use and rebuilt when
+# the log changes.  A query binary searches the times and decodes only the
+# records in range, straight from the memory mapped log.
+#
+#   python log_index.py log.bin -s 120000 -e 180000 -t tank_pressure
+#
+
+import argparse
+import mmap
+import os
+import struct
+import time
+import numpy as np
+
+from log_decoder import RECORD_HEADER, decode_records, decode_table_records, index_log, log_columns, _record_times
+from log_records import LOG_RECORDS
+
+INDEX_DTYPE = np.dtype([("offset", "<u8"), ("t", "<u4"), ("log_id", "u1"), ("length", "u1")])
+
+
+class LogIndex:
+    SUFFIX  = ".idx"
+    MAGIC   = b"DSSPIDX1"
+    HEADER  = struct.Struct("<8sQqBQ")      # magic, log size, log mtime_ns, archive, records
+
+    def __init__(self, filename, archive = False, rebuild = False):
+        self.filename = filename
+        self.index_file = filename + self.SUFFIX
+        self.archive = archive
+        self.built = False
+        stat = os.stat(filename)
+        self._stamp = (stat.st_size, stat.st_mtime_ns, int(archive))
+        if (rebuild) or not (self._load()):
+            self.build()
+
+    def _load( self ):
+        try:
+            with open(self.index_file, "rb") as f:
+                magic, size, mtime, archive, count = self.HEADER.unpack(f.read(self.HEADER.size))
+        except (OSError, struct.error):
+            return False
+        if (magic != self.MAGIC) or ((size, mtime, archive) != self._stamp):
+            return False
+        self.records = np.memmap(self.index_file, dtype=INDEX_DTYPE, mode="r", offset=self.HEADER.size, shape=(count,)) if (count) else np.zeros(0, dtype=INDEX_DTYPE)
+        by_time = self.HEADER.size + count * INDEX_DTYPE.itemsize
+        self.by_time = np.memmap(self.index_file, dtype="<u4", mode="r", offset=by_time, shape=(count,)) if (count) else np.zeros(0, dtype="<u4")
+        self.times = self.records["t"][self.by_time]
+        return True
+
+    def build( self ):
+        with open(self.filename, "rb") as fs:
+            buf = mmap.mmap(fs.fileno(), 0, access=mmap.ACCESS_READ) if (self._stamp[0]) else b''
+            offsets, lengths = index_log(buf, self.archive)
+            payload = lengths > RECORD_HEADER
+            offsets, lengths = offsets[payload], lengths[payload]
+            data = np.frombuffer(buf, dtype=np.uint8)
+            records = np.zeros(len(offsets), dtype=INDEX_DTYPE)
+            records["offset"] = offsets
+            records["t"] = _record_times(data, offsets)
+            records["log_id"] = data[offsets + RECORD_HEADER]
+            records["length"] = lengths
+            del data
+            if (self._stamp[0]):
+                buf.close()
+        by_time = np.argsort(records["t"], kind="stable").astype("<u4")
+        tmp = self.index_file + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.HEADER.pack(self.MAGIC, *self._stamp, len(records)))
+            f.write(records.tobytes())
+            f.write(by_time.tobytes())
+        os.replace(tmp, self.index_file)
+        self.records = records
+        self.by_time = by_time
+        self.times = records["t"][by_time]
+        self.built = True
+
+    def __len__( self ):
+        return len(self.records)
+
+    # Record numbers, in log order, of the records with start <= t <= end and
+    # of the given log types (ids or table names).  None is no limit
+    def select( self, start = None, end = None, log_types = None ):
+        first = 0 if (start == None) else np.searchsorted(self.times, start, side="left")
+        last = len(self.times) if (end == None) else np.searchsorted(self.times, end, side="right")
+        numbers = np.sort(self.by_time[first:last]).astype(np.int64)
+        if (log_types != None):
+            names = {record.name: log_type for log_type, record in LOG_RECORDS.items()}
+            ids = [names[log_type] if (isinstance(log_type, str)) else log_type for log_type in log_types]
+            numbers = numbers[np.isin(self.records["log_id"][numbers], ids)]
+        return numbers
+
+    def _decode( self, numbers, decoder ):
+        offsets = self.records["offset"][numbers].astype(np.int64)
+        lengths = self.records["length"][numbers].astype(np.int64)
+        with open(self.filename, "rb") as fs:
+            if (len(numbers) == 0):
+                return decoder(b'', offsets, lengths)
+            with mmap.mmap(fs.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                return decoder(buf, offsets, lengths)
+
+    # One DataFrame per log type, as log_decoder.decode_tables(), of the
+    # records in range
+    def tables( self, start = None, end = None, log_types = None ):
+        numbers = self.select(start, end, log_types)
+        return self._decode(numbers, lambda buf, offsets, lengths: decode_table_records(buf, offsets, lengths, numbers))
+
+    # The wide table of log_to_csv, of the records in range
+    def dataframe( self, start = None, end = None, log_types = None ):
+        from log_decoder import log_dataframe
+        numbers = self.select(start, end, log_types)
+        def decoder(buf, offsets, lengths):
+            if (len(offsets) == 0):
+                return dict(t = np.zeros(0, dtype=np.int64), u = np.zeros(0, dtype=object))
+            return decode_records(buf, offsets, lengths, *log_columns(np.frombuffer(buf, dtype=np.uint8), offsets, lengths))
+        df = log_dataframe(self._decode(numbers, decoder))
+        df.index = numbers
+        return df
+
+def _check( index ):
+    import pandas as pd
+    from log_decoder import decode_file, decode_tables
+    tables, processed = decode_file(index.filename, decode_tables, index.archive)
+    t = np.sort(index.records["t"])
+    bounds = [(None, None), (t[len(t) // 3], t[len(t) // 2]), (t[-1], None), (None, t[0] - 1)] if (len(t)) else [(None, None)]
+    for start, end in bounds:
+        for log_types in (None, [name for name in list(tables)[:2]]):
+            got = index.tables(start, end, log_types)
+            for name, table in tables.items():
+                keep = ((start == None) | (table["t"] >= (start or 0))) & ((end == None) | (table["t"] <= (end or 0)))
+                expected = table[keep].reset_index(drop=True)
+                if (log_types != None) and (name not in log_types):
+                    expected = expected[:0]
+                result = got.get(name)
+                if (len(expected) == 0) and ((result is None) or (len(result) == 0)):
+                    continue
+                try:
+                    pd.testing.assert_frame_equal(result, expected)
+                except (AssertionError, TypeError):
+                    print( f"Fail, query {start}..{end} of {name}" )
+                    exit(-1)
+    print( f"Pass, {len(bounds) * 2} queries match the full decode" )
+
+def main():
+    parser = argparse.ArgumentParser(description="Time range queries on a DSSP binary log")
+    parser.add_argument("in_file", help="The binary log" )
+    parser.add_argument("-s", "--start", help="First time", type=int)
+    parser.add_argument("-e", "--end", help="Last time", type=int)
+    parser.add_argument("-t", "--types", help="Log types, as ids or table names", nargs="+")
+    parser.add_argument("-o", "--out_file", help="Write the records in range as CSV, as log_to_csv")
+    parser.add_argument("-a", "--archive", help="Carry on after the erased flash at the end of a log, for several logs in one file", action="store_true")
+    parser.add_argument("-r", "--rebuild", help="Rebuild the index", action="store_true")
+    parser.add_argument("-c", "--check", help="Check queries against decoding the whole log", action="store_true")
+    args = parser.parse_args()
+
+    starttime = time.time()
+    index = LogIndex(args.in_file, args.archive, args.rebuild)
+    print( f"{'Built' if (index.built) else 'Loaded'} index of {len(index)} records in {time.time() - starttime:.3f}s" )
+    if (args.check):
+        _check(index)
+        return
+
+    log_types = [int(name) if (name.isdigit()) else name for name in args.types] if (args.types) else None
+    starttime = time.time()
+    if (args.out_file):
+        df = index.dataframe(args.start, args.end, log_types)
+        df.to_csv(args.out_file)
+        print( f"Wrote {len(df)} records in {time.time() - starttime:.3f}s" )
+        return
+    tables = index.tables(args.start, args.end, log_types)
+    querytime = time.time() - starttime
+    for name, table in tables.items():
+        print( f"{name} ({len(table)} records)" )
+        print( table.to_string(max_rows=20) )
+        print()
+    print( f"Queried {sum(len(table) for table in tables.values())} records in {querytime:.3f}s" )
+
+if __name__ == "__main__":
+    main()
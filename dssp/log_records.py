@@ -0,0 +1,182 @@
+#!/bin/python
+#
+#               /|\
+#              / | \
+#             /  |  \
+#            /   |   \
+#           /   / \   \
+#          /   //|\\   \
+#         /   // | \\   \  (c) Dawn Aerospace Ltd
+#        /___//_/ \_\\___\  www.dawnaerospace.com
+#
+# @file log_records.py
+# @brief Layouts of the DSSP log records
+#
+# The one place the LOG_TYPE_* payloads are described.  Each log type has one
+# or more layouts, picked by payload length for backwards compatibility with
+# older firmware.  A layout lists its fields and the text log_parser writes for
+# it, and is compiled once into a struct for decoding single records and a
+# NumPy dtype for decoding many (see log_decoder).
+#
+# A field is (name, offset in payload, size) for a little endian unsigned
+# integer of 1, 2 or 4 bytes, or (name, offset, size, HEX) for bytes shown as
+# hex, where a size of None runs to the end of the payload.  Payloads shorter
+# than a layout read as if padded with zeros.
+#
+
+import struct
+import numpy as np
+
+HEX = 'hex'
+
+_STRUCT_FORMATS = {1 : 'B', 2 : 'H', 4 : 'I'}
+
+
+class LogLayout:
+    def __init__(self, min_length, fields, text):
+        self.min_length = min_length
+        self.fields = fields
+        self.text = text
+        self.names = [name for name, *field in fields]
+        self.int_fields = [(name, offset, size) for name, offset, size, *kind in fields if not (kind)]
+        self.hex_fields = [(name, offset, size) for name, offset, size, *kind in fields if (kind)]
+        # fixed part of the payload, hex fields running to the end excluded
+        self.size = max([1] + [offset + (size or 0) for name, offset, size, *kind in fields])
+        fmt = '<'
+        position = 0
+        for name, offset, size in sorted(self.int_fields, key=lambda field: field[1]):
+            fmt += f"{offset - position}x" + _STRUCT_FORMATS[size]
+            position = offset + size
+        self.struct = struct.Struct(fmt)
+        self.dtype = np.dtype(dict(names = [name for name, offset, size in self.int_fields],
+                                   formats = [f"<u{size}" for name, offset, size in self.int_fields],
+                                   offsets = [offset for name, offset, size in self.int_fields],
+                                   itemsize = self.size))
+        # values come out of _values() as the struct's, then the hex fields
+        self._order = [name for name, offset, size in sorted(self.int_fields, key=lambda field: field[1])]
+        self._order += [name for name, offset, size in self.hex_fields]
+        self._text = self.text.format(**{name: "{%d}" % n for n, name in enumerate(self._order)})
+
+    # Integer fields beyond a short payload read as 0, hex fields show only
+    # the bytes the payload has
+    def _values(self, u):
+        padded = u
+        if (len(u) < self.size):
+            padded = bytes(u) + bytes(self.size - len(u))
+        values = self.struct.unpack_from(padded)
+        if (self.hex_fields):
+            values += tuple(u[offset:None if (size == None) else offset + size].hex() for name, offset, size in self.hex_fields)
+        return values
+
+    # Field values of one payload, in field order
+    def unpack(self, u):
+        values = dict(zip(self._order, self._values(u)))
+        return {name: values[name] for name in self.names}
+
+    # Text of a record from its field values
+    def format(self, values):
+        return self.text.format(**values)
+
+    # Text of one payload, without going through unpack()
+    def format_payload(self, u):
+        return self._text.format(*self._values(u))
+
+
+class LogRecord:
+    def __init__(self, log_type, name, layouts):
+        self.log_type = log_type
+        self.name = name
+        self.layouts = [LogLayout(*layout) for layout in layouts]
+
+    # The layout with the largest minimum length that a payload of length reaches
+    def layout(self, length):
+        found = self.layouts[0]
+        for layout in self.layouts:
+            if (length >= layout.min_length):
+                found = layout
+        return found
+
+
+_TANK_STATE = "heater state={heater_state}, temperature={temperature}x0.1K"
+_FEEDLINE_STATE = "valve state={valve_state}, heater state={heater_state}, temperature={temperature}x0.1K"
+
+# log type -> (name, [(minimum payload length, fields, text), ...])
+LOG_SCHEMA = {
+    0  : ("init_log", [(0, [], "log init")]),
+    1  : ("init_node", [(0, [("node", 1, 1), ("system_runtime", 2, 4), ("system_cycles", 6, 4),
+                             ("heating_runtime", 10, 4), ("heating_cycles", 14, 4)],
+                         "Node {node} Initialised system:(cycles={system_runtime}, runtime={system_cycles}), "
+                         "heating:(cycles={heating_runtime}, runtime ={heating_cycles})")]),
+    2  : ("time_scet", [(0, [("scet_coarse", 1, 4), ("scet_fine", 5, 4)], "scet")]),
+    3  : ("time_utc", [(0, [("utc_day", 1, 2), ("utc_ms_of_day", 3, 4), ("utc_sub_ms", 7, 2)], "utc")]),
+    4  : ("cmd_received", [(0, [], "cmd")]),
+    5  : ("state_change", [(0, [("node", 1, 1), ("state", 2, 1)], "Node {node} State Change to {state}")]),
+    6  : ("fire_cmd", [(0, [("fire_cmd", 1, 4, HEX)], "Fire Cmd {fire_cmd}"),
+                       (6, [("node", 1, 1), ("fire_cmd", 2, 4, HEX)], "Node {node} Fire Cmd {fire_cmd}")]),
+    7  : ("fire_counters", [(0, [("node", 1, 1),
+                                 ("hot_cycles", 2, 2), ("hot_time", 4, 4), ("hot_pint", 8, 4),
+                                 ("cold_fu_cycles", 12, 2), ("cold_fu_time", 14, 4), ("cold_fu_pint", 18, 4),
+                                 ("cold_ox_cycles", 22, 2), ("cold_ox_time", 24, 4), ("cold_ox_pint", 28, 4)],
+                             "Node {node} Fire Counters hot:(cycles={hot_cycles}, time={hot_time}, pint={hot_pint})"
+                             " cold_fu:(cycles={cold_fu_cycles}, time={cold_fu_time}, pint={cold_fu_pint})"
+                             " cold_ox:(cycles={cold_ox_cycles}, time={cold_ox_time}, pint={cold_ox_pint})")]),
+    8  : ("anomaly", [(0, [("node", 1, 1), ("anomaly", 2, 1)], "Node {node} Anomaly {anomaly}")]),
+    9  : ("thruster_data", [(0, [("node", 1, 1), ("thruster_state", 2, 1), ("temperature", 3, 2), ("pressure", 5, 2)],
+                             "Node {node} Thruster state={thruster_state}, temp={temperature}x0.1K, pressure={pressure}mBar"),
+                            (8, [("node", 1, 1), ("thruster_state", 2, 1), ("temperature", 3, 2), ("pressure", 5, 2),
+                                 ("pressure_integral", 7, 2)],
+                             "Node {node} Thruster state={thruster_state}, temp={temperature}x0.1K, pressure={pressure}mBar"
+                             " integral={pressure_integral}mBar.s")]),
+    10 : ("feedline_data", [(0, [("node", 1, 1), ("temperature", 2, 2)],     # deprecated
+                             "Node {node} Feedline temp={temperature}x0.1K")]),
+    11 : ("tank_data", [(0, [("node", 1, 1), ("temperature", 2, 2), ("pressure", 4, 2)],    # deprecated
+                         "Node {node} Tank temp={temperature}x0.1K pressure={pressure}mBar"),
+                        (8, [("node", 1, 1), ("temperature", 2, 2), ("pressure", 4, 4)],
+                         "Node {node} Tank temp={temperature}x0.1K pressure={pressure}mBar")]),
+    12 : ("power_data", [(0, [("node", 1, 1), ("vact_v", 2, 2), ("vact_i", 4, 2)],
+                          "Node {node} Power Vact V={vact_v}mV, I={vact_i}mA")]),
+    13 : ("pdo", [(0, [("pdo_id", 1, 2), ("pdo", 3, None, HEX)], "PDO id={pdo_id} {pdo}")]),
+    14 : ("fu_feedline_state", [(0, [("fu_feedline", 1, 1), ("valve_state", 2, 1), ("heater_state", 3, 1), ("temperature", 4, 2)],
+                                 "Fu Feedline [{fu_feedline}] " + _FEEDLINE_STATE),
+                                (7, [("node", 1, 1), ("fu_feedline", 2, 1), ("valve_state", 3, 1), ("heater_state", 4, 1),
+                                     ("temperature", 5, 2)],
+                                 "Node {node} Feedline Fu [{fu_feedline}] " + _FEEDLINE_STATE)]),
+    15 : ("ox_feedline_state", [(0, [("ox_feedline", 1, 1), ("valve_state", 2, 1), ("heater_state", 3, 1), ("temperature", 4, 2)],
+                                 "Ox Feedline [{ox_feedline}] " + _FEEDLINE_STATE),
+                                (7, [("node", 1, 1), ("ox_feedline", 2, 1), ("valve_state", 3, 1), ("heater_state", 4, 1),
+                                     ("temperature", 5, 2)],
+                                 "Node {node} Feedline Ox [{ox_feedline}] " + _FEEDLINE_STATE)]),
+    16 : ("feedline_pressure", [(0, [("node", 1, 1), ("pressure", 2, 4), ("pressure_2", 6, 4)],
+                                 "Node {node} Feedline Fu pressure={pressure}mBar, Ox pressure={pressure_2}mBar")]),
+    17 : ("fu_tank_data", [(0, [("node", 1, 1), ("fu_tank", 2, 1), ("heater_state", 3, 1), ("temperature", 4, 2)],
+                            "Node {node} Tank Fu [{fu_tank}] " + _TANK_STATE)]),
+    18 : ("ox_tank_data", [(0, [("node", 1, 1), ("ox_tank", 2, 1), ("heater_state", 3, 1), ("temperature", 4, 2)],
+                            "Node {node} Tank Ox [{ox_tank}] " + _TANK_STATE)]),
+    19 : ("tank_pressure", [(0, [("node", 1, 1), ("pressure", 2, 4), ("pressure_2", 6, 4)],
+                             "Node {node} Tank Fu pressure={pressure}mBar, Ox pressure={pressure_2}mBar")]),
+    20 : ("vdig_data", [(0, [("node", 1, 1), ("vdig_v", 2, 2), ("vdig_i", 4, 2)],
+                         "Node {node} Power Vdig V={vdig_v}mV, I={vdig_i}mA")]),
+}
+
+LOG_RECORDS = {log_type: LogRecord(log_type, name, layouts) for log_type, (name, layouts) in LOG_SCHEMA.items()}
+
+UNKNOWN_TEXT = "unknown record"
+
+# Layout of a payload of the given type and length, None for unknown types
+def log_layout( log_type, length ):
+    record = LOG_RECORDS.get(log_type)
+    return record.layout(length) if (record != None) else None
+
+def table_name( log_type ):
+    record = LOG_RECORDS.get(log_type)
+    return record.name if (record != None) else f"log_type_{log_type}"
+
+# Field values of a payload, empty for unknown types
+def decode_record( u ):
+    layout = log_layout(u[0], len(u))
+    return layout.unpack(u) if (layout != None) else dict()
+
+# Text of a payload, as log_parser writes it
+def format_record( u ):
+    layout = log_layout(u[0], len(u))
+    return layout.format_payload(u) if (layout != None) else UNKNOWN_TEXT
@@ -0,0 +1,142 @@
+#!/bin/python
+#
+#               /|\
+#              / | \
+#             /  |  \
+#            /   |   \
+#           /   / \   \
+#          /   //|\\   \
+#         /   // | \\   \  (c) Dawn Aerospace Ltd
+#        /___//_/ \_\\___\  www.dawnaerospace.com
+#
+# @file log_stream.py
+# @brief Chunked, multi-core conversion of DSSP binary logs
+#
+# The log is indexed once (log_decoder.index_log), the index is cut into
+# chunks of whole records and the chunks are decoded by a pool of processes,
+# each memory mapping the log itself.  The converted chunks are written to the
+# output in order as they come back, with at most a few chunks per process
+# held in memory at a time.  The output is the same as converting the log in
+# one go with log_to_csv or log_parser.
+#
+
+import argparse
+import collections
+import concurrent.futures
+import mmap
+import os
+import time
+import numpy as np
+
+from log_decoder import RECORD_HEADER, decode_records, index_log, log_columns, log_dataframe, _record_times
+from log_records import format_record
+
+CHUNK_RECORDS = 100000
+CHUNKS_PER_JOB = 2                      # in flight, bounds the memory held by the writer
+
+_logs = dict()                          # filename -> mmap, of this process
+
+def _open_log( filename ):
+    if (filename not in _logs):
+        with open(filename, "rb") as fs:
+            _logs[filename] = mmap.mmap(fs.fileno(), 0, access=mmap.ACCESS_READ) if (os.fstat(fs.fileno()).st_size) else b''
+    return _logs[filename]
+
+def _csv_chunk( filename, offsets, lengths, order, gaps, first_row ):
+    df = log_dataframe(decode_records(_open_log(filename), offsets, lengths, order, gaps))
+    df.index = range(first_row, first_row + len(df))
+    return df.to_csv(header=(first_row == 0))
+
+def _text_chunk( filename, offsets, lengths ):
+    buf = _open_log(filename)
+    times = _record_times(np.frombuffer(buf, dtype=np.uint8), offsets).tolist()
+    lines = []
+    for t, o, n in zip(times, offsets.tolist(), lengths.tolist()):
+        if (n > RECORD_HEADER):
+            lines.append(f"{t:010}: {format_record(buf[o + RECORD_HEADER:o + n])}\n")
+        else:
+            lines.append(f"{t:010}: \n")
+    return "".join(lines)
+
+# Runs worker over the chunks (tuples of its arguments) with jobs processes and
+# writes the results to out in order
+def _convert( worker, chunks, out, jobs ):
+    if (jobs <= 1) or (len(chunks) <= 1):
+        for chunk in chunks:
+            out.write(worker(*chunk))
+        return
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.submit(worker, *chunk))
+            if (len(pending) >= jobs * CHUNKS_PER_JOB):
+                out.write(pending.popleft().result())
+        while (pending):
+            out.write(pending.popleft().result())
+
+def _chunks( count, chunk_records ):
+    return [(n, min(n + chunk_records, count)) for n in range(0, max(count, 1), chunk_records)]
+
+# Converts a log to the same CSV as log_to_csv and returns the number of
+# records processed
+def convert_csv( in_file, out_file, jobs = None, chunk_records = CHUNK_RECORDS, archive = False ):
+    jobs = jobs or os.cpu_count()
+    buf = _open_log(in_file)
+    offsets, lengths = index_log(buf, archive)
+    processed = len(offsets)
+    payload = lengths > RECORD_HEADER
+    offsets, lengths = offsets[payload], lengths[payload]
+    if (len(offsets)):
+        order, gaps = log_columns(np.frombuffer(buf, dtype=np.uint8), offsets, lengths)
+    else:
+        order, gaps = ["t", "u"], set()
+    chunks = [(in_file, offsets[a:b], lengths[a:b], order, gaps, a) for a, b in _chunks(len(offsets), chunk_records)]
+    with open(out_file, "w", newline='') as out:
+        _convert(_csv_chunk, chunks, out, jobs)
+    return processed
+
+# Converts a log to the same text as log_parser and returns the number of
+# records processed
+def convert_text( in_file, out_file, jobs = None, chunk_records = CHUNK_RECORDS, archive = False ):
+    jobs = jobs or os.cpu_count()
+    offsets, lengths = index_log(_open_log(in_file), archive)
+    chunks = [(in_file, offsets[a:b], lengths[a:b]) for a, b in _chunks(len(offsets), chunk_records)]
+    with open(out_file, "wt") as out:
+        _convert(_text_chunk, chunks, out, jobs)
+    return len(offsets)
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a DSSP binary log in chunks and compare with converting it in one go")
+    parser.add_argument("in_file", help="The binary log" )
+    parser.add_argument("out_file", help="The csv output, the text output goes to out_file.txt" )
+    parser.add_argument("-j", "--jobs", help="Processes, all cores by default", type=int)
+    parser.add_argument("-c", "--chunk", help="Records per chunk", type=int, default=CHUNK_RECORDS)
+    args = parser.parse_args()
+
+    starttime = time.time()
+    processed_records = convert_csv(args.in_file, args.out_file, args.jobs, args.chunk)
+    print( f"CSV of {processed_records} records in {time.time() - starttime:.3f}s" )
+    starttime = time.time()
+    convert_text(args.in_file, args.out_file + ".txt", args.jobs, args.chunk)
+    print( f"Text of {processed_records} records in {time.time() - starttime:.3f}s" )
+
+    from log_decoder import decode_file
+    columns, reference_records = decode_file(args.in_file)
+    if (open(args.out_file, newline='').read() != log_dataframe(columns).to_csv()) or (processed_records != reference_records):
+        print( "Fail, chunked CSV differs" )
+        exit(-1)
+    lines = []
+    import log_parser
+    with open(args.in_file, "rb") as fs:
+        while True:
+            t, u = log_parser.read_record( fs )
+            if (t == 0):
+                break
+            lines.append('{:010}: '.format(t) + (log_parser.parse_record(u) if (len(u) > 0) else '') + '\n')
+    if (open(args.out_file + ".txt").read() != "".join(lines)):
+        print( "Fail, chunked text differs" )
+        exit(-1)
+    print( "Pass, chunked output is identical" )
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,8 @@
 import argparse
 import time
 import pandas as pd
+from log_decoder import TABLE_FORMATS, decode_file, decode_tables, write_tables
+from log_stream import convert_csv
 
 def read_record( fs ):
     v = int.from_bytes(fs.read(1), byteorder='little', signed=False)          # version 
@@ -143,36 +145,58 @@ def state_change(row):
         row["vdig_i"] = int.from_bytes(u[4:6],byteorder='little',signed=False)
     return row
 
+# Row by row decode with state_change, kept as the reference for log_decoder.
+# Returns the DataFrame and the number of records processed
+def reference_dataframe( in_file ):
+    l = []
+    fs = open(in_file, "rb")                                  # open log file
+    processed_records = 0
+    try:
+        while True:
+            t, u = read_record( fs )
+            if (t == 0):
+                break
+            if (len(u) > 0):
+                l.append([t, u])
+            processed_records = processed_records + 1
+    except IOError:
+        pass
+
+    fs.close()
+    df = pd.DataFrame(l, columns= ["t", "u"])
+    df = df.apply(state_change, axis=1)
+    return df, processed_records
+
 def main():
     parser = argparse.ArgumentParser(description="Dawn Aerospace CANopen log to csv converter")
     parser.add_argument("in_file", help="The binary log" )
     parser.add_argument("out_file", help="The csv output" )
+    parser.add_argument("-r", "--reference", help="Decode row by row with the original state_change", action="store_true")
+    parser.add_argument("-t", "--tables", help="Write one table per log type to the out_file directory, with a manifest", choices=TABLE_FORMATS.keys())
+    parser.add_argument("-j", "--jobs", help="Processes converting chunks of the log, all cores by default", type=int)
+    parser.add_argument("-a", "--archive", help="Carry on after the erased flash at the end of a log, for several logs in one file", action="store_true")
     args = parser.parse_args()
 
     print( f"Reading log data from {args.in_file}")
     print( f"Writing output to {args.out_file}")
 
     fname = args.out_file    
-    l = []
-          
-    fs = open(args.in_file, "rb")                                  # open log file
     starttime = time.time()        
-    processed_records = 0
-    try:
-        while True:
-            t, u = read_record( fs )               
-            if (t == 0):
-                break                
-            if (len(u) > 0):                    
-                l.append([t, u])                
-            processed_records = processed_records + 1
-    except IOError:
-        pass
-
-    fs.close()        
-    df = pd.DataFrame(l, columns= ["t", "u"])
-    df = df.apply(state_change, axis=1)        
-    df.to_csv(fname)
+    if (args.tables):
+        tables, processed_records = decode_file(args.in_file, decode_tables, args.archive)
+        try:
+            manifest = write_tables(tables, args.out_file, args.tables, args.in_file, processed_records)
+        except ImportError as err:
+            print( err )                # parquet and feather need pyarrow
+            return
+        print( f"Wrote {len(tables)} tables, manifest {manifest}")
+        print( f"Processed {processed_records} records in {time.time() - starttime:.3f}s")
+        return
+    if (args.reference):
+        df, processed_records = reference_dataframe(args.in_file)
+        df.to_csv(fname)
+    else:
+        processed_records = convert_csv(args.in_file, fname, args.jobs, archive = args.archive)
     processtime = time.time() - starttime
     print( f"Processed {processed_records} records in {processtime:.3f}s")
 
@@ -17,6 +17,15 @@ addresses = [
     0x2623   # Address for heater 10
 ]
 
+# Setpoint and temperature subindexes, heaters 1 and 2 have a different layout
+def heater_subindexes(address):
+    if address == addresses[0] or address == addresses[1]:
+        return 7, 5
+    return 5, 3
+
+# Every heater's setpoint and temperature, read as one batch
+heater_objects = [(address, subindex, dssp.GATEWAY_TYPE_UINT16) for address in addresses for subindex in heater_subindexes(address)]
+
 # Celsius to bytes conversion
 def cel2bytes(celsius, byte_length=2):
     kelvin = (celsius + 273.15) * 10
@@ -24,12 +33,9 @@ def cel2bytes(celsius, byte_length=2):
     payload = scaled_temp.to_bytes(byte_length, byteorder='little', signed=False)
     return payload
 
-# Bytes to Celsius conversion
-def bytes2cel(byte_sequence):
-    value = int.from_bytes(byte_sequence, byteorder='little')
-    kelvin = value / 10
-    celsius = kelvin - 273.15
-    return celsius
+# 0.1K units to Celsius conversion
+def dk2cel(value):
+    return value / 10 - 273.15
 
 def main():
     cmd_line = argparse.ArgumentParser(description="Dawn Aerospace DSSP Test")
@@ -37,6 +43,7 @@ def main():
     cmd_line.add_argument("node", help="The target node id", type=int)
     cmd_line.add_argument("-b", "--baudrate", help="CAN or Serial baud rate", type=int, default=115200)
     cmd_line.add_argument("-o", "--output", help="Output CSV file", type=str, default="output.csv")
+    cmd_line.add_argument("-w", "--window", help="Serial gateway requests in flight", type=int, default=1)
     args = cmd_line.parse_args()
 
     print("Dawn Aerospace (c) 2022")
@@ -45,7 +52,7 @@ def main():
     try:
         gateway = dssp.CanInterface()
         try:
-            gateway.connect(channel=args.device)
+            gateway.connect(channel=args.device, window=args.window)
         except:
             print("Error connecting to ", args.device)
             exit(-1)
@@ -106,20 +113,22 @@ def main():
                         print("5 minutes have passed. Terminating.")
                         break
 
-                    # Iterate through all addresses
+                    # Read all heaters, then iterate through all addresses
                     print ("Data Iteration", data_pass)
+                    try:
+                        temps = dssp.sdo_read_many(node.sdo, heater_objects)
+                    except Exception as e:
+                        print(f"Error reading heaters: {e}")
+                        temps = {}
+                    timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
                     for address in addresses:
                         try:
                             # Retrieve data based on address
-                            if address == addresses[0] or address == addresses[1]:
-                                setpoint = bytes2cel(node.sdo.upload(address, 7))
-                                real_temp = bytes2cel(node.sdo.upload(address, 5))
-                            else:
-                                setpoint = bytes2cel(node.sdo.upload(address, 5))
-                                real_temp = bytes2cel(node.sdo.upload(address, 3))
+                            setpoint_subindex, real_subindex = heater_subindexes(address)
+                            setpoint = dk2cel(temps[(address, setpoint_subindex)])
+                            real_temp = dk2cel(temps[(address, real_subindex)])
 
                             # Write data to CSV
-                            timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
                             writer.writerow({
                                 'Timestamp': timestamp,
                                 'Address': hex(address),
@@ -1,14 +1,22 @@
-import smbus
+import os
 import time
 import socket
+import argparse
+import threading
+import collections
 
-bus1 = smbus.SMBus(1)  
-bus6 = smbus.SMBus(6)  
+try:
+    from smbus2 import SMBus, i2c_msg   # reads the three registers of a device in one I2C transaction
+except ImportError:
+    from smbus import SMBus
+    i2c_msg = None
+
+from ina_protocol import (PORT, SENSOR_BUSES, SENSOR_ADDRESSES, SUBSCRIBE, SUBSCRIPTION, BACKFILL, RANGE, RESENT,
+                          FrameDecoder, encode_samples)
+from ina_ring import SampleRing
 
-buses = [bus1, bus6]
-    
 # bus addresses
-addresses = [0x40, 0x41, 0x42, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48, 0x49]
+addresses = SENSOR_ADDRESSES
 
 # Register addresses
 POWER_REGISTER = 0x03  # Power Register
@@ -16,76 +24,252 @@ VOLTAGE_REGISTER = 0x02  # Voltage Register
 CURRENT_REGISTER = 0x01  # Current Register
 CONFIG_REGISTER = 0x00   # Config Register
 
+# samples per frame, and the longest a sample waits for its frame to fill
+BATCH_SIZE = 64
+BATCH_TIME = 0.05
+# samples waiting for each client, the oldest are dropped beyond this
+RING_SIZE = 10000
+# samples kept on disk for clients to backfill what they missed, and samples per backfill frame
+SAMPLE_RING = os.path.expanduser('~/ina_samples.ring')
+SAMPLE_RING_SIZE = 2000000
+BACKFILL_SIZE = 1024
+
 def read_register(bus, address, register):
     """Read a 16-bit value from the specified register."""
     raw_bytes = bus.read_i2c_block_data(address, register, 2)
     value = raw_bytes[0] << 8 | raw_bytes[1]
     return value
 
+def read_registers(bus, address):
+    """Read the current, voltage and power registers, in one transaction when smbus2 is there."""
+    if i2c_msg is None:
+        return [read_register(bus, address, register) for register in (CURRENT_REGISTER, VOLTAGE_REGISTER, POWER_REGISTER)]
+    # the register pointer doesn't auto increment, so each register is a pointer write and a read
+    reads = []
+    msgs = []
+    for register in (CURRENT_REGISTER, VOLTAGE_REGISTER, POWER_REGISTER):
+        reads.append(i2c_msg.read(address, 2))
+        msgs += [i2c_msg.write(address, [register]), reads[-1]]
+    bus.i2c_rdwr(*msgs)
+    return [raw[0] << 8 | raw[1] for raw in (list(read) for read in reads)]
+
 def two_complement_to_signed(value, bits):
     """Convert a two's complement encoded value to a signed integer."""
     if value & (1 << (bits - 1)):  # Check if the MSB is set
         value -= (1 << bits)  # Adjust for negative value
     return value
 
-def get_voltage(bus, address):
-    raw_value = read_register(bus, address, VOLTAGE_REGISTER)
-    voltage = raw_value * 0.00125  # LSB size is 1.25 mV/bit
-    return voltage
-
-def get_power(bus, address):
-    raw_value = read_register(bus, address, POWER_REGISTER)
-    # Power is always positive in the register, no need for two's complement conversion
-    power = raw_value * 0.01  # LSB size is 10 mW/bit
-    return power
-
-def get_current(bus, address):
-    raw_value = read_register(bus, address, CURRENT_REGISTER)
-    # Convert raw_value from two's complement to signed value
-    signed_value = two_complement_to_signed(raw_value, 16)  # 16-bit register
-    current = signed_value * 0.00125  # LSB size is 1.25 mA/bit
-    return current
+def read_device(bus, address):
+    """Current (A), voltage (V) and power (W) of a device."""
+    raw_current, raw_voltage, raw_power = read_registers(bus, address)
+    current = two_complement_to_signed(raw_current, 16) * 0.00125  # LSB size is 1.25 mA/bit
+    voltage = raw_voltage * 0.00125  # LSB size is 1.25 mV/bit
+    power = raw_power * 0.01  # LSB size is 10 mW/bit, always positive
+    return current, voltage, power
 
 def configure_device(bus, address):
     data_block = [0x61, 0x27]
     bus.write_i2c_block_data(address, CONFIG_REGISTER, data_block)
 
 
+class BusSampler(threading.Thread):
+    """Sweeps the devices of one bus as fast as the bus allows, publishing samples."""
+
+    def __init__(self, bus_number, publish):
+        super().__init__(daemon=True)
+        self.bus_number = bus_number
+        self.publish = publish
+        self.sweeps = 0
+        self.errors = 0
+
+    def run(self):
+        bus = SMBus(self.bus_number)
+        for address in addresses:
+            try:
+                configure_device(bus, address)
+            except OSError as e:
+                print(f"Bus {self.bus_number} address {address:#x}: {e}")
+        while True:
+            for address in addresses:
+                try:
+                    t = time.time()
+                    current, voltage, power = read_device(bus, address)
+                except OSError:
+                    self.errors += 1
+                    continue
+                self.publish((self.bus_number, address, t, current, voltage, power))
+            self.sweeps += 1
+
+
+class Subscriber:
+    """A client of the server, with its own ring of samples waiting to be sent.
+
+    When the client is slower than the sampling the oldest samples are dropped,
+    so sampling and the other clients are never held up.  A client can ask for
+    at most one sample per sensor every interval seconds with a SUBSCRIBE frame,
+    and for samples it missed with a BACKFILL frame, which are sent from the
+    sample ring between the live frames.
+    """
+
+    def __init__(self, connection, address, samples):
+        self.connection = connection
+        self.address = address
+        self.samples = samples
+        self.ring = collections.deque(maxlen=RING_SIZE)
+        self.backfills = collections.deque()    # [first, last] still to send
+        self.ready = threading.Condition()
+        self.interval = 0.0
+        self.last = dict()          # (bus, address) -> t of the last sample taken
+        self.sent = 0
+        self.resent = 0
+        self.dropped = 0
+        self.closed = False
+
+    def offer(self, sample):
+        if self.interval > 0:
+            key = sample[1:3]
+            if sample[3] - self.last.get(key, 0.0) < self.interval:
+                return
+            self.last[key] = sample[3]
+        with self.ready:
+            if len(self.ring) == self.ring.maxlen:
+                self.dropped += 1
+            self.ring.append(sample)
+            if len(self.ring) >= BATCH_SIZE:
+                self.ready.notify()
+
+    def backfill(self, first, last):
+        with self.ready:
+            self.backfills.append([first, last])
+            self.ready.notify()
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+
+    def _resend(self):
+        """Send the next frame of the oldest backfill, BACKFILL_SIZE samples at most."""
+        with self.ready:
+            if not self.backfills:
+                return
+            backfill = self.backfills[0]
+        batch = self.samples.read(backfill[0], backfill[1], BACKFILL_SIZE)
+        with self.ready:
+            if batch:
+                backfill[0] = batch[-1][0] + 1
+            if not batch or backfill[0] > backfill[1]:
+                self.backfills.popleft()
+        if batch:
+            self.connection.sendall(encode_samples(batch, RESENT))
+            self.resent += len(batch)
+
+    def send_loop(self):
+        """Send the ring in frames of up to BATCH_SIZE samples, at least every BATCH_TIME, with a backfill frame between."""
+        try:
+            while True:
+                with self.ready:
+                    self.ready.wait_for(lambda: len(self.ring) >= BATCH_SIZE or self.backfills or self.closed, timeout=BATCH_TIME)
+                    if self.closed:
+                        break
+                    batch = [self.ring.popleft() for n in range(min(len(self.ring), BATCH_SIZE))]
+                if batch:
+                    self.connection.sendall(encode_samples(batch))
+                    self.sent += len(batch)
+                self._resend()
+        except OSError:
+            pass
+        finally:
+            self.close()
+
+    def receive_loop(self):
+        """Read the client's requests until it disconnects."""
+        decoder = FrameDecoder()
+        try:
+            while not self.closed:
+                data = self.connection.recv(4096)
+                if not data:
+                    break
+                for kind, payload in decoder.feed(data):
+                    if kind == SUBSCRIBE and len(payload) == SUBSCRIPTION.size:
+                        self.interval, = SUBSCRIPTION.unpack(payload)
+                        self.last.clear()
+                    elif kind == BACKFILL and len(payload) == RANGE.size:
+                        self.backfill(*RANGE.unpack(payload))
+        except OSError:
+            pass
+        finally:
+            self.close()
+
+
+class Publisher:
+    """Numbers every sample in the sample ring and hands it to every subscriber."""
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+    def publish(self, sample):
+        # under the lock so every subscriber gets the samples in sequence
+        with self.lock:
+            sample = self.samples.append(sample)
+            for subscriber in self.subscribers:
+                subscriber.offer(sample)
+
+    def serve(self, connection, address):
+        subscriber = Subscriber(connection, address, self.samples)
+        with self.lock:
+            self.subscribers = self.subscribers + [subscriber]
+        print(f"Connected to {address}, {len(self.subscribers)} clients")
+        receiver = threading.Thread(target=subscriber.receive_loop, daemon=True)
+        receiver.start()
+        subscriber.send_loop()
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if s is not subscriber]
+        connection.close()
+        print(f"Disconnected from {address}, sent {subscriber.sent} samples, resent {subscriber.resent}, dropped {subscriber.dropped}")
 
 def main():
-        
-    # create server connections
+    parser = argparse.ArgumentParser(description="INA sensor server")
+    parser.add_argument("-r", "--ring", help="Sample ring file, for clients to backfill samples they missed", default=SAMPLE_RING)
+    parser.add_argument("-s", "--ring_size", help="Samples kept in the ring", type=int, default=SAMPLE_RING_SIZE)
+    args = parser.parse_args()
+
+    samples = SampleRing(args.ring, args.ring_size)
+    print(f"Sample ring {args.ring}, {samples.capacity} samples, next sample {samples.next_seq}")
+
+    # one sampler per bus, so the buses are swept at the same time
+    publisher = Publisher(samples)
+    samplers = [BusSampler(bus, publisher.publish) for bus in SENSOR_BUSES]
+    for sampler in samplers:
+        sampler.start()
+
+    def report():
+        while True:
+            sweeps = [sampler.sweeps for sampler in samplers]
+            time.sleep(10)
+            rates = ", ".join(f"bus {sampler.bus_number} {(sampler.sweeps - n) / 10:.1f} sweeps/s, {sampler.errors} errors" for sampler, n in zip(samplers, sweeps))
+            print(f"{rates}, {len(publisher.subscribers)} clients")
+            samples.flush()
+    threading.Thread(target=report, daemon=True).start()
+
+    # create server connections, any number of clients get the samples
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind(('0.0.0.0', 12346))
-    server_socket.listen(1)
-    
-    print("Waiting for Connection")
-    connection,  client_address = server_socket.accept()
-    print(f"Connected to {client_address}")
-    
-    # configure addresses for bus 1 and 6
-    for bus in buses:
-        for address in addresses:
-            configure_device(bus, address)
-    
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind(('0.0.0.0', PORT))
+    server_socket.listen()
+
+    print("Waiting for Connections")
     try:
         while True:
-             for bus in buses:
-                for address in addresses:
-                    current = get_current(bus, address)
-                    voltage = get_voltage(bus, address)
-                    power = get_power(bus, address)
-                    print(f"Current: {current:.2f} A")
-                    print(f"Voltage: {voltage:.2f} V")
-                    print(f"Power: {power:.2f} W")
-                    message = f"{current:.2f}, {voltage:.2f}, {power:.2f}"
-                    connection.sendall(message.encode('utf-8'))
-                    time.sleep(0.25)
-                    
+            connection, client_address = server_socket.accept()
+            threading.Thread(target=publisher.serve, args=(connection, client_address), daemon=True).start()
     except KeyboardInterrupt:
         print("Server interrupted")
-    finally: 
-        connection.close()
-    
+    finally:
+        server_socket.close()
+        samples.flush()
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,175 @@
+"""Bench host side of the INA telemetry stream from the Pi (ina.py).
+
+InaClient keeps a connection to the Pi, reconnecting with backoff when it
+drops, and turns the framed stream into (address, current, voltage, power,
+timestamp) rows on a bounded queue, address being the sensor number 1..20.
+When it gets every sample it follows their sequence numbers and asks the Pi
+to backfill the ones it missed, while it was disconnected or when the Pi
+dropped them for it, so the rows have no gaps as long as the Pi's sample
+ring still holds them.  Backfilled rows come after the live ones around them.
+SqliteWriter takes the rows off the queue and inserts them in batches, one
+transaction per batch.
+"""
+import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+
+from ina_protocol import (PORT, SAMPLES, RESENT, FrameDecoder, decode_samples, encode_backfill, encode_subscribe,
+                          sensor_number)
+
+QUEUE_SIZE = 100000
+
+CREATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS VMBOX (
+        address INTEGER,
+        current INTEGER,
+        voltage INTEGER,
+        power INTEGER,
+        timestamps REAL
+    )
+"""
+INSERT = "INSERT INTO VMBOX (address, current, voltage, power, timestamps) VALUES (?, ?, ?, ?, ?)"
+
+
+class InaClient(threading.Thread):
+    """Receives samples from the Pi into rows, reconnecting when the link drops."""
+
+    BACKOFF_MIN = 0.5
+    BACKOFF_MAX = 30.0
+    RECV_SIZE = 65536
+
+    def __init__(self, host, port=PORT, rows=None, interval=0.0):
+        """interval asks the Pi for at most one sample per sensor every interval seconds."""
+        super().__init__(daemon=True)
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.rows = rows if rows is not None else queue.Queue(QUEUE_SIZE)
+        self.connected = threading.Event()
+        self.stopped = threading.Event()
+        self.connects = 0
+        self.samples = 0
+        self.backfilled = 0
+        self.dropped_bytes = 0
+        self.last_seq = None        # of the last live sample
+
+    def stop(self):
+        self.stopped.set()
+
+    def _connect(self):
+        backoff = self.BACKOFF_MIN
+        while not self.stopped.is_set():
+            try:
+                return socket.create_connection((self.host, self.port), timeout=10)
+            except OSError as e:
+                print(f"INA connect to {self.host}:{self.port} failed ({e}), retrying in {backoff:.1f} s")
+                self.stopped.wait(backoff)
+                backoff = min(backoff * 2, self.BACKOFF_MAX)
+        return None
+
+    def _follow(self, connection, samples, first):
+        """Asks for the samples missing before these, returns the last sequence number."""
+        seq = samples[0][0]
+        if self.interval == 0 and self.last_seq is not None and self.last_seq + 1 < seq:
+            connection.sendall(encode_backfill(self.last_seq + 1, seq - 1))
+        elif first and self.last_seq is not None and seq <= self.last_seq:
+            print(f"INA server restarted its sequence at {seq}, after {self.last_seq}")
+        return samples[-1][0]
+
+    def _receive(self, connection):
+        decoder = FrameDecoder()
+        first = True
+        connection.settimeout(1.0)
+        while not self.stopped.is_set():
+            try:
+                data = connection.recv(self.RECV_SIZE)
+            except socket.timeout:
+                continue
+            if not data:
+                return
+            for kind, payload in decoder.feed(data):
+                if kind == SAMPLES:
+                    samples = decode_samples(payload)
+                    if samples:
+                        self.last_seq = self._follow(connection, samples, first)
+                        first = False
+                    self._put(samples)
+                    self.samples += len(samples)
+                elif kind == RESENT:
+                    samples = decode_samples(payload)
+                    self._put(samples)
+                    self.backfilled += len(samples)
+            self.dropped_bytes = decoder.dropped_bytes
+
+    def _put(self, samples):
+        for seq, bus, address, t, current, voltage, power in samples:
+            self.rows.put((sensor_number(bus, address), current, voltage, power, t))
+
+    def run(self):
+        while not self.stopped.is_set():
+            connection = self._connect()
+            if connection is None:
+                break
+            self.connects += 1
+            self.connected.set()
+            print(f"Connected to INA server {self.host}:{self.port}")
+            try:
+                if self.interval > 0:
+                    connection.sendall(encode_subscribe(self.interval))
+                self._receive(connection)
+            except OSError as e:
+                print(f"INA connection lost: {e}")
+            finally:
+                self.connected.clear()
+                connection.close()
+
+
+class SqliteWriter(threading.Thread):
+    """Inserts rows from a queue into the VMBOX table, BATCH_SIZE rows or BATCH_TIME seconds per transaction."""
+
+    BATCH_SIZE = 5000
+    BATCH_TIME = 1.0
+
+    def __init__(self, db_path, rows):
+        super().__init__(daemon=True)
+        self.db_path = db_path
+        self.rows = rows
+        self.stopped = threading.Event()
+        self.inserted = 0
+        self.errors = 0
+
+    def stop(self):
+        self.stopped.set()
+
+    def _batch(self):
+        try:
+            batch = [self.rows.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.BATCH_TIME
+        while len(batch) < self.BATCH_SIZE:
+            try:
+                batch.append(self.rows.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+        with sqlite3.connect(self.db_path) as connection:
+            connection.execute(CREATE_TABLE)
+            connection.commit()
+            while not self.stopped.is_set() or not self.rows.empty():
+                batch = self._batch()
+                if not batch:
+                    continue
+                try:
+                    with connection:
+                        connection.executemany(INSERT, batch)
+                    self.inserted += len(batch)
+                except sqlite3.Error as e:
+                    self.errors += 1
+                    print(f"Database error: {e}")
@@ -0,0 +1,110 @@
+"""INA telemetry stream between the Pi (ina.py) and the bench host.
+
+The stream is a sequence of frames
+
+    magic 'IN' | version (1) | kind (1) | payload length (4) | payload | crc32 (4)
+
+all little endian, with the crc32 over the header and payload.  A SAMPLES
+frame carries fixed size records of (seq, bus, address, t, current, voltage,
+power) with seq the Pi's sequence number of the sample, counting from 1, and
+t the unix time the device was read on the Pi, in SI units.  A client may
+send the Pi a SUBSCRIBE frame to get fewer samples, and a BACKFILL frame to
+have samples it missed sent again from the Pi's ring (ina_ring.py) in RESENT
+frames.
+"""
+import struct
+import zlib
+
+PORT = 12346
+
+MAGIC = b'IN'
+VERSION = 2
+HEADER = struct.Struct("<2sBBI")        # magic, version, kind, payload length
+TRAILER = struct.Struct("<I")           # crc32
+MAX_PAYLOAD = 1 << 20
+
+# frame kinds
+SAMPLES = 1
+SUBSCRIBE = 2       # client to Pi, at most one sample per sensor every interval seconds
+RESENT = 3          # samples sent again for a BACKFILL, as SAMPLES
+BACKFILL = 4        # client to Pi, send the samples first..last again
+
+SUBSCRIPTION = struct.Struct("<d")      # interval (s), 0 for every sample
+RANGE = struct.Struct("<QQ")            # first, last sequence number
+LAST_SEQ = (1 << 64) - 1
+
+# seq, bus, address, t (s), current (A), voltage (V), power (W)
+SAMPLE = struct.Struct("<QBBdfff")
+
+# sensors on the Pi, numbered 1..20 in this order by the bench host
+SENSOR_BUSES = [1, 6]
+SENSOR_ADDRESSES = [0x40, 0x41, 0x42, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48, 0x49]
+
+
+def sensor_number(bus, address):
+    """Number 1..20 the bench host uses for the sensor at bus and address."""
+    return SENSOR_BUSES.index(bus) * len(SENSOR_ADDRESSES) + SENSOR_ADDRESSES.index(address) + 1
+
+
+def encode_frame(kind, payload):
+    header = HEADER.pack(MAGIC, VERSION, kind, len(payload))
+    return header + payload + TRAILER.pack(zlib.crc32(payload, zlib.crc32(header)))
+
+
+def encode_samples(samples, kind=SAMPLES):
+    """One SAMPLES (or RESENT) frame of (seq, bus, address, t, current, voltage, power) tuples."""
+    return encode_frame(kind, b''.join(SAMPLE.pack(*sample) for sample in samples))
+
+
+def encode_subscribe(interval):
+    return encode_frame(SUBSCRIBE, SUBSCRIPTION.pack(interval))
+
+
+def encode_backfill(first, last=LAST_SEQ):
+    return encode_frame(BACKFILL, RANGE.pack(first, last))
+
+
+def decode_samples(payload):
+    return list(SAMPLE.iter_unpack(payload))
+
+
+class FrameDecoder:
+    """Splits a byte stream into frames, however it was cut up by TCP.
+
+    Bytes that aren't a valid frame are skipped up to the next magic and
+    counted in dropped_bytes.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.frames = 0
+        self.dropped_bytes = 0
+
+    def feed(self, data):
+        """Adds received bytes, returns the list of complete (kind, payload) frames."""
+        self.buffer += data
+        frames = []
+        while len(self.buffer) >= HEADER.size:
+            if self.buffer[:2] != MAGIC:
+                start = self.buffer.find(MAGIC, 1)
+                skip = start if start > 0 else len(self.buffer) - 1
+                del self.buffer[:skip]
+                self.dropped_bytes += skip
+                continue
+            magic, version, kind, length = HEADER.unpack_from(self.buffer)
+            if version != VERSION or length > MAX_PAYLOAD:
+                del self.buffer[:1]
+                self.dropped_bytes += 1
+                continue
+            end = HEADER.size + length + TRAILER.size
+            if len(self.buffer) < end:
+                break
+            crc, = TRAILER.unpack_from(self.buffer, end - TRAILER.size)
+            if crc != zlib.crc32(self.buffer[:end - TRAILER.size]):
+                del self.buffer[:1]
+                self.dropped_bytes += 1
+                continue
+            frames.append((kind, bytes(self.buffer[HEADER.size:end - TRAILER.size])))
+            del self.buffer[:end]
+            self.frames += 1
+        return frames
@@ -0,0 +1,77 @@
+"""Ring of the latest INA samples on the Pi, in a memory mapped file.
+
+Every sample gets the next sequence number and goes in slot seq % capacity,
+so the ring holds the last capacity samples.  The file keeps the next
+sequence number, so the ring and the numbering carry on when ina.py is
+restarted.  Clients ask for samples they missed by sequence number
+(ina_protocol BACKFILL).
+"""
+import mmap
+import os
+import struct
+import threading
+
+from ina_protocol import SAMPLE
+
+MAGIC = b'INARING1'
+HEADER = struct.Struct("<8sQQ")     # magic, capacity, next sequence number
+
+
+class SampleRing:
+
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        size = HEADER.size + capacity * SAMPLE.size
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            header = os.pread(fd, HEADER.size, 0)
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.next_seq = 1
+        if len(header) == HEADER.size:
+            magic, old_capacity, next_seq = HEADER.unpack(header)
+            if magic == MAGIC and old_capacity == capacity:
+                self.next_seq = next_seq
+        if self.next_seq == 1:
+            self.map[:HEADER.size] = HEADER.pack(MAGIC, capacity, 1)
+
+    @property
+    def first_seq(self):
+        """Oldest sequence number still in the ring."""
+        return max(1, self.next_seq - self.capacity)
+
+    def append(self, sample):
+        """Stores (bus, address, t, current, voltage, power), returns the record with its sequence number."""
+        with self.lock:
+            seq = self.next_seq
+            record = (seq,) + tuple(sample)
+            SAMPLE.pack_into(self.map, HEADER.size + (seq % self.capacity) * SAMPLE.size, *record)
+            self.next_seq = seq + 1
+            HEADER.pack_into(self.map, 0, MAGIC, self.capacity, self.next_seq)
+        return record
+
+    def read(self, first, last, limit):
+        """Up to limit records from first to last that are still in the ring."""
+        records = []
+        with self.lock:
+            seq = max(first, self.first_seq)
+            last = min(last, self.next_seq - 1)
+            while seq <= last and len(records) < limit:
+                record = SAMPLE.unpack_from(self.map, HEADER.size + (seq % self.capacity) * SAMPLE.size)
+                if record[0] == seq:
+                    records.append(record)
+                seq += 1
+        return records
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
@@ -1,14 +1,16 @@
 from pywebio import start_server
 from pywebio.output import put_html, put_error
 from pywebio.input import input
-import socket
-import datetime
 import sqlite3
 import os
+import sys
 import threading
 from flask import Flask, jsonify
 import time
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ina_client import CREATE_TABLE, InaClient, SqliteWriter
+
 # Configuration for the SQLite database
 db_directory = '/var/lib/grafana/db'
 os.makedirs(db_directory, exist_ok=True)  # Create the directory if it doesn't exist
@@ -22,69 +24,23 @@ app = Flask(__name__)
 def setup_database():
     with sqlite3.connect(db_path) as connection:
         cursor = connection.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS VMBOX (
-                address INTEGER,
-                current INTEGER,
-                voltage INTEGER,
-                power INTEGER,
-                timestamps REAL
-            )
-        """)
+        cursor.execute(CREATE_TABLE)
         connection.commit()
 
-def insert_data(address, timestamp, current, voltage, power):
-    try:
-        with sqlite3.connect(db_path) as connection:
-            cursor = connection.cursor()
-            cursor.execute("""
-                INSERT INTO VMBOX (address, current, voltage, power, timestamps) 
-                VALUES (?, ?, ?, ?, ?)
-            """, (address, current, voltage, power, timestamp))
-            connection.commit()
-    except sqlite3.Error as e:
-        put_error(f"Database error: {e}")
+collector = []
+collector_lock = threading.Lock()
 
 def collect_data():
-    IP_Address = "192.168.80.104"
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    
-    try:
-        client_socket.connect((IP_Address, 12345))
-        client_socket.settimeout(None)  # Disable timeout for continuous reading
-
-        addresses_all = [i for i in range(1, 21)]
-
-        while True:
-            try:
-                # Read data from the socket
-                data = client_socket.recv(1024).decode('utf-8')
-                if not data:
-                    continue
-
-                data_split = data.split(',')
-                if len(data_split) < 3:
-                    continue
-
-                # Process data for each address
-                for address in addresses_all:
-                    curr_curr, curr_vol, curr_pow = data_split[:3]
-                    timestamp = datetime.datetime.now().timestamp()
-
-                    # Insert data into the database
-                    insert_data(address, timestamp, curr_curr, curr_vol, curr_pow)
-
-            except socket.error as e:
-                print(f"Socket error: {e}")
-                break
-            except Exception as e:
-                print(f"Error in data collection: {e}")
-                break
-
-    except Exception as e:
-        print(f"Failed to connect or socket error: {e}")
-    finally:
-        client_socket.close()
+    # every dashboard session calls this, but the samples must only be collected once
+    with collector_lock:
+        if collector:
+            return
+        IP_Address = "192.168.80.104"
+        client = InaClient(IP_Address)
+        writer = SqliteWriter(db_path, client.rows)
+        writer.start()
+        client.start()
+        collector.extend([client, writer])
 
 @app.route('/data')
 def get_data():